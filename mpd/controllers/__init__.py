@@ -0,0 +1 @@
+from .nmpc import *
@@ -0,0 +1,119 @@
+import casadi as ca
+import numpy as np
+
+
+class CartPoleNMPC:
+    """
+    Nonlinear MPC for the cart pole, built once as a parametric CasADi Opti problem.
+    The starting state x0 is an opti.parameter, so consecutive solves only update its value and the initial
+    guesses, instead of rebuilding the symbolic graph and the IPOPT instance.
+
+    Warm start: pass a previous (shifted) solution as initial guesses and its constraint multipliers as initial_lam_g.
+    The dual initial guess is only used by IPOPT with 'ipopt.warm_start_init_point': 'yes' in opts_setting.
+
+    system_update(system_dynamic, ts, x, u) -> x_next, e.g. EulerForwardCartpole_virtual_Casadi
+    """
+
+    def __init__(self, system_update, system_dynamic, num_state, horizon, Q_cost, R_cost, P_cost, ts, opts_setting):
+        self.num_state = num_state
+        self.horizon = horizon
+        self.ts = ts
+
+        Q_cost = np.asarray(Q_cost)
+        P_cost = np.asarray(P_cost)
+
+        self.opti = ca.Opti()
+
+        # x and u mpc prediction along N
+        self.X_pre = self.opti.variable(num_state, horizon + 1)
+        self.U_pre = self.opti.variable(1, horizon)
+        self.x0_param = self.opti.parameter(num_state)
+
+        self.opti.subject_to(self.X_pre[:, 0] == self.x0_param)  # starting state
+
+        # initial cost
+        cost = 0
+        for i in range(num_state):
+            cost += Q_cost[i, i] * self.X_pre[i, 0]**2
+
+        # state cost
+        for k in range(0, horizon - 1):
+            x_next = system_update(system_dynamic, ts, self.X_pre[:, k], self.U_pre[:, k])
+            self.opti.subject_to(self.X_pre[:, k + 1] == x_next)
+            for i in range(num_state):
+                cost += Q_cost[i, i] * self.X_pre[i, k + 1]**2
+            cost += R_cost * self.U_pre[:, k]**2
+
+        # terminal cost
+        x_terminal = system_update(system_dynamic, ts, self.X_pre[:, horizon - 1], self.U_pre[:, horizon - 1])
+        self.opti.subject_to(self.X_pre[:, horizon] == x_terminal)
+        for i in range(num_state):
+            cost += P_cost[i, i] * self.X_pre[i, horizon]**2
+        cost += R_cost * self.U_pre[:, horizon - 1]**2
+
+        self.cost = cost
+        self.opti.minimize(cost)
+        self.opti.solver('ipopt', opts_setting)
+
+        self.stats = None
+        self.lam_g = None
+
+    def solve(self, x0, initial_guess_x, initial_guess_u, initial_lam_g=None):
+        """
+        initial_guess_x: scalar or [ num_state x (horizon + 1) ], initial_guess_u: scalar or [ horizon ]
+        initial_lam_g: constraint multipliers of a previous solve [ num_state * (horizon + 1) ], None -> 0 (cold start)
+        returns X_sol [ num_state x (horizon + 1) ], U_sol [ horizon ], Cost_sol
+        """
+        self.opti.set_value(self.x0_param, x0)
+        self.opti.set_initial(self.X_pre, initial_guess_x)
+        self.opti.set_initial(self.U_pre, initial_guess_u)
+        # reset the duals explicitly, Opti keeps the initial values of the previous solve otherwise
+        self.opti.set_initial(self.opti.lam_g, 0 if initial_lam_g is None else initial_lam_g)
+
+        sol = self.opti.solve()
+        self.stats = sol.stats()
+        self.lam_g = sol.value(self.opti.lam_g)
+
+        X_sol = sol.value(self.X_pre)
+        U_sol = sol.value(self.U_pre)
+        Cost_sol = sol.value(self.cost)
+        return X_sol, U_sol, Cost_sol
+
+    @property
+    def iter_count(self):
+        return self.stats['iter_count']
+
+    @property
+    def solve_time(self):
+        return self.stats['t_wall_total']
+
+    @staticmethod
+    def shift_solution(X_sol, U_sol, lam_g=None):
+        """
+        Receding horizon warm start: drop the first step of a solution and repeat the last one.
+        Constraint multipliers are ordered per step (starting state, then one block per dynamics constraint).
+        """
+        X_guess = np.concatenate((X_sol[:, 1:], X_sol[:, -1:]), axis=1)
+        U_guess = np.concatenate((U_sol[1:], U_sol[-1:]))
+        if lam_g is None:
+            return X_guess, U_guess, None
+        lam_g = np.asarray(lam_g).reshape(-1, X_sol.shape[0])
+        lam_g_guess = np.concatenate((lam_g[1:], lam_g[-1:]), axis=0).reshape(-1)
+        return X_guess, U_guess, lam_g_guess
+
+
+_NMPC_CACHE = {}
+
+
+def get_cart_pole_nmpc(system_update, system_dynamic, num_state, horizon, Q_cost, R_cost, P_cost, ts, opts_setting):
+    """
+    One CartPoleNMPC per (dynamics, horizon, Q, R, P, Ts, solver options) and process.
+    """
+    key = (system_update, system_dynamic, num_state, horizon,
+           np.asarray(Q_cost).tobytes(), float(R_cost), np.asarray(P_cost).tobytes(), float(ts),
+           tuple(sorted(opts_setting.items())))
+    if key not in _NMPC_CACHE:
+        _NMPC_CACHE[key] = CartPoleNMPC(
+            system_update, system_dynamic, num_state, horizon, Q_cost, R_cost, P_cost, ts, opts_setting
+        )
+    return _NMPC_CACHE[key]
@@ -1,3 +1,5 @@
 from .trajectories import *
+from .shard_store import *
 from .cart_pole_u import *
-
+from .cart_pole_memmap import *
+from .batch_loader import *
@@ -0,0 +1,89 @@
+import queue
+import threading
+from math import ceil
+
+import numpy as np
+import torch
+
+
+class TensorBatchLoader:
+    """
+    Batch-level replacement for DataLoader(Subset(dataset, indices)).
+    Each batch is gathered at once with dataset.get_batch(batch_indices), instead of building one dict per sample and
+    collating them. The batches are ready-made dicts, on the device of the dataset fields.
+
+    indices: indices of the (sub)set in the dataset, None for the whole dataset
+    shuffle: new permutation of the indices every epoch, otherwise the order of indices is kept
+    prefetch: number of batches prepared ahead on a background thread (0: no thread)
+    start_batch: the next iteration starts at this batch of the epoch (resuming a training), then it is reset to 0
+    """
+
+    def __init__(self, dataset, indices=None, batch_size=32, shuffle=False, drop_last=False, prefetch=0,
+                 generator=None):
+        self.dataset = dataset
+        if indices is None:
+            indices = torch.arange(len(dataset))
+        self.indices = torch.as_tensor(np.asarray(indices) if not torch.is_tensor(indices) else indices, dtype=torch.long)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.drop_last = drop_last
+        self.prefetch = prefetch
+        self.generator = generator
+        self.start_batch = 0
+
+    def __len__(self):
+        if self.drop_last:
+            return len(self.indices) // self.batch_size
+        return ceil(len(self.indices) / self.batch_size)
+
+    def get_epoch_indices(self):
+        if self.shuffle:
+            return self.indices[torch.randperm(len(self.indices), generator=self.generator)]
+        return self.indices
+
+    def iter_batches(self, epoch_indices, start_batch=0):
+        for i in range(start_batch, len(self)):
+            yield self.dataset.get_batch(epoch_indices[i * self.batch_size:(i + 1) * self.batch_size])
+
+    def __iter__(self):
+        # the epoch permutation is drawn when the iterator is created, a resumed training reproduces it from the rng state
+        epoch_indices = self.get_epoch_indices()
+        start_batch, self.start_batch = self.start_batch, 0
+        batches = self.iter_batches(epoch_indices, start_batch)
+        if self.prefetch <= 0:
+            return batches
+        return self.iter_prefetch(batches)
+
+    def iter_prefetch(self, batches_iter):
+        batches = queue.Queue(maxsize=self.prefetch)
+        stop = threading.Event()
+        done = object()
+
+        def producer():
+            try:
+                for batch in batches_iter:
+                    if stop.is_set():
+                        return
+                    batches.put(batch)
+                batches.put(done)
+            except Exception as e:
+                batches.put(e)
+
+        thread = threading.Thread(target=producer, daemon=True)
+        thread.start()
+        try:
+            while True:
+                batch = batches.get()
+                if batch is done:
+                    break
+                if isinstance(batch, Exception):
+                    raise batch
+                yield batch
+        finally:
+            # the consumer may stop early (e.g. validation), unblock and release the producer
+            stop.set()
+            while thread.is_alive():
+                try:
+                    batches.get_nowait()
+                except queue.Empty:
+                    thread.join(timeout=0.01)
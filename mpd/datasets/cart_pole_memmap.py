@@ -0,0 +1,142 @@
+import json
+import os.path
+
+import numpy as np
+import torch
+
+from mpd.datasets.cart_pole_u import InputsDataset, U_DATA_NAME, X0_CONDITION_DATA_NAME, dataset_base_dir
+from mpd.datasets.normalization import DatasetNormalizer, RunningStats
+
+
+# Memory-mapped training format: one .npy file per field (columnar) and a small json header, in a subdir of the dataset
+MEMMAP_DIR_NAME = 'memmap'
+MEMMAP_HEADER_FILE_NAME = 'header.json'
+MEMMAP_FORMAT_VERSION = 1
+
+
+def load_pt_lazily(path):
+    # zipfile checkpoints (torch >= 2.1) are memory-mapped instead of read into memory
+    try:
+        return torch.load(path, map_location='cpu', mmap=True)
+    except (TypeError, RuntimeError):
+        return torch.load(path, map_location='cpu')
+
+
+def convert_inputs_to_memmap(base_dir, out_dir=None,
+                             u_data_name=U_DATA_NAME, x0_condition_data_name=X0_CONDITION_DATA_NAME,
+                             dtype='float32', chunk_size=65536,
+                             field_key_inputs='inputs', field_key_condition='condition'):
+    """
+    Converts the u_*.pt / x0_*.pt tensors of an InputsDataset into the memory-mapped format read by
+    InputsMemmapDataset. Data is copied in chunks, and the normalizer statistics are computed on the way.
+    dtype: 'float32' or 'float16' (statistics are always computed from the float32 values)
+    """
+    if out_dir is None:
+        out_dir = os.path.join(base_dir, MEMMAP_DIR_NAME)
+    os.makedirs(out_dir, exist_ok=True)
+
+    header = {'version': MEMMAP_FORMAT_VERSION, 'n_samples': None, 'fields': {}, 'stats': {}}
+    for key, file_name in ((field_key_inputs, u_data_name), (field_key_condition, x0_condition_data_name)):
+        data = load_pt_lazily(os.path.join(base_dir, file_name))
+        n = data.shape[0]
+        if header['n_samples'] is None:
+            header['n_samples'] = n
+        elif header['n_samples'] != n:
+            raise ValueError(f'{file_name} has {n} samples, expected {header["n_samples"]}')
+
+        field_file_name = f'{key}.npy'
+        out = np.lib.format.open_memmap(
+            os.path.join(out_dir, field_file_name), mode='w+', dtype=dtype, shape=tuple(data.shape)
+        )
+        shape = list(data.shape)
+        stats = RunningStats(shape[-1])
+        for start in range(0, n, chunk_size):
+            chunk = data[start:start + chunk_size].float()
+            out[start:start + chunk.shape[0]] = chunk.numpy().astype(dtype)
+            stats.update(chunk.reshape(-1, chunk.shape[-1]))
+        out.flush()
+        del out, data
+
+        header['fields'][key] = {'file': field_file_name, 'dtype': dtype, 'shape': shape}
+        header['stats'][key] = stats.get_stats()
+
+    with open(os.path.join(out_dir, MEMMAP_HEADER_FILE_NAME), 'w') as f:
+        json.dump(header, f, indent=2)
+    return out_dir
+
+
+class InputsMemmapDataset(InputsDataset):
+    """
+    InputsDataset on the memory-mapped format written by convert_inputs_to_memmap.
+    Fields are read lazily per sample / batch and normalized on the fly, so the resident memory stays near the batch
+    size and the startup time does not depend on the dataset size.
+    """
+
+    def __init__(self,
+                 dataset_subdir=None,
+                 include_velocity=False,
+                 normalizer='LimitsNormalizer',
+                 memmap_dir_name=MEMMAP_DIR_NAME,
+                 tensor_args=None,
+                 **kwargs):
+
+        self.tensor_args = tensor_args
+
+        self.dataset_subdir = dataset_subdir
+        self.base_dir = os.path.join(dataset_base_dir, self.dataset_subdir)
+        self.memmap_dir = os.path.join(self.base_dir, memmap_dir_name)
+
+        self.field_key_inputs = 'inputs'
+        self.field_key_condition = 'condition'
+        self.fields = {}
+
+        # load data (memory-mapped, nothing is read here)
+        self.include_velocity = include_velocity
+        self.load_inputs()
+
+        # dimensions
+        b, h, d = self.dataset_shape = self.fields[self.field_key_inputs].shape
+        self.n_init = b
+        self.n_support_points = h
+        self.state_dim = d
+        self.inputs_dim = (self.n_support_points, d)
+
+        # normalizer from the statistics computed by the converter, on the cpu (batches are normalized when read)
+        self.normalizer = DatasetNormalizer(
+            {key: RunningStats.from_stats(stats) for key, stats in self.header['stats'].items()},
+            normalizer=normalizer
+        )
+        self.normalizer_keys = [self.field_key_inputs, self.field_key_condition]
+
+    def load_inputs(self):
+        with open(os.path.join(self.memmap_dir, MEMMAP_HEADER_FILE_NAME), 'r') as f:
+            self.header = json.load(f)
+        for key in (self.field_key_inputs, self.field_key_condition):
+            self.fields[key] = np.load(os.path.join(self.memmap_dir, self.header['fields'][key]['file']), mmap_mode='r')
+        print(f'inputs_training -- {self.fields[self.field_key_inputs].shape}')
+
+    def normalize_all_data(self, *keys):
+        # data is normalized per sample / batch in __getitem__
+        pass
+
+    def __repr__(self):
+        msg = f'InputsMemmapDataset\n' \
+              f'n_init: {self.n_init}\n' \
+              f'inputs_dim: {self.inputs_dim}\n'
+        return msg
+
+    def __getitem__(self, index):
+        # index: int, slice or array of indices, only the requested rows are read from disk
+        data = {}
+        for key in self.normalizer_keys:
+            x = torch.from_numpy(np.array(self.fields[key][index], dtype=np.float32))
+            data[f'{key}_normalized'] = self.normalizer(x, key)
+        return data
+
+    def get_batch(self, indices):
+        # rows are read in increasing order from the memmap and put back in the order of indices
+        indices = np.asarray(indices)
+        order = np.argsort(indices, kind='stable')
+        data = self[indices[order]]
+        inverse = torch.from_numpy(np.argsort(order, kind='stable'))
+        return {key: val[inverse] for key, val in data.items()}
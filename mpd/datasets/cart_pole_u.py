@@ -7,6 +7,7 @@ import torch
 from torch.utils.data import Dataset
 
 from mpd.datasets.normalization import DatasetNormalizer
+from mpd.datasets.shard_store import ShardStore, SHARD_STORE_DIR_NAME
 from mpd.utils.loading import load_params_from_yaml
 
 
@@ -17,6 +18,13 @@ DATASET_BASE_PATH = '/root/cartpoleDiff/cart_pole_diffusion_based_on_MPD/trainin
 U_DATA_NAME = 'u_ini_10x15_noise_15_step_50_hor_64.pt'
 X0_CONDITION_DATA_NAME = 'x0_ini_10x15_noise_15_step_50_hor_64_4DoF.pt'
 
+# Sharded store fields (see shard_store.py) read as inputs / condition
+SHARD_U_FIELD = 'u'
+SHARD_X0_FIELD = 'x0'
+
+# Fitted normalizer statistics, saved next to args.yaml of each trained model
+NORMALIZER_FILE_NAME = 'normalizer.pt'
+
 dataset_base_dir = DATASET_BASE_PATH 
 
 class InputsDataset(Dataset, abc.ABC):
@@ -47,6 +55,8 @@ class InputsDataset(Dataset, abc.ABC):
         self.field_key_inputs = 'inputs'
         self.field_key_condition = 'condition'
         self.fields = {}
+        # per-field RunningStats when they are already known (sharded store), computed from the fields otherwise
+        self.field_stats = None
 
         # load data
         self.include_velocity = include_velocity
@@ -63,12 +73,19 @@ class InputsDataset(Dataset, abc.ABC):
         # print(f'fields -- {self.fields}')
 
         # normalize the inputs (for the diffusion model)
-        self.normalizer = DatasetNormalizer(self.fields, normalizer=normalizer)
+        self.normalizer = DatasetNormalizer(
+            self.field_stats if self.field_stats is not None else self.fields, normalizer=normalizer)
         # self.fields[self.field_key_condition] = self.condition
         self.normalizer_keys = [self.field_key_inputs, self.field_key_condition] # [self.field_key_inputs, self.field_key_task]
         self.normalize_all_data(*self.normalizer_keys)
 
     def load_inputs(self):
+        # sharded append-only store, read as one dataset
+        shard_store_dir = os.path.join(self.base_dir, SHARD_STORE_DIR_NAME)
+        if ShardStore.exists(shard_store_dir):
+            self.load_inputs_from_shards(shard_store_dir)
+            return
+
         # load training inputs
         check = self.tensor_args['device']
         print(f'tensor_device -- {check}')
@@ -114,6 +131,19 @@ class InputsDataset(Dataset, abc.ABC):
         self.fields[self.field_key_condition] = x0_condition
         print(f'fields -- {len(self.fields)}')
 
+    def load_inputs_from_shards(self, shard_store_dir):
+        store = ShardStore(shard_store_dir)
+        device = self.tensor_args['device']
+        self.fields[self.field_key_inputs] = store.load_field(SHARD_U_FIELD, device=device)
+        self.fields[self.field_key_condition] = store.load_field(SHARD_X0_FIELD, device=device)
+        # statistics merged over the shards when they were appended
+        self.field_stats = {
+            self.field_key_inputs: store.get_stats(SHARD_U_FIELD, dtype=torch.float32, device=device),
+            self.field_key_condition: store.get_stats(SHARD_X0_FIELD, dtype=torch.float32, device=device),
+        }
+        print(f'inputs_training -- {self.fields[self.field_key_inputs].shape} '
+              f'({len(store.read_manifest()["shards"])} shards)')
+
     def normalize_all_data(self, *keys):
         for key in keys:
             self.fields[f'{key}_normalized'] = self.normalizer(self.fields[f'{key}'], key)
@@ -127,6 +157,16 @@ class InputsDataset(Dataset, abc.ABC):
                 self.fields[f'{key}_normalized'] = self.fields[f'{key}']
 
 
+    def save_normalizer(self, path):
+        # only the per-dimension statistics are saved, not the data
+        torch.save({
+            'normalizer': self.normalizer.state_dict(),
+            'field_key_inputs': self.field_key_inputs,
+            'field_key_condition': self.field_key_condition,
+            'n_support_points': self.n_support_points,
+            'state_dim': self.state_dim,
+        }, path)
+
     def __repr__(self):
         msg = f'InputsDataset\n' \
               f'n_init: {self.n_init}\n' \
@@ -155,6 +195,11 @@ class InputsDataset(Dataset, abc.ABC):
 
         return data
 
+    def get_batch(self, indices):
+        # gathers a whole batch at once from the normalized fields (used by TensorBatchLoader)
+        indices = torch.as_tensor(indices, device=self.fields[self.field_key_inputs].device)
+        return self[indices]
+
     def get_hard_conditions(self, traj, horizon=None, normalize=False):
         raise NotImplementedError
 
@@ -196,6 +241,52 @@ class InputsDataset(Dataset, abc.ABC):
         return self.normalize(x, self.field_key_condition)
 
 
+class InputsNormalizer:
+    """
+    Normalization interface of an InputsDataset (normalize_condition, unnormalize_states, ...), rebuilt from the
+    statistics saved with InputsDataset.save_normalizer, without loading the training data.
+    """
+
+    def __init__(self, normalizer, n_support_points, state_dim,
+                 field_key_inputs='inputs', field_key_condition='condition', **kwargs):
+        self.normalizer = normalizer
+        self.n_support_points = n_support_points
+        self.state_dim = state_dim
+        self.field_key_inputs = field_key_inputs
+        self.field_key_condition = field_key_condition
+
+    @classmethod
+    def load(cls, path, tensor_args=None):
+        device = tensor_args['device'] if tensor_args is not None else None
+        normalizer_dict = torch.load(path, map_location=device)
+        normalizer = DatasetNormalizer.from_state_dict(normalizer_dict.pop('normalizer'), device=device)
+        return cls(normalizer, **normalizer_dict)
+
+    def __repr__(self):
+        msg = f'InputsNormalizer\n' \
+              f'n_support_points: {self.n_support_points}\n' \
+              f'state_dim: {self.state_dim}\n'
+        return msg
+
+    def unnormalize(self, x, key):
+        return self.normalizer.unnormalize(x, key)
+
+    def normalize(self, x, key):
+        return self.normalizer.normalize(x, key)
+
+    def unnormalize_states(self, x):
+        return self.unnormalize(x, self.field_key_inputs)
+
+    def normalize_states(self, x):
+        return self.normalize(x, self.field_key_inputs)
+
+    def unnormalize_condition(self, x):
+        return self.unnormalize(x, self.field_key_condition)
+
+    def normalize_condition(self, x):
+        return self.normalize(x, self.field_key_condition)
+
+
 # class InputsHardDataset(InputsDatasetBase):
 
     # def __init__(self, **kwargs):
@@ -12,13 +12,23 @@ import torch
 class DatasetNormalizer:
 
     def __init__(self, dataset, normalizer):
-        dataset = flatten(dataset)
-
+        '''
+            dataset: { key: [ ... x dim ] } (tensors or RunningStats), or an iterable of shards { key: [ ... x dim ] }
+            the statistics are computed in one streaming pass, only the per-dimension statistics are kept
+        '''
         if type(normalizer) == str:
             normalizer = eval(normalizer)
 
+        if isinstance(dataset, dict):
+            field_stats = {key: get_running_stats(val) for key, val in dataset.items()}
+        else:
+            field_stats = {}
+            for shard in dataset:
+                for key, val in shard.items():
+                    field_stats.setdefault(key, RunningStats()).update(val)
+
         self.normalizers = {}
-        for key, val in dataset.items():
+        for key, val in field_stats.items():
             self.normalizers[key] = normalizer(val)
             # try:
             #     self.normalizers[key] = normalizer(val)
@@ -43,6 +53,26 @@ class DatasetNormalizer:
     def get_field_normalizers(self):
         return self.normalizers
 
+    def state_dict(self):
+        '''
+            per-field normalizer class and statistics (small, independent of the dataset size)
+        '''
+        return {
+            key: {'normalizer_class': type(normalizer).__name__, 'stats': normalizer.get_stats()}
+            for key, normalizer in self.normalizers.items()
+        }
+
+    @classmethod
+    def from_state_dict(cls, state_dict, device=None):
+        dataset_normalizer = cls.__new__(cls)
+        dataset_normalizer.normalizers = {}
+        for key, val in state_dict.items():
+            NormalizerClass = globals()[val['normalizer_class']]
+            stats = {k: v.to(device) if torch.is_tensor(v) and device is not None else v
+                     for k, v in val['stats'].items()}
+            dataset_normalizer.normalizers[key] = NormalizerClass.from_stats(stats)
+        return dataset_normalizer
+
 
 # def flatten(dataset):
 #     '''
@@ -79,6 +109,127 @@ def flatten(dataset):
 
 
 
+#-----------------------------------------------------------------------------#
+#---------------------------- streaming statistics ---------------------------#
+#-----------------------------------------------------------------------------#
+
+class RunningStats:
+    '''
+        per-dimension min, max, mean and (unbiased) std over chunks of [ ... x dim ] data,
+        mergeable (parallel variance update) and serializable
+    '''
+
+    def __init__(self, dim=None, chunk_size=2**20):
+        self.n = 0
+        self.chunk_size = chunk_size
+        self.mins = self.maxs = self.means = self.m2 = None
+        if dim is not None:
+            self._init(dim, torch.float32, 'cpu')
+
+    def _init(self, dim, dtype, device):
+        self.mins = torch.full((dim,), float('inf'), dtype=dtype, device=device)
+        self.maxs = torch.full((dim,), float('-inf'), dtype=dtype, device=device)
+        self.means = torch.zeros(dim, dtype=torch.float64, device=device)
+        self.m2 = torch.zeros(dim, dtype=torch.float64, device=device)
+
+    def update(self, x):
+        x = torch.as_tensor(x)
+        x = x.reshape(-1, x.shape[-1])
+        if self.mins is None:
+            self._init(x.shape[-1], x.dtype, x.device)
+        for start in range(0, x.shape[0], self.chunk_size):
+            chunk = x[start:start + self.chunk_size].to(self.mins.device)
+            self.mins = torch.minimum(self.mins, chunk.min(dim=0).values.to(self.mins.dtype))
+            self.maxs = torch.maximum(self.maxs, chunk.max(dim=0).values.to(self.maxs.dtype))
+            chunk = chunk.double()
+            chunk_means = chunk.mean(dim=0)
+            self._combine(chunk.shape[0], chunk_means, ((chunk - chunk_means)**2).sum(dim=0))
+        return self
+
+    def merge(self, other):
+        if other.n == 0:
+            return self
+        if self.mins is None:
+            self._init(other.mins.shape[0], other.mins.dtype, other.mins.device)
+        device = self.mins.device
+        self.mins = torch.minimum(self.mins, other.mins.to(device, self.mins.dtype))
+        self.maxs = torch.maximum(self.maxs, other.maxs.to(device, self.maxs.dtype))
+        self._combine(other.n, other.means.to(device), other.m2.to(device))
+        return self
+
+    def _combine(self, n_b, means_b, m2_b):
+        n = self.n + n_b
+        delta = means_b - self.means
+        self.means = self.means + delta * n_b / n
+        self.m2 = self.m2 + m2_b + delta**2 * self.n * n_b / n
+        self.n = n
+
+    def get_tensors(self):
+        # statistics in the dtype and on the device of the data
+        stds = (self.m2 / max(self.n - 1, 1)).clamp(min=0).sqrt()
+        return {'mins': self.mins.clone(), 'maxs': self.maxs.clone(),
+                'means': self.means.to(self.mins.dtype), 'stds': stds.to(self.mins.dtype)}
+
+    def get_stats(self):
+        # plain lists (json)
+        stats = {key: val.tolist() for key, val in self.get_tensors().items()}
+        stats['n'] = self.n
+        return stats
+
+    @classmethod
+    def from_stats(cls, stats, dtype=torch.float32, device=None):
+        running_stats = cls()
+        running_stats.n = stats.get('n', 2)  # older headers: any n > 1 gives back the same stds
+        running_stats.mins = torch.tensor(stats['mins'], dtype=dtype, device=device)
+        running_stats.maxs = torch.tensor(stats['maxs'], dtype=dtype, device=device)
+        running_stats.means = torch.tensor(stats['means'], dtype=torch.float64, device=device)
+        running_stats.m2 = torch.tensor(stats['stds'], dtype=torch.float64, device=device)**2 * max(running_stats.n - 1, 1)
+        return running_stats
+
+    def state_dict(self):
+        return {'n': self.n, 'mins': self.mins.cpu(), 'maxs': self.maxs.cpu(),
+                'means': self.means.cpu(), 'm2': self.m2.cpu()}
+
+    def to_json_dict(self):
+        # exact (float64) accumulators as plain lists, to merge the statistics later
+        return {'n': self.n, 'dtype': str(self.mins.dtype).replace('torch.', ''),
+                'mins': self.mins.tolist(), 'maxs': self.maxs.tolist(),
+                'means': self.means.tolist(), 'm2': self.m2.tolist()}
+
+    @classmethod
+    def from_json_dict(cls, json_dict, dtype=None, device=None):
+        dtype = getattr(torch, json_dict['dtype']) if dtype is None else dtype
+        running_stats = cls()
+        running_stats.n = json_dict['n']
+        running_stats.mins = torch.tensor(json_dict['mins'], dtype=dtype, device=device)
+        running_stats.maxs = torch.tensor(json_dict['maxs'], dtype=dtype, device=device)
+        running_stats.means = torch.tensor(json_dict['means'], dtype=torch.float64, device=device)
+        running_stats.m2 = torch.tensor(json_dict['m2'], dtype=torch.float64, device=device)
+        return running_stats
+
+    @classmethod
+    def from_state_dict(cls, state_dict, device=None):
+        running_stats = cls()
+        running_stats.n = state_dict['n']
+        for key in ('mins', 'maxs', 'means', 'm2'):
+            setattr(running_stats, key, state_dict[key].to(device) if device is not None else state_dict[key])
+        return running_stats
+
+
+def get_running_stats(X):
+    '''
+        X: [ ... x dim ] tensor, iterable of [ ... x dim ] shards, or RunningStats
+    '''
+    if isinstance(X, RunningStats):
+        return X
+    if torch.is_tensor(X):
+        return RunningStats().update(X)
+    running_stats = RunningStats()
+    for shard in X:
+        running_stats.update(shard)
+    return running_stats
+
+
 #-----------------------------------------------------------------------------#
 #-------------------------- single-field normalizers -------------------------#
 #-----------------------------------------------------------------------------#
@@ -88,9 +239,12 @@ class Normalizer:
     '''
 
     def __init__(self, X):
-        self.X = X
-        self.mins = X.min(dim=0).values
-        self.maxs = X.max(dim=0).values
+        '''
+            X: [ ... x dim ] tensor, iterable of shards or RunningStats, only the statistics are kept
+        '''
+        stats = get_running_stats(X).get_tensors()
+        self.mins = stats['mins']
+        self.maxs = stats['maxs']
 
     def __repr__(self):
         return (
@@ -101,6 +255,19 @@ class Normalizer:
     def __call__(self, x):
         return self.normalize(x)
 
+    def get_stats(self):
+        return {'mins': self.mins.cpu(), 'maxs': self.maxs.cpu()}
+
+    @classmethod
+    def from_stats(cls, stats):
+        '''
+            rebuilds a fitted normalizer from its statistics, without the data
+        '''
+        normalizer = cls.__new__(cls)
+        for key, val in stats.items():
+            setattr(normalizer, key, val)
+        return normalizer
+
     def normalize(self, *args, **kwargs):
         raise NotImplementedError()
 
@@ -121,10 +288,12 @@ class GaussianNormalizer(Normalizer):
         normalizes to zero mean and unit variance
     '''
 
-    def __init__(self, *args, **kwargs):
-        super().__init__(*args, **kwargs)
-        self.means = self.X.mean(dim=0)
-        self.stds = self.X.std(dim=0)
+    def __init__(self, X, *args, **kwargs):
+        running_stats = get_running_stats(X)
+        super().__init__(running_stats, *args, **kwargs)
+        stats = running_stats.get_tensors()
+        self.means = stats['means']
+        self.stds = stats['stds']
         self.z = 1
 
     def __repr__(self):
@@ -134,6 +303,11 @@ class GaussianNormalizer(Normalizer):
             f'''stds: {torch.round(self.z * self.stds, decimals=2)}\n'''
         )
 
+    def get_stats(self):
+        stats = super().get_stats()
+        stats.update({'means': self.means.cpu(), 'stds': self.stds.cpu(), 'z': self.z})
+        return stats
+
     def normalize(self, x):
         return (x - self.means) / self.stds
 
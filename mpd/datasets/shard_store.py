@@ -0,0 +1,155 @@
+import fcntl
+import json
+import os
+import shutil
+import uuid
+from contextlib import contextmanager
+
+import numpy as np
+import torch
+
+from mpd.datasets.normalization import RunningStats
+
+
+# Append-only sharded dataset: one directory per shard with one .npy file per field (u, x0, j, ...), and a manifest
+# with the shard sizes and the normalizer statistics per shard and merged over the shards.
+# A shard is never rewritten, appending one only merges its statistics into the manifest.
+SHARD_STORE_DIR_NAME = 'shards'
+SHARD_STORE_MANIFEST_FILE_NAME = 'manifest.json'
+SHARD_STORE_FORMAT_VERSION = 1
+
+
+def field_running_stats(data):
+    # per last dimension statistics, 1d fields (e.g. costs j) have one dimension
+    data = torch.as_tensor(data)
+    if data.ndim == 1:
+        data = data.unsqueeze(-1)
+    return RunningStats().update(data)
+
+
+class ShardStore:
+    """
+    root_dir/manifest.json
+    root_dir/shard_00000/u.npy, x0.npy, j.npy
+    ...
+    Several collector processes can append to the same store, the manifest is updated under a file lock and replaced
+    atomically, so readers only see complete shards.
+    """
+
+    def __init__(self, root_dir):
+        self.root_dir = root_dir
+        self.manifest_path = os.path.join(root_dir, SHARD_STORE_MANIFEST_FILE_NAME)
+
+    @staticmethod
+    def exists(root_dir):
+        return os.path.exists(os.path.join(root_dir, SHARD_STORE_MANIFEST_FILE_NAME))
+
+    def read_manifest(self):
+        if not os.path.exists(self.manifest_path):
+            return {'version': SHARD_STORE_FORMAT_VERSION, 'n_samples': 0, 'fields': {}, 'shards': [], 'stats': {}}
+        with open(self.manifest_path, 'r') as f:
+            return json.load(f)
+
+    def _write_manifest(self, manifest):
+        tmp = f'{self.manifest_path}.tmp'
+        with open(tmp, 'w') as f:
+            json.dump(manifest, f, indent=2)
+        os.replace(tmp, self.manifest_path)
+
+    @contextmanager
+    def _lock(self):
+        with open(os.path.join(self.root_dir, '.lock'), 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def append(self, fields, meta=None, dtype=None):
+        """
+        fields: { name: [ n x ... ] } tensors or arrays, same number of samples n
+        meta: json-serializable information about the shard (collection settings, ...)
+        dtype: storage dtype (e.g. 'float32'), None keeps the dtype of the data
+        Returns the shard name
+        """
+        os.makedirs(self.root_dir, exist_ok=True)
+        n_samples = {name: len(data) for name, data in fields.items()}
+        if len(set(n_samples.values())) != 1:
+            raise ValueError(f'fields have different numbers of samples {n_samples}')
+
+        # write the data outside of the lock, in a private directory
+        tmp_dir = os.path.join(self.root_dir, f'.tmp_{uuid.uuid4().hex}')
+        os.makedirs(tmp_dir)
+        shard = {'n_samples': next(iter(n_samples.values())), 'fields': {}, 'stats': {}, 'meta': meta or {}}
+        try:
+            for name, data in fields.items():
+                data = data.detach().cpu().numpy() if torch.is_tensor(data) else np.asarray(data)
+                if dtype is not None:
+                    data = data.astype(dtype)
+                np.save(os.path.join(tmp_dir, f'{name}.npy'), data)
+                shard['fields'][name] = {'file': f'{name}.npy', 'dtype': str(data.dtype), 'shape': list(data.shape[1:])}
+                shard['stats'][name] = field_running_stats(torch.from_numpy(data)).to_json_dict()
+
+            with self._lock():
+                manifest = self.read_manifest()
+                for name, field in shard['fields'].items():
+                    known_field = manifest['fields'].setdefault(name, {'shape': field['shape']})
+                    if known_field['shape'] != field['shape']:
+                        raise ValueError(f'field {name} has shape {field["shape"]}, expected {known_field["shape"]}')
+
+                shard['name'] = f'shard_{len(manifest["shards"]):05d}'
+                os.rename(tmp_dir, os.path.join(self.root_dir, shard['name']))
+
+                # merge the statistics of the new shard, the previous shards are not read again
+                for name, stats in shard['stats'].items():
+                    merged_stats = RunningStats.from_json_dict(stats)
+                    if name in manifest['stats']:
+                        merged_stats = RunningStats.from_json_dict(manifest['stats'][name]).merge(merged_stats)
+                    manifest['stats'][name] = merged_stats.to_json_dict()
+                manifest['shards'].append(shard)
+                manifest['n_samples'] += shard['n_samples']
+                self._write_manifest(manifest)
+        finally:
+            if os.path.exists(tmp_dir):
+                shutil.rmtree(tmp_dir)
+        print(f'{shard["name"]} appended to {self.root_dir} -- {shard["n_samples"]} samples')
+        return shard['name']
+
+    def __len__(self):
+        return self.read_manifest()['n_samples']
+
+    def get_stats(self, name, dtype=None, device=None):
+        # normalizer statistics of a field over all shards
+        return RunningStats.from_json_dict(self.read_manifest()['stats'][name], dtype=dtype, device=device)
+
+    def load_field_shards(self, name, mmap=True):
+        # one (memory-mapped) array per shard, in the order of the manifest
+        return [np.load(os.path.join(self.root_dir, shard['name'], shard['fields'][name]['file']),
+                        mmap_mode='r' if mmap else None)
+                for shard in self.read_manifest()['shards']]
+
+    def get_layout(self, noisy=True):
+        """
+        Row blocks (shard index, start, stop) of the previous full .pt file layout: the normal data of all shards,
+        then the noisy data of all shards (meta size_normal_data: first rows of the shard, all rows without it), the
+        shards sorted by meta idx_group if they have one (appended by parallel workers in completion order).
+        The normal / noisy index ranges of the training split then hold for a store like for the full file.
+        noisy=False: only the normal blocks
+        """
+        shards = self.read_manifest()['shards']
+        order = list(range(len(shards)))
+        if shards and all('idx_group' in shard['meta'] for shard in shards):
+            order.sort(key=lambda i: shards[i]['meta']['idx_group'])
+        size_normal = {i: shards[i]['meta'].get('size_normal_data', shards[i]['n_samples']) for i in order}
+        normal_blocks = [(i, 0, size_normal[i]) for i in order]
+        if not noisy:
+            return normal_blocks
+        noisy_blocks = [(i, size_normal[i], shards[i]['n_samples']) for i in order
+                        if size_normal[i] < shards[i]['n_samples']]
+        return normal_blocks + noisy_blocks
+
+    def load_field(self, name, dtype=torch.float32, device=None):
+        # all shards as one tensor, in the layout of the full file (get_layout)
+        shards = self.load_field_shards(name)
+        blocks = [torch.tensor(np.asarray(shards[i][start:stop]), dtype=dtype) for i, start, stop in self.get_layout()]
+        return torch.cat(blocks, dim=0).to(device)
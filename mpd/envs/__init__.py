@@ -0,0 +1,2 @@
+from .linear_dynamics import *
+from .cart_pole import *
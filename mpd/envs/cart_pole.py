@@ -0,0 +1,118 @@
+import numpy as np
+import torch
+
+from mpd.envs.linear_dynamics import DiscreteLinearDynamics
+from torch_robotics.torch_utils.torch_utils import DEFAULT_TENSOR_ARGS, to_torch
+
+
+############### Linear cart pole (LMPC data) ######################
+LINEAR_A = np.array([
+    [0, 1, 0, 0],
+    [0, -0.1, 3, 0],
+    [0, 0, 0, 1],
+    [0, -0.5, 30, 0]
+])
+LINEAR_B = np.array([
+    [0],
+    [2],
+    [0],
+    [5]
+])
+LINEAR_TS = 0.1
+
+############### Nonlinear cart pole (NMPC data) ######################
+# state: x, x_dot, theta, theta_dot, theta_red (redundant theta state)
+M_car = 4.5
+m_pole = 0.12
+l_pendul = 0.14
+k = 0.5
+c = 0.002
+G = 9.81
+I = (m_pole*l_pendul**2)/3
+v_1 = (M_car + m_pole)/(I*(M_car + m_pole) + (l_pendul**2)*m_pole*M_car)
+v_2 = (I + (l_pendul**2)*m_pole)/(I*(M_car + m_pole) + (l_pendul**2)*m_pole*M_car)
+PI_UNDER_2 = 2/np.pi
+NONLINEAR_TS = 0.01
+
+
+def theta_to_red_theta(theta):
+    return (theta-np.pi)**2/-np.pi + np.pi
+
+
+def nonlinear_cart_pole_step(x, u, dt=NONLINEAR_TS):
+    # Euler forward, x: [ N x 5 ], u: [ N ]
+    x_dot, theta, theta_dot = x[:, 1], x[:, 2], x[:, 3]
+    xdot = torch.stack((
+        x_dot,  # xdot
+
+        -k*v_2*x_dot + ((l_pendul*m_pole)**2)*G*v_2/(I + (l_pendul**2)*m_pole)*theta
+        - l_pendul*m_pole*c*v_2/(I + (l_pendul**2)*m_pole)*theta_dot + v_2*u,  # xddot
+
+        theta_dot,  # thetadot
+
+        -l_pendul*m_pole*k*v_1/(M_car+m_pole)*x_dot + l_pendul*m_pole*G*v_1*theta - c*v_1*theta_dot
+        + l_pendul*m_pole*v_1/(M_car+m_pole)*u,  # thetaddot
+
+        -PI_UNDER_2 * (theta-np.pi) * theta_dot  # theta_stat_dot
+    ), dim=-1)
+    return x + xdot * dt
+
+
+class CartPoleVecEnv:
+    """
+    N cart poles simulated in parallel. The states are held as a [ N x state_dim ] tensor.
+    dynamics='linear': ZOH discretized linear model (4 states), as in the LMPC data collection
+    dynamics='nonlinear': Euler forward 5 state model with the redundant theta state, as in the NMPC data collection
+    """
+
+    def __init__(self, dynamics='linear', dt=None, tensor_args=DEFAULT_TENSOR_ARGS):
+        self.dynamics = dynamics
+        self.tensor_args = tensor_args
+
+        if dynamics == 'linear':
+            self.dt = dt or LINEAR_TS
+            self.state_dim = 4
+            self.linear_dynamics = DiscreteLinearDynamics(LINEAR_A, LINEAR_B, self.dt)
+        elif dynamics == 'nonlinear':
+            self.dt = dt or NONLINEAR_TS
+            self.state_dim = 5
+        else:
+            raise NotImplementedError
+
+        self.state = None
+
+    @staticmethod
+    def initial_state_grid(position_range, theta_range, dynamics='linear'):
+        """
+        All (position, theta) combinations, in the same order as the inference scripts (X0_IDX)
+        """
+        x0 = []
+        for position in position_range:
+            for theta in theta_range:
+                if dynamics == 'linear':
+                    x0.append([round(position, 4), 0, round(theta, 4), 0])
+                else:
+                    x0.append([position, 0, theta, 0, theta_to_red_theta(theta)])
+        return np.array(x0, dtype=float)
+
+    def reset(self, x0):
+        self.state = to_torch(x0, **self.tensor_args).reshape(-1, self.state_dim).clone()
+        return self.state
+
+    def step(self, u):
+        u = to_torch(u, **self.tensor_args).reshape(-1)
+        if self.dynamics == 'linear':
+            self.state = self.linear_dynamics.step_torch(self.state, u)
+        else:
+            self.state = nonlinear_cart_pole_step(self.state, u, self.dt)
+        return self.state
+
+    def closed_loop_cost(self, x_track, u_track, Q, R):
+        """
+        x_track: [ N x (steps + 1) x state_dim ], u_track: [ N x steps ]
+        returns the quadratic cost sum_k x_k^T Q x_k + R u_k^2 of each rollout [ N ]
+        """
+        Q = to_torch(Q, **self.tensor_args)
+        state_cost = torch.einsum('nki,ij,nkj->n', x_track, Q, x_track)
+        input_cost = float(np.asarray(R).squeeze()) * (u_track ** 2).sum(-1)
+        return state_cost + input_cost
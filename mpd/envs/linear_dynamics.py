@@ -0,0 +1,116 @@
+import casadi as ca
+import numpy as np
+import scipy.linalg
+import torch
+
+
+_ZOH_CACHE = {}
+
+
+def zoh_discretization(A, B, Ts):
+    """
+    Zero-order hold discretization, expm([[A, B], [0, 0]] * Ts) = [[A_d, B_d], [0, I]].
+    Cached per (A, B, Ts), so that repeated calls do not recompute the matrix exponential.
+    """
+    A = np.asarray(A, dtype=np.float64)
+    B = np.asarray(B, dtype=np.float64)
+    key = (A.tobytes(), A.shape, B.tobytes(), B.shape, float(Ts))
+    if key not in _ZOH_CACHE:
+        n, m = B.shape
+        M = np.zeros((n + m, n + m))
+        M[:n, :n] = A
+        M[:n, n:] = B
+        M_d = scipy.linalg.expm(M * Ts)
+        A_d, B_d = M_d[:n, :n], M_d[:n, n:]
+        A_d.setflags(write=False)
+        B_d.setflags(write=False)
+        _ZOH_CACHE[key] = (A_d, B_d)
+    return _ZOH_CACHE[key]
+
+
+class DiscreteLinearDynamics:
+    """
+    x_{k+1} = A_d x_k + B_d u_k, discretized once from the continuous time (A, B) with sampling time Ts.
+    NumPy, torch (batched and differentiable) and CasADi front-ends share the same cached matrices.
+    """
+
+    def __init__(self, A, B, Ts):
+        self.Ts = Ts
+        self.A_d, self.B_d = zoh_discretization(A, B, Ts)
+        self.state_dim, self.input_dim = self.B_d.shape
+
+        self._A_d_casadi = ca.DM(self.A_d)
+        self._B_d_casadi = ca.DM(self.B_d)
+        self._torch_cache = {}
+        self._rollout_cache = {}
+
+    # ------------------------------------------ NumPy ------------------------------------------#
+    def step_numpy(self, x, u):
+        """
+        x: [ ... x state_dim ], u: scalar or [ ... ] (single input)
+        """
+        x = np.asarray(x)
+        u = np.asarray(u).reshape(x.shape[:-1] + (1,))
+        return x @ self.A_d.T + u @ self.B_d.T
+
+    def rollout_matrices(self, horizon):
+        """
+        x_k = A_d^k x_0 + sum_{j<k} A_d^{k-1-j} B_d u_j, for k = 0, ..., horizon
+        Phi: [ (horizon + 1) x state_dim x state_dim ], Gamma: [ (horizon + 1) x state_dim x horizon ]
+        """
+        if horizon not in self._rollout_cache:
+            n = self.state_dim
+            A_powers = [np.eye(n)]
+            for _ in range(horizon):
+                A_powers.append(self.A_d @ A_powers[-1])
+            Phi = np.stack(A_powers)
+            Gamma = np.zeros((horizon + 1, n, horizon))
+            for k in range(1, horizon + 1):
+                for j in range(k):
+                    Gamma[k, :, j] = (A_powers[k - 1 - j] @ self.B_d)[:, 0]
+            self._rollout_cache[horizon] = (Phi, Gamma)
+        return self._rollout_cache[horizon]
+
+    def rollout_numpy(self, x0, u_horizon):
+        """
+        x0: [ ... x state_dim ], u_horizon: [ ... x horizon ]
+        returns the states along the horizon, including x0 [ ... x (horizon + 1) x state_dim ]
+        """
+        u_horizon = np.asarray(u_horizon)
+        Phi, Gamma = self.rollout_matrices(u_horizon.shape[-1])
+        return np.einsum('kij,...j->...ki', Phi, np.asarray(x0)) + np.einsum('kij,...j->...ki', Gamma, u_horizon)
+
+    # ------------------------------------------ torch ------------------------------------------#
+    def torch_matrices(self, device, dtype):
+        key = (str(device), dtype)
+        if key not in self._torch_cache:
+            self._torch_cache[key] = (
+                torch.as_tensor(self.A_d, device=device, dtype=dtype),
+                torch.as_tensor(self.B_d, device=device, dtype=dtype),
+            )
+        return self._torch_cache[key]
+
+    def step_torch(self, x, u):
+        """
+        x: [ ... x state_dim ], u: [ ... ] or [ ... x 1 ]
+        """
+        A_d, B_d = self.torch_matrices(x.device, x.dtype)
+        u = u.reshape(x.shape[:-1] + (1,))
+        return x @ A_d.T + u @ B_d.T
+
+    def rollout_torch(self, x0, u_horizon):
+        """
+        x0: [ ... x state_dim ], u_horizon: [ ... x horizon ]
+        returns [ ... x (horizon + 1) x state_dim ]
+        """
+        Phi, Gamma = self.rollout_matrices(u_horizon.shape[-1])
+        Phi = torch.as_tensor(Phi, device=x0.device, dtype=x0.dtype)
+        Gamma = torch.as_tensor(Gamma, device=x0.device, dtype=x0.dtype)
+        return torch.einsum('kij,...j->...ki', Phi, x0) + torch.einsum('kij,...j->...ki', Gamma, u_horizon)
+
+    # ------------------------------------------ CasADi ------------------------------------------#
+    def step_casadi(self, x, u):
+        """
+        x: state_dim x 1 (symbolic or numeric), u: 1 x 1
+        """
+        return ca.mtimes(self._A_d_casadi, x) + self._B_d_casadi * u
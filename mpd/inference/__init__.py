@@ -0,0 +1,2 @@
+from .diffusion_policy import *
+from .evaluation import *
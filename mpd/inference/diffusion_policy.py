@@ -0,0 +1,175 @@
+import os
+
+import torch
+
+from mpd.models.diffusion_models.sample_functions import ddpm_cart_pole_sample_fn
+from mpd.trainer import get_normalizer, load_diffusion_model
+from mpd.utils.loading import load_params_from_yaml
+from torch_robotics.torch_utils.torch_utils import freeze_torch_model_params, DEFAULT_TENSOR_ARGS
+
+
+def shift_horizon(x, n_shift=1, pad='last'):
+    """
+    Receding horizon shift of a plan [ batch x horizon x d ]: drops the first n_shift inputs (already applied) and
+    pads the tail with the last input ('last') or with zeros ('zeros').
+    """
+    if n_shift <= 0:
+        return x
+    n_shift = min(n_shift, x.shape[1])
+    if pad == 'last':
+        tail = x[:, -1:].expand(-1, n_shift, *x.shape[2:])
+    elif pad == 'zeros':
+        tail = torch.zeros_like(x[:, :n_shift])
+    else:
+        raise NotImplementedError
+    return torch.cat([x[:, n_shift:], tail], dim=1)
+
+
+class DiffusionPolicy:
+    """
+    Receding horizon policy around a trained classifier-free guided diffusion model.
+    The model is built from args.yaml and the checkpoint, compiled and warmed up once, so that every call to act()
+    only pays for sampling.
+
+    Warm start (warm_start_steps=k): the plan of the previous call, shifted by one control step, is noised to the
+    diffusion timestep k - 1 and only the last k denoising steps are run (instead of all n_diffusion_steps from pure
+    noise). warm_start_prior: optional cheap prior (e.g. an AMPC network), called with the current states
+    [ batch x state_dim ] and returning unnormalized inputs [ batch x horizon (x state_dim) ], used as the seed instead
+    of the previous plan. Without a previous plan (first call, reset(), other batch size) the sampling is cold.
+    """
+
+    def __init__(self,
+                 model_dir=None,
+                 context_weight=0.01,
+                 n_samples=1,
+                 dataset=None,
+                 checkpoint_name=None,
+                 compile_model=True,
+                 sample_fn=ddpm_cart_pole_sample_fn,
+                 tensor_args=DEFAULT_TENSOR_ARGS,
+                 warm_start_steps=None,
+                 warm_start_prior=None,
+                 warm_start_pad='last',
+                 **sample_kwargs):
+        self.model_dir = model_dir
+        self.tensor_args = tensor_args
+        self.args = load_params_from_yaml(os.path.join(model_dir, 'args.yaml'))
+
+        self.context_weight = context_weight
+        self.n_samples = n_samples
+        self.sample_kwargs = dict(sample_fn=sample_fn, **sample_kwargs)
+        if 'distilled_timesteps' in self.args:
+            # few-step student of a progressive distillation: its own DDIM timesteps, guidance distilled (w = 0)
+            self.context_weight = 0.
+            self.sample_kwargs.update(ddim=True, eta=0., n_sampling_steps=len(self.args['distilled_timesteps']),
+                                      timestep_respacing=list(self.args['distilled_timesteps']))
+            if warm_start_steps:
+                raise ValueError('a warm start needs timesteps below warm_start_steps, the timesteps of a distilled '
+                                 'student are fixed')
+
+        # receding horizon warm start, None: cold sampling at every call
+        self.warm_start_steps = warm_start_steps
+        self.warm_start_prior = warm_start_prior
+        self.warm_start_pad = warm_start_pad
+        self.previous_inputs_normalized = None
+
+        # normalizer (and dimensions) of the training data
+        if dataset is None:
+            dataset = get_normalizer(model_dir=model_dir, **self.args, tensor_args=tensor_args)
+        self.dataset = dataset
+        self.state_dim = dataset.state_dim
+        self.n_support_points = dataset.n_support_points
+        self.condition_dim = dataset.normalizer.normalizers[dataset.field_key_condition].mins.shape[-1]
+
+        # model
+        self.model = self.load_model(checkpoint_name)
+        if compile_model:
+            # compile the denoiser, which is the module called at every diffusion step
+            self.model.model = torch.compile(self.model.model)
+
+        # preallocated buffers
+        self.x0_buffer = torch.zeros((n_samples, self.condition_dim), **tensor_args)
+        self.context_mask_buffer = torch.zeros((n_samples, 1), **tensor_args)
+
+        self.warmup()
+
+    def load_model(self, checkpoint_name=None):
+        diffusion_model = load_diffusion_model(
+            model_dir=self.model_dir, args=self.args, checkpoint_name=checkpoint_name,
+            state_dim=self.state_dim, n_support_points=self.n_support_points, tensor_args=self.tensor_args
+        )
+        freeze_torch_model_params(diffusion_model)
+        return diffusion_model
+
+    @torch.no_grad()
+    def warmup(self):
+        context = self.dataset.normalize_condition(self.x0_buffer)
+        self.model.warmup_CFG(
+            horizon=self.n_support_points, device=self.tensor_args['device'],
+            context=context, context_mask=self.context_mask_buffer,
+            fused_cfg=self.sample_kwargs.get('fused_cfg', True) and self.context_weight != 0
+        )
+
+    def get_x0_buffer(self, batch_size):
+        if self.x0_buffer.shape[0] != batch_size:
+            self.x0_buffer = torch.zeros((batch_size, self.condition_dim), **self.tensor_args)
+        return self.x0_buffer
+
+    def reset(self):
+        # forget the previous plan (new episode / initial state), the next call samples cold
+        self.previous_inputs_normalized = None
+
+    @torch.no_grad()
+    def get_warm_start(self, x0_buffer):
+        # normalized seed of the warm start [ batch x horizon x state_dim ], None: cold sampling
+        if not self.warm_start_steps:
+            return None
+        shape = (x0_buffer.shape[0], self.n_support_points, self.state_dim)
+        if self.warm_start_prior is not None:
+            inputs = torch.as_tensor(self.warm_start_prior(x0_buffer), **self.tensor_args).reshape(shape)
+            return self.dataset.normalize_states(inputs)
+        previous = self.previous_inputs_normalized
+        if previous is None or previous.shape != shape:
+            return None
+        return shift_horizon(previous, n_shift=1, pad=self.warm_start_pad)
+
+    @torch.no_grad()
+    def sample(self, x0_buffer):
+        context = self.dataset.normalize_condition(x0_buffer)
+        sample_kwargs = self.sample_kwargs
+        x_warm_start = self.get_warm_start(x0_buffer)
+        if x_warm_start is not None:
+            sample_kwargs = dict(sample_kwargs, x_warm_start=x_warm_start, n_warm_start_steps=self.warm_start_steps)
+        inputs_normalized = self.model.run_CFG(
+            context, None, self.context_weight,
+            n_samples=x0_buffer.shape[0], horizon=self.n_support_points,
+            return_chain=False,
+            **sample_kwargs
+        )
+        if self.warm_start_steps:
+            self.previous_inputs_normalized = inputs_normalized
+        return self.dataset.unnormalize_states(inputs_normalized)
+
+    @torch.no_grad()
+    def act(self, x0):
+        """
+        x0: current state [ state_dim ] (numpy array or tensor)
+        returns the (unnormalized) control inputs along the horizon [ n_samples x horizon x state_dim ]
+        """
+        x0_buffer = self.get_x0_buffer(self.n_samples)
+        x0_buffer.copy_(torch.as_tensor(x0).reshape(1, -1))
+        return self.sample(x0_buffer)
+
+    @torch.no_grad()
+    def act_batch(self, x0):
+        """
+        x0: current states of N systems [ N x state_dim ]
+        Samples the control inputs of all systems with a single diffusion sampling call.
+        returns the (unnormalized) control inputs along the horizon [ N x n_samples x horizon x state_dim ]
+        """
+        x0 = torch.as_tensor(x0).reshape(-1, self.condition_dim)
+        n_systems = x0.shape[0]
+        x0_buffer = self.get_x0_buffer(n_systems * self.n_samples)
+        x0_buffer.copy_(x0.repeat_interleave(self.n_samples, dim=0))
+        inputs = self.sample(x0_buffer)
+        return inputs.reshape(n_systems, self.n_samples, *inputs.shape[1:])
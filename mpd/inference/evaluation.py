@@ -0,0 +1,62 @@
+import numpy as np
+import torch
+
+from torch_robotics.torch_utils.torch_timer import TimerCUDA
+from torch_robotics.torch_utils.torch_utils import to_numpy
+
+
+@torch.no_grad()
+def rollout_policy_batched(policy, env, x0, n_steps, Q=None, R=None):
+    """
+    Closed loop rollouts of N initial states at once. At every control step the policy is called once for all states
+    (DiffusionPolicy.act_batch) and the first control input of the first sample is applied to each system.
+    x0: [ N x state_dim ]
+    returns a dict with the per state trajectories and the aggregate metrics
+    """
+    x = env.reset(x0)
+    if hasattr(policy, 'reset'):
+        policy.reset()  # no warm start from a previous rollout
+    n_systems, state_dim = x.shape
+
+    x_track = torch.zeros((n_systems, n_steps + 1, state_dim), **env.tensor_args)
+    u_track = torch.zeros((n_systems, n_steps), **env.tensor_args)
+    u_horizon_track = torch.zeros((n_systems, n_steps, policy.n_support_points), **env.tensor_args)
+    sampling_time = np.zeros(n_steps)
+
+    x_track[:, 0] = x
+    for i in range(n_steps):
+        with TimerCUDA() as t_sampling:
+            u_horizon = policy.act_batch(x)[:, 0, :, 0]  # first sample of each system [ N x horizon ]
+        sampling_time[i] = t_sampling.elapsed
+
+        u = u_horizon[:, 0]
+        x = env.step(u)
+
+        x_track[:, i + 1] = x
+        u_track[:, i] = u
+        u_horizon_track[:, i] = u_horizon
+
+    results = dict(
+        x_track=to_numpy(x_track),
+        u_track=to_numpy(u_track),
+        u_horizon_track=to_numpy(u_horizon_track),
+        sampling_time=sampling_time,
+    )
+
+    metrics = dict(
+        n_systems=n_systems,
+        sampling_time_per_step_mean=sampling_time.mean(),
+        sampling_time_total=sampling_time.sum(),
+        final_state_norm_mean=torch.linalg.norm(x_track[:, -1], dim=-1).mean().item(),
+    )
+    if Q is not None:
+        cost = env.closed_loop_cost(x_track, u_track, Q, R)
+        results['cost'] = to_numpy(cost)
+        metrics.update(
+            cost_mean=cost.mean().item(),
+            cost_std=cost.std().item() if n_systems > 1 else 0.,
+            cost_max=cost.max().item(),
+        )
+    results['metrics'] = metrics
+
+    return results
@@ -1,2 +1,4 @@
 from .gaussian_diffusion_loss import *
-from .gaussian_diffusion_cartpoleloss import *
\ No newline at end of file
+from .gaussian_diffusion_cartpoleloss import *
+from .progressive_distillation_loss import *
+from .guidance_distillation_loss import *
@@ -0,0 +1,50 @@
+import torch
+
+
+class GuidanceDistillationLoss:
+    """
+    Guidance distillation (Meng et al., 2023, first stage) of a classifier-free guided cart pole diffusion model:
+    the student gets the guidance weight w as input and regresses the guided output of the teacher
+    (1 + w) * out_context - w * out_noncontext at every timestep, for w drawn uniformly in guidance_weight_range.
+    The student then needs one forward pass per step at any guidance weight.
+
+    teacher: frozen GaussianDiffusionModel trained with context dropout
+    """
+
+    def __init__(self, teacher=None, guidance_weight_range=(0., 1.)):
+        self.teacher = teacher
+        self.guidance_weight_range = guidance_weight_range
+
+    def loss_fn(self, diffusion_model, input_dict, dataset, step=None):
+        inputs_normalized = input_dict[f'{dataset.field_key_inputs}_normalized']
+        context = input_dict[f'{dataset.field_key_condition}_normalized']
+        batch_size = inputs_normalized.shape[0]
+        device = inputs_normalized.device
+
+        t = torch.randint(0, diffusion_model.n_diffusion_steps, (batch_size,), device=device).long()
+        x_t = diffusion_model.q_sample(inputs_normalized, t)
+        w_min, w_max = self.guidance_weight_range
+        w = torch.empty(batch_size, device=device).uniform_(w_min, w_max)
+
+        context_nonmask = torch.zeros(batch_size, 1, device=device)
+        context_mask = torch.ones(batch_size, 1, device=device)
+
+        # guided output of the teacher, conditional and unconditional branches in one forward pass
+        with torch.no_grad():
+            teacher_out = self.teacher.model(
+                torch.cat((x_t, x_t), dim=0),
+                torch.cat((t, t), dim=0),
+                torch.cat((context, context), dim=0),
+                torch.cat((context_nonmask, context_mask), dim=0)
+            )
+            out_context, out_noncontext = teacher_out[:batch_size], teacher_out[batch_size:]
+            w_ = w.reshape(-1, *((1,) * (x_t.ndim - 1)))
+            target = (1 + w_) * out_context - w_ * out_noncontext
+
+        out = diffusion_model.model(x_t, t, context, context_nonmask, guidance_weight=w)
+        loss = ((out - target) ** 2).mean()
+
+        loss_dict = {'guidance_distillation_loss': loss}
+        info = {}
+
+        return loss_dict, info
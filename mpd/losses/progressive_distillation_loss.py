@@ -0,0 +1,67 @@
+import torch
+
+from mpd.models.diffusion_models.sample_functions import extract
+
+
+class ProgressiveDistillationLoss:
+    """
+    Progressive distillation (Salimans & Ho, 2022) of a classifier-free guided cart pole diffusion model:
+    one deterministic DDIM step of the student from t to t_next matches two guided DDIM steps of the teacher
+    (t -> t_mid -> t_next), so every round halves the number of sampling steps.
+    The guidance weight is distilled into the student, which only runs the conditional branch (sampled with w = 0).
+
+    teacher: frozen GaussianDiffusionModel (the trained model, or the student of the previous round)
+    teacher_timesteps: descending DDIM timesteps of the teacher (even number), the student visits every other one
+    context_weight: guidance weight of the teacher (0 for the students of the previous rounds)
+    """
+
+    def __init__(self, teacher=None, teacher_timesteps=None, context_weight=0.):
+        assert len(teacher_timesteps) % 2 == 0, 'the teacher needs an even number of sampling steps'
+        self.teacher = teacher
+        self.teacher.w = context_weight
+        device = teacher.betas.device
+        teacher_timesteps = torch.tensor(list(teacher_timesteps) + [-1], device=device, dtype=torch.long)
+        # student step i: teacher_timesteps[2i] -> [2i + 1] -> [2i + 2]
+        self.student_t = teacher_timesteps[0:-1:2]
+        self.teacher_t_mid = teacher_timesteps[1::2]
+        self.student_t_next = teacher_timesteps[2::2]
+
+    def loss_fn(self, diffusion_model, input_dict, dataset, step=None):
+        inputs_normalized = input_dict[f'{dataset.field_key_inputs}_normalized']
+        context = input_dict[f'{dataset.field_key_condition}_normalized']
+        batch_size = inputs_normalized.shape[0]
+        device = inputs_normalized.device
+
+        # one student step per sample
+        step_idx = torch.randint(0, len(self.student_t), (batch_size,), device=device)
+        t, t_mid, t_next = self.student_t[step_idx], self.teacher_t_mid[step_idx], self.student_t_next[step_idx]
+
+        # the first step starts from pure noise, like the sampler
+        x_t = diffusion_model.q_sample(inputs_normalized, t)
+        first_step = (step_idx == 0).reshape(-1, *((1,) * (x_t.ndim - 1)))
+        x_t = torch.where(first_step, torch.randn_like(x_t), x_t)
+
+        context_nonmask = torch.zeros(batch_size, 1, device=device)
+        context_mask = torch.ones(batch_size, 1, device=device)
+
+        # two guided DDIM steps of the teacher
+        with torch.no_grad():
+            x_mid = self.teacher.ddim_cart_pole_step(x_t, t, t_mid, context, context_nonmask, context_mask)
+            x_next = self.teacher.ddim_cart_pole_step(x_mid, t_mid, t_next, context, context_nonmask, context_mask)
+
+            # x_start for which one DDIM step of the student t -> t_next lands on x_next
+            alpha = extract(diffusion_model.alphas_cumprod, t, x_t.shape)
+            alpha_next = diffusion_model.alphas_cumprod_at(t_next, x_t.shape)
+            sigma_ratio = ((1 - alpha_next) / (1 - alpha)).sqrt()
+            x_start_target = (x_next - sigma_ratio * x_t) / (alpha_next.sqrt() - sigma_ratio * alpha.sqrt())
+
+        # conditional branch only (guidance distilled)
+        x_start = diffusion_model.predict_start_from_noise(
+            x_t, t=t, noise=diffusion_model.model(x_t, t, context, context_nonmask)
+        )
+        loss = ((x_start - x_start_target) ** 2).mean()
+
+        loss_dict = {'distillation_loss': loss}
+        info = {}
+
+        return loss_dict, info
@@ -10,23 +10,53 @@ import einops
 import matplotlib.pyplot as plt
 import numpy as np
 import torch
+import torch.distributed as dist
 import torch.nn as nn
 from abc import ABC
 
 from torch.nn import DataParallel
 
-from mpd.models.diffusion_models.helpers import cosine_beta_schedule, Losses, exponential_beta_schedule
+from mpd.models.diffusion_models.helpers import cosine_beta_schedule, Losses, exponential_beta_schedule, ChainRecorder
 from mpd.models.diffusion_models.sample_functions import extract, apply_hard_conditioning, guide_gradient_steps, \
     ddpm_sample_fn, ddpm_cart_pole_sample_fn
+from mpd.models.diffusion_models.sampling_plan import CartPoleSamplingPlan
 from torch_robotics.torch_utils.torch_timer import TimerCUDA
 from torch_robotics.torch_utils.torch_utils import to_numpy
 
 
+MAX_CACHED_SAMPLING_PLANS = 16
+
+
 def make_timesteps(batch_size, i, device):
     t = torch.full((batch_size,), i, device=device, dtype=torch.long)
     return t
 
 
+def make_respaced_timesteps(n_diffusion_steps, n_sampling_steps, timestep_respacing='uniform'):
+    """
+    Subset of the training timesteps visited by a respaced (DDIM) sampler, in descending order.
+    The first timestep is always n_diffusion_steps - 1, the sampler starts from pure noise.
+    timestep_respacing: 'uniform', 'quadratic' (denser close to t=0) or an explicit list of timesteps.
+    """
+    if isinstance(timestep_respacing, (list, tuple)):
+        times = sorted(set(int(time) for time in timestep_respacing), reverse=True)
+        if not times or times[0] != n_diffusion_steps - 1 or times[-1] < 0:
+            raise ValueError(f'timesteps {list(timestep_respacing)} must start at the last diffusion step '
+                             f'{n_diffusion_steps - 1} and end at a timestep >= 0')
+        return times
+    if n_sampling_steps < 1:
+        raise ValueError(f'n_sampling_steps must be >= 1, got {n_sampling_steps}')
+    # descending from n_diffusion_steps - 1
+    fractions = np.linspace(1., 0., n_sampling_steps)
+    if timestep_respacing == 'uniform':
+        times = (n_diffusion_steps - 1) * fractions
+    elif timestep_respacing == 'quadratic':
+        times = (n_diffusion_steps - 1) * fractions ** 2
+    else:
+        raise NotImplementedError
+    return sorted(set(np.round(times).astype(int).tolist()), reverse=True)
+
+
 def build_context(model, dataset, input_dict):
     # input_dict is already normalized
     context = None
@@ -55,10 +85,27 @@ class GaussianDiffusionModel(nn.Module, ABC):
                  context_model=None,
                  device = 'cuda',
                  drop_prob = 0.25,
+                 n_noise_levels=1,
+                 timestep_sampling='uniform',
+                 importance_weighting=False,
+                 importance_history_decay=0.99,
+                 importance_warmup=10,
                  **kwargs):
+        """
+        Training noise levels:
+        n_noise_levels: K timesteps and noises per clean sequence in the loss (the batch is expanded K times
+            internally), so every loaded batch gives K noise levels per trajectory
+        timestep_sampling: 'uniform' (i.i.d. timesteps) or 'stratified' (low discrepancy: the K timesteps of a
+            sample fall in the K quantile bands of the timestep distribution, and the batch covers every band evenly)
+        importance_weighting: timesteps drawn with p(t) ~ sqrt(E[loss_t^2]) from a running history of the loss per
+            timestep, the losses are weighted by 1 / (n_diffusion_steps * p(t)) (unbiased estimate of the uniform loss).
+            Uniform until every timestep has been seen importance_warmup times.
+        """
         super().__init__()
 
         self.model = model
+        # guidance weight as input of the denoiser (guidance distillation), one forward pass per step
+        self.guidance_distilled = getattr(model, 'guidance_emb_dim', 0) > 0
 
         self.context_model = context_model
 
@@ -70,6 +117,20 @@ class GaussianDiffusionModel(nn.Module, ABC):
 
         self.drop_prob = drop_prob
 
+        self.n_noise_levels = n_noise_levels
+        assert timestep_sampling in ('uniform', 'stratified')
+        self.timestep_sampling = timestep_sampling
+        self.importance_weighting = importance_weighting
+        self.importance_history_decay = importance_history_decay
+        self.importance_warmup = importance_warmup
+        # running E[loss_t^2] per timestep (not in the model state dict, trained models load as before; saved in the
+        # training state to resume, see loss_history_state_dict)
+        self.register_buffer('loss_sq_history', torch.zeros(n_diffusion_steps), persistent=False)
+        self.register_buffer('loss_history_counts', torch.zeros(n_diffusion_steps, dtype=torch.long), persistent=False)
+
+        # precomputed sampling plans of cart_pole_sample_loop
+        self.sampling_plans = {}
+
         if variance_schedule == 'cosine':
             betas = cosine_beta_schedule(n_diffusion_steps, s=0.008, a_min=0, a_max=0.999)
         elif variance_schedule == 'exponential':
@@ -161,13 +222,44 @@ class GaussianDiffusionModel(nn.Module, ABC):
         return model_mean, posterior_variance, posterior_log_variance
     
 
-    def p_mean_variance_CFG(self, x, hard_conds, context, t,  context_nonmask, context_mask,):
+    def predict_start_CFG(self, x, t, context, context_nonmask, context_mask, fused_cfg=True):
+        """
+        Classifier-free guided prediction of x_start.
+        fused_cfg=True stacks the conditional and unconditional branches into one batch of size 2B and runs a
+        single forward pass of the model. fused_cfg=False runs two separate forward passes (reference path).
+        Guidance distilled models get w as input and run one forward pass, w = 0 only runs the conditional branch.
+        """
+        if self.guidance_distilled:
+            guidance_weight = torch.full((x.shape[0],), float(self.w), device=x.device)
+            return self.predict_start_from_noise(
+                x, t=t, noise=self.model(x, t, context, context_nonmask, guidance_weight=guidance_weight)
+            )
+        if self.w == 0:
+            return self.predict_start_from_noise(x, t=t, noise=self.model(x, t, context, context_nonmask))
+
+        if fused_cfg:
+            batch_size = x.shape[0]
+            model_out = self.model(
+                torch.cat((x, x), dim=0),
+                torch.cat((t, t), dim=0),
+                torch.cat((context, context), dim=0),
+                torch.cat((context_nonmask, context_mask), dim=0)
+            )
+            out_context, out_noncontext = model_out[:batch_size], model_out[batch_size:]
+            # predict_start_from_noise is affine in the model output, so mixing the outputs first is equivalent
+            # to mixing the two reconstructions
+            model_out = (1 + self.w) * out_context - self.w * out_noncontext
+            return self.predict_start_from_noise(x, t=t, noise=model_out)
 
         x_recon_context = self.predict_start_from_noise(x, t=t, noise=self.model(x, t, context, context_nonmask)) # no mask (use the context)
         # context_masked = torch.ones(context.size(0),1).to(self.device) #torch.zeros(context.size(0),1).to(device)
         x_recon_noncontext = self.predict_start_from_noise(x, t=t, noise=self.model(x, t, context, context_mask)) # mask (no context)
 
-        x_recon = (1 + self.w) * x_recon_context - self.w * x_recon_noncontext
+        return (1 + self.w) * x_recon_context - self.w * x_recon_noncontext
+
+    def p_mean_variance_CFG(self, x, hard_conds, context, t,  context_nonmask, context_mask, fused_cfg=True):
+
+        x_recon = self.predict_start_CFG(x, t, context, context_nonmask, context_mask, fused_cfg=fused_cfg)
 
         if self.clip_denoised:
             x_recon.clamp_(-1., 1.)
@@ -182,37 +274,68 @@ class GaussianDiffusionModel(nn.Module, ABC):
     def cart_pole_sample_loop(self, shape, hard_conds, context=None, return_chain=False,
                       sample_fn=ddpm_cart_pole_sample_fn,
                       n_diffusion_steps_without_noise=0,
+                      fused_cfg=True,
+                      chain_stride=1, chain_last=None,
+                      x_warm_start=None, n_warm_start_steps=None,
+                      use_sampling_plan=True,
                       **sample_kwargs):
+        """
+        use_sampling_plan: the fused cfg DDPM loop runs on a precomputed CartPoleSamplingPlan (coefficients, time
+        embeddings and buffers cached per steps / batch size / horizon), other sample_fn use the generic loop
+        """
         device = self.betas.device
 
         batch_size = shape[0]
-        x = torch.randn(shape, device=device) # initial state(noise) with shape 1*8*1
+        if x_warm_start is None:
+            n_steps = self.n_diffusion_steps
+            x = torch.randn(shape, device=device) # initial state(noise) with shape 1*8*1
+        else:
+            # warm start: the seed is noised to an intermediate timestep, only the last steps are denoised
+            n_steps, x = self.warm_start(x_warm_start, n_warm_start_steps, shape)
         # print(f'random x -- {x}')
         # x = apply_hard_conditioning(x, hard_conds)
 
-        chain = [x] if return_chain else None
+        if (use_sampling_plan and fused_cfg and sample_fn is ddpm_cart_pole_sample_fn
+                and hasattr(self.model, 'time_mlp')):
+            plan = self.get_sampling_plan(n_steps, n_diffusion_steps_without_noise, shape, device)
+            return plan.run(self, x, context, return_chain=return_chain, chain_stride=chain_stride,
+                            chain_last=chain_last)
 
-        for i in reversed(range(-n_diffusion_steps_without_noise, self.n_diffusion_steps)):
+        chain = ChainRecorder(x, chain_stride, chain_last) if return_chain else None
+
+        for i in reversed(range(-n_diffusion_steps_without_noise, n_steps)):
             t = make_timesteps(batch_size, i, device)
             context_nonmask = torch.zeros(context.size(0),1).to(device)
             context_mask = torch.ones(context.size(0),1).to(device)
-            x = sample_fn(self, x, hard_conds, context, t, context_nonmask, context_mask, **sample_kwargs)
+            x = sample_fn(self, x, hard_conds, context, t, context_nonmask, context_mask, fused_cfg=fused_cfg,
+                          **sample_kwargs)
             # x = apply_hard_conditioning(x, hard_conds)
 
             if return_chain:
                 chain.append(x)
 
         if return_chain:
-            chain = torch.stack(chain, dim=1)
+            chain = chain.stack(x)
             return x, chain
 
         return x
 
 
+    def get_sampling_plan(self, n_steps, n_diffusion_steps_without_noise, shape, device):
+        key = (n_steps, n_diffusion_steps_without_noise, tuple(shape), str(device))
+        plan = self.sampling_plans.get(key)
+        if plan is None or not plan.is_valid(self):
+            if len(self.sampling_plans) >= MAX_CACHED_SAMPLING_PLANS:
+                self.sampling_plans.clear()
+            plan = CartPoleSamplingPlan(self, n_steps, n_diffusion_steps_without_noise, shape[0], shape[1], device)
+            self.sampling_plans[key] = plan
+        return plan
+
     @torch.no_grad()
     def p_sample_loop(self, shape, hard_conds, context=None, return_chain=False,
                       sample_fn=ddpm_sample_fn,
                       n_diffusion_steps_without_noise=0,
+                      chain_stride=1, chain_last=None,
                       **sample_kwargs):
         device = self.betas.device
 
@@ -220,7 +343,7 @@ class GaussianDiffusionModel(nn.Module, ABC):
         x = torch.randn(shape, device=device)
         x = apply_hard_conditioning(x, hard_conds)
 
-        chain = [x] if return_chain else None
+        chain = ChainRecorder(x, chain_stride, chain_last) if return_chain else None
 
         for i in reversed(range(-n_diffusion_steps_without_noise, self.n_diffusion_steps)):
             t = make_timesteps(batch_size, i, device)
@@ -231,7 +354,7 @@ class GaussianDiffusionModel(nn.Module, ABC):
                 chain.append(x)
 
         if return_chain:
-            chain = torch.stack(chain, dim=1)
+            chain = chain.stack(x)
             return x, chain
 
         return x
@@ -243,6 +366,7 @@ class GaussianDiffusionModel(nn.Module, ABC):
         t_start_guide=torch.inf,
         guide=None,
         n_guide_steps=1,
+        chain_stride=1, chain_last=None,
         **sample_kwargs,
     ):
         # Adapted from https://github.com/ezhang7423/language-control-diffusion/blob/63cdafb63d166221549968c662562753f6ac5394/src/lcd/models/diffusion.py#L226
@@ -261,7 +385,7 @@ class GaussianDiffusionModel(nn.Module, ABC):
         x = torch.randn(shape, device=device)
         x = apply_hard_conditioning(x, hard_conds)
 
-        chain = [x] if return_chain else None
+        chain = ChainRecorder(x, chain_stride, chain_last) if return_chain else None
 
         for time, time_next in time_pairs:
             t = make_timesteps(batch_size, time, device)
@@ -308,11 +432,108 @@ class GaussianDiffusionModel(nn.Module, ABC):
                 chain.append(x)
 
         if return_chain:
-            chain = torch.stack(chain, dim=1)
+            chain = chain.stack(x)
             return x, chain
 
         return x
     
+    @torch.no_grad()
+    def ddim_cart_pole_sample(
+        self, shape, hard_conds,
+        context=None, return_chain=False,
+        n_sampling_steps=10,
+        eta=0.,
+        timestep_respacing='uniform',
+        fused_cfg=True,
+        chain_stride=1, chain_last=None,
+        x_warm_start=None, n_warm_start_steps=None,
+        **sample_kwargs,
+    ):
+        """
+        DDIM sampler with classifier-free guidance for the context-conditioned (cart pole) models.
+        Visits only n_sampling_steps of the n_diffusion_steps training timesteps. eta=0 is deterministic DDIM,
+        eta=1 recovers the DDPM posterior variance on the respaced chain.
+        With a warm start, the respaced timesteps cover only the first n_warm_start_steps training timesteps.
+        """
+        device = self.betas.device
+        batch_size = shape[0]
+
+        if x_warm_start is None:
+            n_steps = self.n_diffusion_steps
+            x = torch.randn(shape, device=device)
+        else:
+            n_steps, x = self.warm_start(x_warm_start, n_warm_start_steps, shape)
+
+        times = make_respaced_timesteps(n_steps, n_sampling_steps, timestep_respacing)
+        time_pairs = list(zip(times, times[1:] + [-1]))  # [(T-1, t_1), ..., (t_k, -1)]
+
+        context_nonmask = torch.zeros(context.size(0), 1, device=device)
+        context_mask = torch.ones(context.size(0), 1, device=device)
+
+        chain = ChainRecorder(x, chain_stride, chain_last) if return_chain else None
+
+        for time, time_next in time_pairs:
+            t = make_timesteps(batch_size, time, device)
+            t_next = make_timesteps(batch_size, time_next, device)
+            x = self.ddim_cart_pole_step(x, t, t_next, context, context_nonmask, context_mask, eta=eta,
+                                         fused_cfg=fused_cfg)
+
+            if return_chain:
+                chain.append(x)
+
+        if return_chain:
+            chain = chain.stack(x)
+            return x, chain
+
+        return x
+
+    def ddim_cart_pole_step(self, x, t, t_next, context, context_nonmask, context_mask, eta=0., fused_cfg=True):
+        """
+        One guided DDIM step from the timesteps t to t_next ([ batch ], per sample). t_next = -1 is the end of the
+        chain (alpha_cumprod = 1), the step then returns the predicted x_start.
+        """
+        x_start = self.predict_start_CFG(x, t, context, context_nonmask, context_mask, fused_cfg=fused_cfg)
+        if self.clip_denoised:
+            x_start.clamp_(-1., 1.)
+
+        # noise consistent with the guided (and clipped) x_start
+        pred_noise = (
+            extract(self.sqrt_recip_alphas_cumprod, t, x.shape) * x - x_start
+        ) / extract(self.sqrt_recipm1_alphas_cumprod, t, x.shape)
+
+        alpha = extract(self.alphas_cumprod, t, x.shape)
+        alpha_next = self.alphas_cumprod_at(t_next, x.shape)
+
+        sigma = (
+            eta * ((1 - alpha / alpha_next) * (1 - alpha_next) / (1 - alpha)).sqrt()
+        )
+        c = (1 - alpha_next - sigma**2).clamp(min=0.).sqrt()
+
+        x = x_start * alpha_next.sqrt() + c * pred_noise
+
+        # add noise
+        if eta > 0:
+            x = x + sigma * torch.randn_like(x)
+        return x
+
+    def alphas_cumprod_at(self, t, x_shape):
+        # alpha_cumprod of the timesteps t, 1 at t = -1 (clean data)
+        alpha = extract(self.alphas_cumprod, t.clamp(min=0), x_shape)
+        return torch.where(t.reshape(alpha.shape) >= 0, alpha, torch.ones_like(alpha))
+
+    def warm_start(self, x_warm_start, n_warm_start_steps, shape):
+        """
+        Partial noising of a seed (e.g. the shifted plan of the previous control step) for receding horizon sampling:
+        the seed is diffused to the timestep n_warm_start_steps - 1 with q_sample, so that denoising the last
+        n_warm_start_steps steps gives a sample close to the seed instead of a sample from pure noise.
+        Returns (n_steps, x)
+        """
+        n_steps = self.n_diffusion_steps if n_warm_start_steps is None else n_warm_start_steps
+        n_steps = min(max(int(n_steps), 1), self.n_diffusion_steps)
+        x_warm_start = x_warm_start.to(self.betas.device).reshape(shape)
+        t = make_timesteps(shape[0], n_steps - 1, self.betas.device)
+        return n_steps, self.q_sample(x_warm_start, t)
+
     @torch.no_grad()
     def cart_pole_sample(self, hard_conds, horizon=None, context = None, batch_size=1, ddim=False, **sample_kwargs):
         '''
@@ -322,7 +543,7 @@ class GaussianDiffusionModel(nn.Module, ABC):
         shape = (batch_size, horizon, self.state_dim)
 
         if ddim:
-            return self.ddim_sample(shape, hard_conds, **sample_kwargs)
+            return self.ddim_cart_pole_sample(shape, hard_conds, context=context, **sample_kwargs)
 
         return self.cart_pole_sample_loop(shape, hard_conds, context=context, **sample_kwargs)
 
@@ -351,14 +572,32 @@ class GaussianDiffusionModel(nn.Module, ABC):
         self.model(x, t, context=None)
 
     @torch.no_grad()
-    def warmup_CFG(self, horizon=64, device='cuda', context=None, context_mask = None):
-        shape = (1, horizon, self.state_dim)
+    def warmup_CFG(self, horizon=64, device='cuda', context=None, context_mask = None, fused_cfg=True):
+        guidance_kwargs = {}
+        if self.guidance_distilled:
+            # a single (conditional) branch, with the guidance weight as input
+            guidance_kwargs = dict(guidance_weight=torch.zeros(context.size(0), device=device))
+        elif fused_cfg:
+            # the fused CFG path runs the model on the stacked (conditional, unconditional) batch
+            context = torch.cat((context, context), dim=0)
+            context_mask = torch.cat((torch.zeros_like(context_mask), torch.ones_like(context_mask)), dim=0)
+        batch_size = context.size(0)
+        shape = (batch_size, horizon, self.state_dim)
         x = torch.randn(shape, device=device)
-        t = make_timesteps(1, 1, device)
-        self.model(x, t, context=context, context_mask=context_mask)
+        t = make_timesteps(batch_size, 1, device)
+        self.model(x, t, context=context, context_mask=context_mask, **guidance_kwargs)
+        if (fused_cfg or self.guidance_distilled) and hasattr(self.model, 'time_mlp'):
+            # the sampling plan passes precomputed time embeddings
+            self.model(x, t, context=context, context_mask=context_mask, t_emb=self.model.time_mlp(t),
+                       **guidance_kwargs)
 
     @torch.no_grad()
     def run_inference(self, context=None, hard_conds=None, n_samples=1, return_chain=False, **diffusion_kwargs):
+        """
+        return_chain: also records the denoising chain [ steps x n_samples x horizon x state_dim ], memory-bounded
+        with chain_stride=k (every k-th step) / chain_last=m (last m recorded steps). By default only the final
+        samples are kept.
+        """
         # context and hard_conds must be normalized
         hard_conds = copy(hard_conds)
         # print(f'hard_conds -- {hard_conds}')
@@ -374,48 +613,46 @@ class GaussianDiffusionModel(nn.Module, ABC):
                 context[k] = einops.repeat(v, 'd -> b d', b=n_samples)
 
         # Sample from diffusion model
-        samples, chain = self.conditional_sample(
-            hard_conds, context=context, batch_size=n_samples, return_chain=True, **diffusion_kwargs
+        samples = self.conditional_sample(
+            hard_conds, context=context, batch_size=n_samples, return_chain=return_chain, **diffusion_kwargs
         )
 
-        # chain: [ n_samples x (n_diffusion_steps + 1) x horizon x (state_dim)]
-        # extract normalized trajectories
-        trajs_chain_normalized = chain
-
-        # trajs: [ (n_diffusion_steps + 1) x n_samples x horizon x state_dim ]
-        trajs_chain_normalized = einops.rearrange(trajs_chain_normalized, 'b diffsteps h d -> diffsteps b h d')
-
         if return_chain:
-            return trajs_chain_normalized
+            # chain: [ n_samples x recorded steps x horizon x (state_dim)]
+            _, chain = samples
+            # trajs: [ recorded steps x n_samples x horizon x state_dim ]
+            return einops.rearrange(chain, 'b diffsteps h d -> diffsteps b h d')
 
-        # return the last denoising step
-        return trajs_chain_normalized[-1]
+        # the last denoising step
+        return samples
     
     def run_CFG(self, context=None, hard_conds=None, context_weight = 0.1, n_samples=1, horizon =8, return_chain=False, **diffusion_kwargs):
+        """
+        Classifier-free guided sampling of (normalized) control inputs.
+        Fast sampling: ddim=True, n_sampling_steps=..., eta=..., timestep_respacing='uniform' | 'quadratic'
+        Warm start: x_warm_start=[ n_samples x horizon x state_dim ] (normalized), n_warm_start_steps=k
+        Chain: return_chain=True returns [ recorded steps x n_samples x horizon x state_dim ] (chain_stride=k,
+        chain_last=m to bound the memory), otherwise only the final samples are kept during sampling.
+        """
         context = copy(context)
-        print(f'context -- {context}')
         self.w = context_weight
                 
         # if context is not None:
         #     context = einops.repeat('d -> b d', b=n_samples)
 
         # Sample from diffusion model
-        samples, chain = self.cart_pole_sample(
-            hard_conds, horizon, context=context, batch_size=n_samples, return_chain=True, **diffusion_kwargs
+        samples = self.cart_pole_sample(
+            hard_conds, horizon, context=context, batch_size=n_samples, return_chain=return_chain, **diffusion_kwargs
         )
 
-        # chain: [ n_samples x (n_diffusion_steps + 1) x horizon x (state_dim)]
-        # extract normalized trajectories
-        inputs_chain_normalized = chain
-
-        # trajs: [ (n_diffusion_steps + 1) x n_samples x horizon x state_dim ]
-        inputs_chain_normalized = einops.rearrange(inputs_chain_normalized, 'b diffsteps h d -> diffsteps b h d')
-
         if return_chain:
-            return inputs_chain_normalized
+            # chain: [ n_samples x recorded steps x horizon x (state_dim)]
+            _, chain = samples
+            # inputs: [ recorded steps x n_samples x horizon x state_dim ]
+            return einops.rearrange(chain, 'b diffsteps h d -> diffsteps b h d')
 
-        # return the last denoising step
-        return inputs_chain_normalized[-1]
+        # the last denoising step
+        return samples
 
 
     # ------------------------------------------ training ------------------------------------------#
@@ -431,7 +668,16 @@ class GaussianDiffusionModel(nn.Module, ABC):
 
         return sample
 
-    def p_losses(self, x_start, context, t, hard_conds):
+    def p_losses(self, x_start, context, t, hard_conds, loss_weights=None):
+        """
+        t: [ batch_size ] or [ batch_size * K ] timesteps, in the second case every sample (and its context) is repeated
+        K times, with one context mask draw per sample
+        loss_weights: per (expanded) sample weights of the loss, None for the plain mean
+        """
+        n_noise_levels = t.shape[0] // x_start.shape[0]
+        if n_noise_levels > 1:
+            x_start = x_start.repeat_interleave(n_noise_levels, dim=0)
+
         noise = torch.randn_like(x_start)
         # print(f"noise-- {noise.shape}")
 
@@ -447,6 +693,9 @@ class GaussianDiffusionModel(nn.Module, ABC):
         mask_shape = torch.rand(context.size(0),1) 
         # print(f"mask_shape -- {mask_shape.size()}")
         context_mask = torch.bernoulli(torch.zeros_like(mask_shape)+self.drop_prob).to(self.device)
+        if n_noise_levels > 1:
+            context = context.repeat_interleave(n_noise_levels, dim=0)
+            context_mask = context_mask.repeat_interleave(n_noise_levels, dim=0)
 
         # diffusion model
         x_recon = self.model(x_noisy, t, context, context_mask)
@@ -454,15 +703,92 @@ class GaussianDiffusionModel(nn.Module, ABC):
 
         assert noise.shape == x_recon.shape
 
-        if self.predict_epsilon:
-            loss, info = self.loss_fn(x_recon, noise)
+        target = noise if self.predict_epsilon else x_start
+        if loss_weights is None and not self.importance_weighting:
+            loss, info = self.loss_fn(x_recon, target)
         else:
-            loss, info = self.loss_fn(x_recon, x_start)
+            loss_per_sample = self.loss_fn.per_sample(x_recon, target)
+            info = {'loss_per_sample': loss_per_sample.detach()}
+            if loss_weights is not None:
+                loss_per_sample = loss_per_sample * loss_weights
+            loss = loss_per_sample.mean()
 
         return loss, info
 
+    def timestep_probs(self):
+        # distribution of the training timesteps
+        uniform = torch.full((self.n_diffusion_steps,), 1. / self.n_diffusion_steps, device=self.betas.device)
+        if not self.importance_weighting or (self.loss_history_counts < self.importance_warmup).any():
+            return uniform
+        probs = self.loss_sq_history.sqrt()
+        probs = probs / probs.sum()
+        # keep some uniform mass, no timestep is starved
+        return 0.9 * probs + 0.1 * uniform
+
+    def sample_timesteps(self, batch_size, n_noise_levels=1, device=None):
+        """
+        [ batch_size * n_noise_levels ] timesteps (the K timesteps of a sample are consecutive) and their importance
+        weights (None without importance weighting)
+        """
+        device = self.betas.device if device is None else device
+        if self.timestep_sampling == 'uniform' and not self.importance_weighting:
+            return torch.randint(0, self.n_diffusion_steps, (batch_size * n_noise_levels,), device=device).long(), None
+
+        if self.timestep_sampling == 'stratified':
+            # band k of [0, 1) for the k-th noise level, and a random stratum of the band for every sample
+            n = batch_size * n_noise_levels
+            strata = torch.argsort(torch.rand(n_noise_levels, batch_size, device=device), dim=1)
+            strata = strata + torch.arange(n_noise_levels, device=device).unsqueeze(1) * batch_size
+            u = ((strata + torch.rand(n_noise_levels, batch_size, device=device)) / n).T.reshape(-1)
+        else:
+            u = torch.rand(batch_size * n_noise_levels, device=device)
+
+        # inverse cdf of the timestep distribution
+        probs = self.timestep_probs().to(device)
+        cdf = torch.cumsum(probs, dim=0)
+        t = torch.searchsorted(cdf, u.contiguous(), right=True).clamp(max=self.n_diffusion_steps - 1).long()
+
+        weights = None
+        if self.importance_weighting:
+            weights = 1. / (self.n_diffusion_steps * probs[t])
+        return t, weights
+
+    @torch.no_grad()
+    def update_loss_history(self, t, loss_per_sample):
+        loss_sq = torch.zeros_like(self.loss_sq_history).index_add_(0, t, loss_per_sample.float() ** 2)
+        counts = torch.zeros_like(self.loss_history_counts).index_add_(0, t, torch.ones_like(t))
+        if dist.is_available() and dist.is_initialized():
+            # distributed training: the losses of all the processes, same history and timestep distribution everywhere
+            sums = torch.stack((loss_sq, counts.float()))
+            dist.all_reduce(sums)
+            loss_sq, counts = sums[0], sums[1].round().long()
+        seen = counts > 0
+        mean_loss_sq = loss_sq[seen] / counts[seen]
+        warmup = self.loss_history_counts[seen] < self.importance_warmup
+        # plain average during the warmup, then exponential moving average
+        history = self.loss_sq_history[seen]
+        n = self.loss_history_counts[seen].float()
+        history = torch.where(
+            warmup,
+            (history * n + loss_sq[seen]) / (n + counts[seen]),
+            self.importance_history_decay * history + (1 - self.importance_history_decay) * mean_loss_sq
+        )
+        self.loss_sq_history[seen] = history
+        self.loss_history_counts += counts
+
+    def loss_history_state_dict(self):
+        return {'loss_sq_history': self.loss_sq_history.clone(), 'loss_history_counts': self.loss_history_counts.clone()}
+
+    def load_loss_history_state_dict(self, state_dict):
+        self.loss_sq_history.copy_(state_dict['loss_sq_history'])
+        self.loss_history_counts.copy_(state_dict['loss_history_counts'])
+
     def loss(self, x, context, *args):
         batch_size = x.shape[0]
-        t = torch.randint(0, self.n_diffusion_steps, (batch_size,), device=x.device).long()
-        return self.p_losses(x, context, t, *args)
+        t, loss_weights = self.sample_timesteps(batch_size, self.n_noise_levels, device=x.device)
+        loss, info = self.p_losses(x, context, t, *args, loss_weights=loss_weights)
+        if self.importance_weighting and torch.is_grad_enabled():
+            # training batches only, the validation losses run without gradients
+            self.update_loss_history(t, info.pop('loss_per_sample'))
+        return loss, info
 
@@ -6,13 +6,17 @@ import numpy as np
 import torch
 from torch import nn
 import casadi as ca
-import control
 
 from mp_baselines.planners.costs.cost_functions import CostGPTrajectory
 from mp_baselines.planners.costs.factors.mp_priors_multi import MultiMPPrior
 from torch_robotics.torch_planning_objectives.fields.distance_fields import interpolate_points_v1
 from torch_robotics.torch_utils.torch_utils import to_torch
 
+from mpd.envs import DiscreteLinearDynamics, LINEAR_A, LINEAR_B, LINEAR_TS
+
+
+CART_POLE_DYNAMICS = DiscreteLinearDynamics(LINEAR_A, LINEAR_B, LINEAR_TS)
+
 
 class GuideManagerTrajectories(nn.Module):
 
@@ -369,57 +373,10 @@ class GuideManagerCartPole(nn.Module):
         return grad
     
     def cart_pole_dynamics(self, x, u):
-        A = np.array([
-        [0, 1, 0, 0],
-        [0, -0.1, 3, 0],
-        [0, 0, 0, 1],
-        [0, -0.5, 30, 0]
-        ])
-
-        B = np.array([
-        [0],
-        [2],
-        [0],
-        [5]
-        ])
-
-        C = np.eye(4)
-
-        D = np.zeros((4,1))
-
-        # state space equation
-        sys_continuous = control.ss(A, B, C, D)
-
-        # sampling time
-        Ts = 0.1
-
-        # convert to discrete time dynamics
-        sys_discrete = control.c2d(sys_continuous, Ts, method='zoh')
-
-        A_d = sys_discrete.A
-        # print(f'A_d -- {A_d}')
-        B_d = sys_discrete.B
-        # print(f'B_d -- {B_d}')
-        C_d = sys_discrete.C
-        D_d = sys_discrete.D
-
-        # States
-        x_pos = x[0,0]
-        x_dot = x[0,1]
-        theta = x[0,2]
-        theta_dot = x[0,3]
-        # print(f'x_shape -- {x.shape}')
-        # print(f'u_shape -- {u.shape}')
-
-        x_next = np.concatenate((
-            A_d[0,0]*x_pos + A_d[0,1]*x_dot + A_d[0,2]*theta + A_d[0,3]*theta_dot + B_d[0,0]*u,
-            A_d[1,0]*x_pos + A_d[1,1]*x_dot + A_d[1,2]*theta + A_d[1,3]*theta_dot + B_d[1,0]*u,
-            A_d[2,0]*x_pos + A_d[2,1]*x_dot + A_d[2,2]*theta + A_d[2,3]*theta_dot + B_d[2,0]*u,
-            A_d[3,0]*x_pos + A_d[3,1]*x_dot + A_d[3,2]*theta + A_d[3,3]*theta_dot + B_d[3,0]*u), axis=0
-        )
-
-        x_next = np.transpose(x_next)
-        return x_next
+        # discretized dynamics are cached in mpd.envs, no control.ss + control.c2d per call
+        if torch.is_tensor(x):
+            return CART_POLE_DYNAMICS.step_torch(x, u)
+        return CART_POLE_DYNAMICS.step_numpy(x, u)
 
 
 class GuideBase(nn.Module, abc.ABC):
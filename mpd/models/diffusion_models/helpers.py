@@ -1,3 +1,5 @@
+from collections import deque
+
 import numpy as np
 import torch
 from torch import nn
@@ -63,6 +65,38 @@ def variance_preserving_beta_schedule(n_diffusion_steps, beta_start=1e-4, beta_e
 
 
 
+class ChainRecorder:
+    """
+    Memory-bounded recording of the denoising chain of a sampler:
+    stride: keeps every stride-th step (the initial noise and the final sample are always kept)
+    last: keeps only the last recorded steps (ring buffer), None keeps all of them
+    clone: copies the recorded steps (samplers updating x in place)
+    """
+
+    def __init__(self, x, stride=1, last=None, clone=False):
+        self.stride = max(int(stride), 1)
+        self.clone = clone
+        self.steps = deque(maxlen=last)
+        self.n_steps = 0
+        self.last_recorded = True
+        self.record(x)
+
+    def record(self, x):
+        self.steps.append(x.clone() if self.clone else x)
+
+    def append(self, x):
+        self.n_steps += 1
+        self.last_recorded = self.n_steps % self.stride == 0
+        if self.last_recorded:
+            self.record(x)
+
+    def stack(self, x_final):
+        # chain [ batch x recorded steps x ... ], ending with the final sample
+        if not self.last_recorded:
+            self.record(x_final)
+            self.last_recorded = True
+        return torch.stack(list(self.steps), dim=1)
+
 
 #-----------------------------------------------------------------------------#
 #---------------------------------- losses -----------------------------------#
@@ -86,6 +120,13 @@ class WeightedLoss(nn.Module):
             weighted_loss = loss.mean()
         return weighted_loss, {}
 
+    def per_sample(self, pred, targ):
+        # [ batch_size ], mean over the other dimensions (the mean over the batch is forward)
+        loss = self._loss(pred, targ)
+        if self.weights is not None:
+            loss = loss * self.weights
+        return loss.flatten(1).mean(dim=1)
+
 
 class WeightedL1(WeightedLoss):
 
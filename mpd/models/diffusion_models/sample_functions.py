@@ -22,6 +22,7 @@ def ddpm_cart_pole_sample_fn(
         scale_grad_by_std=False,
         t_start_guide=torch.inf,
         noise_std_extra_schedule_fn=None,  # 'linear'
+        fused_cfg=True,
         debug=False,
         **kwargs
 ):
@@ -29,8 +30,10 @@ def ddpm_cart_pole_sample_fn(
     if t_single < 0:
         t = torch.zeros_like(t)
 
+    # fused_cfg=False evaluates the conditional and unconditional branches with two model calls (A/B comparisons)
     model_mean, _, model_log_variance = model.p_mean_variance_CFG(x=x, hard_conds=hard_conds, context=context, t=t, 
-                                                                  context_nonmask = context_nonmask, context_mask = context_mask)
+                                                                  context_nonmask = context_nonmask, context_mask = context_mask,
+                                                                  fused_cfg=fused_cfg)
 
     model_log_variance = extract(model.posterior_log_variance_clipped, t, x.shape)
     # model_std = torch.exp(0.5 * model_log_variance)
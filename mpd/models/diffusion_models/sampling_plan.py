@@ -0,0 +1,123 @@
+import torch
+
+from mpd.models.diffusion_models.helpers import ChainRecorder
+
+
+def time_encoder_version(denoiser):
+    # changes when the time encoder weights are updated in place (optimizer step, load_state_dict)
+    return tuple(p._version for p in denoiser.time_mlp.parameters())
+
+
+class CartPoleSamplingPlan:
+    """
+    Precomputed plan of the fused classifier-free guided DDPM sampler (cart_pole_sample_loop), built once per
+    (n_steps, n_diffusion_steps_without_noise, batch size, horizon, device):
+    - scalar coefficients of every step (python floats) instead of the extract() gathers
+    - time embeddings of every step, instead of encoding the same timestep for every batch element at every step
+    - preallocated model inputs (stacked conditional / unconditional batch), cfg masks and noise buffers
+    so the denoising loop only runs the denoiser and in-place arithmetic.
+    """
+
+    def __init__(self, diffusion_model, n_steps, n_diffusion_steps_without_noise, batch_size, horizon, device):
+        denoiser = diffusion_model.model
+        self.batch_size = batch_size
+        self.version = time_encoder_version(denoiser)
+        shape = (batch_size, horizon, diffusion_model.state_dim)
+
+        # timesteps of the loop, the steps without noise (i < 0) repeat t=0
+        timesteps = [max(i, 0) for i in reversed(range(-n_diffusion_steps_without_noise, n_steps))]
+
+        def table(buffer):
+            return buffer.detach().double().cpu().tolist()
+
+        sqrt_recip_alphas_cumprod = table(diffusion_model.sqrt_recip_alphas_cumprod)
+        sqrt_recipm1_alphas_cumprod = table(diffusion_model.sqrt_recipm1_alphas_cumprod)
+        posterior_mean_coef1 = table(diffusion_model.posterior_mean_coef1)
+        posterior_mean_coef2 = table(diffusion_model.posterior_mean_coef2)
+        posterior_std = table((0.5 * diffusion_model.posterior_log_variance_clipped).exp())
+        # (x_t coef, noise coef) of x_start, (x_start coef, x_t coef) of the posterior mean, std (no noise at t=0)
+        self.coefs = [
+            (sqrt_recip_alphas_cumprod[t], sqrt_recipm1_alphas_cumprod[t],
+             posterior_mean_coef1[t], posterior_mean_coef2[t], posterior_std[t] if t > 0 else 0.)
+            for t in timesteps
+        ]
+
+        # the fused cfg batch stacks the conditional and unconditional branches
+        self.t_in = [torch.full((2 * batch_size,), t, device=device, dtype=torch.long) for t in timesteps]
+        unique_timesteps = sorted(set(timesteps))
+        with torch.no_grad():
+            embeddings = denoiser.time_mlp(torch.tensor(unique_timesteps, device=device))
+        embeddings = {t: emb for t, emb in zip(unique_timesteps, embeddings)}
+        self.t_emb = [embeddings[t].expand(2 * batch_size, -1).contiguous() for t in timesteps]
+
+        self.context_mask_in = torch.cat((torch.zeros(batch_size, 1, device=device),
+                                          torch.ones(batch_size, 1, device=device)), dim=0)
+        self.context_in = None
+        self.guidance_weight_in = torch.empty(batch_size, device=device)
+        self.x_in = torch.empty((2 * batch_size, *shape[1:]), device=device)
+        self.x = torch.empty(shape, device=device)
+        self.model_out = torch.empty(shape, device=device)
+        self.x_recon = torch.empty(shape, device=device)
+        self.noise = torch.empty(shape, device=device)
+
+    def is_valid(self, diffusion_model):
+        return self.version == time_encoder_version(diffusion_model.model)
+
+    def set_context(self, context):
+        if self.context_in is None or self.context_in.shape[1:] != context.shape[1:]:
+            self.context_in = torch.empty((2 * self.batch_size, *context.shape[1:]), device=context.device)
+        self.context_in[:self.batch_size].copy_(context)
+        self.context_in[self.batch_size:].copy_(context)
+
+    @torch.no_grad()
+    def run(self, diffusion_model, x, context, return_chain=False, chain_stride=1, chain_last=None):
+        """
+        Denoises x [ batch x horizon x state_dim ] along the plan.
+        Returns the sample (and the recorded chain [ batch x steps x horizon x state_dim ] if return_chain)
+        """
+        b = self.batch_size
+        w = diffusion_model.w
+        # guidance distilled models (w as input) and w = 0 only need the conditional branch
+        single_branch = diffusion_model.guidance_distilled or w == 0
+        guidance_kwargs = {}
+        if diffusion_model.guidance_distilled:
+            guidance_kwargs = dict(guidance_weight=self.guidance_weight_in.fill_(w))
+        if not single_branch:
+            self.set_context(context)
+        x = self.x.copy_(x)
+        chain = ChainRecorder(x, chain_stride, chain_last, clone=True) if return_chain else None
+
+        for t_in, t_emb, (c_recip, c_recipm1, c_mean_start, c_mean_t, std) in zip(self.t_in, self.t_emb, self.coefs):
+            if single_branch:
+                out = diffusion_model.model(x, t_in[:b], context, self.context_mask_in[:b], t_emb=t_emb[:b],
+                                            **guidance_kwargs)
+                self.model_out.copy_(out)
+            else:
+                self.x_in[:b].copy_(x)
+                self.x_in[b:].copy_(x)
+                out = diffusion_model.model(self.x_in, t_in, self.context_in, self.context_mask_in, t_emb=t_emb)
+
+                # guided model output: (1 + w) * out_context - w * out_noncontext
+                torch.sub(out[:b], out[b:], out=self.model_out)
+                self.model_out.mul_(w).add_(out[:b])
+
+            if diffusion_model.predict_epsilon:
+                torch.mul(x, c_recip, out=self.x_recon).add_(self.model_out, alpha=-c_recipm1)
+            else:
+                self.x_recon.copy_(self.model_out)
+            if diffusion_model.clip_denoised:
+                self.x_recon.clamp_(-1., 1.)
+
+            # posterior mean + std * noise
+            x.mul_(c_mean_t).add_(self.x_recon, alpha=c_mean_start)
+            if std > 0:
+                x.add_(self.noise.normal_(), alpha=std)
+
+            if return_chain:
+                chain.append(x)
+
+        # the buffers are reused by the next call
+        x = x.clone()
+        if return_chain:
+            return x, chain.stack(x)
+        return x
@@ -20,6 +20,9 @@ UNET_DIM_MULTS = {
 CONDITION_DATA = torch.load('/root/cartpoleDiff/cart_pole_diffusion_based_on_MPD/training_data/Panda-Data/panda_test4/x_data_cat_test4.pt')
 X_SIZE = CONDITION_DATA.size(dim=1)
 
+# guidance weights are scaled before the sinusoidal embedding (w ~ 0.01 - 1)
+GUIDANCE_EMB_SCALE = 1000.
+
 class TemporalUnet(nn.Module):
 
     def __init__(
@@ -195,8 +198,13 @@ class ConditionedTemporalUnet(nn.Module):
             conditioning_type='default',
             attention_num_heads=2,
             attention_dim_head=32,
+            guidance_emb_dim=0,
             **kwargs
     ):
+        """
+        guidance_emb_dim: > 0 for guidance distilled models, the cfg guidance weight w is an extra conditioning input
+            (its embedding is appended to the time and context embedding), so one forward pass gives the guided output
+        """
         super().__init__()
 
         self.state_dim = state_dim
@@ -229,8 +237,12 @@ class ConditionedTemporalUnet(nn.Module):
         # Networks
         self.time_mlp = TimeEncoder(32, time_emb_dim)
 
-        # conditioning dimension (time + context)
+        # conditioning dimension (time + context (+ guidance weight))
         cond_dim = time_emb_dim + (conditioning_embed_dim if conditioning_type == 'default' else 0)
+        self.guidance_emb_dim = guidance_emb_dim
+        if guidance_emb_dim > 0:
+            self.guidance_mlp = TimeEncoder(32, guidance_emb_dim)
+            cond_dim += guidance_emb_dim
 
         # Unet
         self.downs = nn.ModuleList([])
@@ -279,10 +291,12 @@ class ConditionedTemporalUnet(nn.Module):
             nn.Conv1d(unet_input_dim, state_dim, 1),
         )
 
-    def forward(self, x, time, context, context_mask):
+    def forward(self, x, time, context, context_mask, t_emb=None, guidance_weight=None):
         """
         x : [ batch x horizon x state_dim ]
         context: [batch x context_dim]
+        t_emb: precomputed time embedding [ batch x time_emb_dim ] (sampling plan), time is then not encoded again
+        guidance_weight: [ batch ] cfg weights of a guidance distilled model (guidance_emb_dim > 0)
         """
         # print(f"x -- {x.shape}")
         b, h, d = x.shape
@@ -295,7 +309,8 @@ class ConditionedTemporalUnet(nn.Module):
         context = torch.mul(context, context_mask)
         # print(f"masked-context -- {context}")
 
-        t_emb = self.time_mlp(time)
+        if t_emb is None:
+            t_emb = self.time_mlp(time)
         c_emb = t_emb
         if self.conditioning_type == 'concatenate':
             x_emb = self.state_encoder(x)
@@ -307,6 +322,9 @@ class ConditionedTemporalUnet(nn.Module):
         elif self.conditioning_type == 'default':
             c_emb = torch.cat((t_emb, context), dim=-1)
             c_emb = c_emb.float()
+        if self.guidance_emb_dim > 0:
+            w_emb = self.guidance_mlp(guidance_weight.reshape(-1).expand(b) * GUIDANCE_EMB_SCALE)
+            c_emb = torch.cat((c_emb, w_emb), dim=-1)
 
         # swap horizon and channels (state_dim)
         x = einops.rearrange(x, 'b h c -> b c h')  # batch, horizon, channels (state_dim) --> batch, channels, horizon (64,1,8)
@@ -1,2 +1,4 @@
 from .train_loaders import *
+from .checkpointing import CheckpointManager
 from .trainer import train
+from .distillation import progressive_distillation, guidance_distillation
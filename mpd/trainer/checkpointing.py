@@ -0,0 +1,262 @@
+import copy
+import fnmatch
+import os
+import queue
+import random
+import re
+import shutil
+import threading
+
+import numpy as np
+import torch
+
+
+STEP_CHECKPOINT_PATTERN = re.compile(r'.*_epoch_\d+_iter_(\d+)_state_dict\.pth$')
+
+# full training state (optimizers, scaler, ema, rng, counters) of the latest checkpoint, for resuming a training
+TRAINING_STATE_FILE_NAME = 'training_state.pth'
+
+
+def state_dict_to_cpu(state_dict):
+    # snapshot, the training can keep updating the parameters while the copy is written
+    return {key: val.detach().to('cpu', copy=True) if torch.is_tensor(val) else val for key, val in state_dict.items()}
+
+
+def to_cpu_copy(obj):
+    # nested snapshot (e.g. optimizer state dicts)
+    if torch.is_tensor(obj):
+        return obj.detach().to('cpu', copy=True)
+    elif isinstance(obj, dict):
+        return {key: to_cpu_copy(val) for key, val in obj.items()}
+    elif isinstance(obj, (list, tuple)):
+        return type(obj)(to_cpu_copy(val) for val in obj)
+    return copy.deepcopy(obj)
+
+
+def get_rng_states():
+    rng_states = {
+        'python': random.getstate(),
+        'numpy': np.random.get_state(),
+        'torch': torch.get_rng_state(),
+    }
+    if torch.cuda.is_available():
+        rng_states['cuda'] = torch.cuda.get_rng_state_all()
+    return rng_states
+
+
+def set_rng_states(rng_states):
+    # the training state can be loaded with map_location on the gpu, the generator states must be cpu tensors
+    random.setstate(rng_states['python'])
+    np.random.set_state(rng_states['numpy'])
+    torch.set_rng_state(rng_states['torch'].cpu())
+    if 'cuda' in rng_states and torch.cuda.is_available():
+        torch.cuda.set_rng_state_all([state.cpu() for state in rng_states['cuda']])
+
+
+def get_process_state(states, rank):
+    # states: per-process states of a training state (e.g. rng states), a list with one entry per rank
+    if rank >= len(states):
+        raise ValueError(f'the training state was saved by {len(states)} processes, process {rank} cannot resume it')
+    return states[rank]
+
+
+def load_training_state(resume_from, map_location=None):
+    """
+    resume_from: training state file, or a model dir (its checkpoints/training_state.pth)
+    """
+    if os.path.isdir(resume_from):
+        resume_from = os.path.join(resume_from, 'checkpoints', TRAINING_STATE_FILE_NAME)
+    return torch.load(resume_from, map_location=map_location, weights_only=False)
+
+
+def link_or_copy(src, dst):
+    # hard links share the data of unchanged files, fall back to a copy across file systems
+    try:
+        os.link(src, dst)
+    except OSError:
+        shutil.copy2(src, dst)
+    return dst
+
+
+def replace_with_link(src, dst):
+    # atomically points dst to the data of src, readers never see a partially written file
+    tmp = f'{dst}.tmp'
+    if os.path.lexists(tmp):
+        os.remove(tmp)
+    link_or_copy(src, tmp)
+    os.replace(tmp, dst)
+
+
+def save_atomic(save_fn, path):
+    # new file + rename, files are never rewritten in place since they can be hard linked in snapshots
+    tmp = f'{path}.tmp'
+    with open(tmp, 'wb') as f:
+        save_fn(f)
+    os.replace(tmp, path)
+
+
+class CheckpointManager:
+    """
+    Writes the training checkpoints on a background thread.
+
+    Per checkpoint, each model is snapshotted to cpu memory and written once as
+    checkpoints/<prefix>epoch_<epoch>_iter_<step>_state_dict.pth.
+    checkpoints/<prefix>current_state_dict.pth is a hard link to the latest one.
+    Snapshot directories (saved_main_folder/<step>, as loaded by the inference scripts) hard link the files of
+    model_dir instead of copying the tree.
+
+    Retention: a step checkpoint (file and snapshot directory) is kept if it is one of the last keep_last_n
+    checkpoints or if its step is a multiple of keep_every_k. None keeps everything.
+    """
+
+    def __init__(self, model_dir, saved_main_folder=None, keep_last_n=None, keep_every_k=None, async_write=True):
+        self.model_dir = model_dir
+        self.checkpoints_dir = os.path.join(model_dir, 'checkpoints')
+        os.makedirs(self.checkpoints_dir, exist_ok=True)
+        self.saved_main_folder = saved_main_folder
+        self.keep_last_n = keep_last_n
+        self.keep_every_k = keep_every_k
+        self.async_write = async_write
+
+        self.saved_steps = []
+        self.error = None
+        self.jobs = queue.Queue()
+        self.thread = None
+        if async_write:
+            self.thread = threading.Thread(target=self._worker, daemon=True)
+            self.thread.start()
+
+    def save(self, models_prefix_l, epoch, total_steps, losses=None, snapshot_name=None):
+        """
+        models_prefix_l: [ (model, prefix) ], as in save_models_to_disk
+        losses: (train_losses, val_losses), saved as train_losses.npy / val_losses.npy
+        snapshot_name: name of the snapshot directory in saved_main_folder, None for no snapshot
+        """
+        self._raise_error()
+
+        state_dicts = []
+        for model, prefix in models_prefix_l:
+            if model is None:
+                continue
+            state_dicts.extend(self._get_state_dicts(model, f'{prefix}_'))
+            for submodule_key, submodule_value in model.submodules.items():
+                state_dicts.extend(self._get_state_dicts(submodule_value, f'{prefix}_{submodule_key}_'))
+
+        if losses is not None:
+            losses = tuple(list(l) for l in losses)
+
+        self._submit(self._write, state_dicts, epoch, total_steps, losses, snapshot_name)
+
+    def save_training_state(self, training_state):
+        """
+        training_state: dict with everything needed to resume (see mpd.trainer.train), snapshotted to cpu memory here
+        and written to checkpoints/training_state.pth, replacing the previous one
+        """
+        self._raise_error()
+        training_state = to_cpu_copy(training_state)
+        self._submit(self._write_training_state, training_state)
+
+    def _submit(self, fn, *args):
+        if self.async_write:
+            self.jobs.put((fn, args))
+        else:
+            fn(*args)
+
+    def wait(self):
+        # blocks until all queued checkpoints are on disk
+        if self.async_write:
+            self.jobs.join()
+        self._raise_error()
+
+    def close(self):
+        if self.thread is not None:
+            self.jobs.put(None)
+            self.thread.join()
+            self.thread = None
+        self._raise_error()
+
+    @staticmethod
+    def _get_state_dicts(model, prefix):
+        # If the model is frozen we do not save it again, since the parameters did not change
+        if hasattr(model, 'is_frozen') and model.is_frozen:
+            return []
+        return [(prefix, state_dict_to_cpu(model.state_dict()))]
+
+    def _raise_error(self):
+        if self.error is not None:
+            error, self.error = self.error, None
+            raise error
+
+    def _worker(self):
+        while True:
+            job = self.jobs.get()
+            try:
+                if job is None:
+                    return
+                fn, args = job
+                fn(*args)
+            except Exception as e:
+                self.error = e
+            finally:
+                self.jobs.task_done()
+
+    def _write_training_state(self, training_state):
+        save_atomic(lambda f: torch.save(training_state, f), os.path.join(self.checkpoints_dir, TRAINING_STATE_FILE_NAME))
+
+    def _write(self, state_dicts, epoch, total_steps, losses, snapshot_name):
+        for prefix, state_dict in state_dicts:
+            step_path = os.path.join(self.checkpoints_dir, f'{prefix}epoch_{epoch:04d}_iter_{total_steps:06d}_state_dict.pth')
+            save_atomic(lambda f: torch.save(state_dict, f), step_path)
+            replace_with_link(step_path, os.path.join(self.checkpoints_dir, f'{prefix}current_state_dict.pth'))
+
+        if losses is not None:
+            train_losses, val_losses = losses
+            save_atomic(lambda f: np.save(f, np.array(train_losses, dtype=object)),
+                        os.path.join(self.checkpoints_dir, 'train_losses.npy'))
+            save_atomic(lambda f: np.save(f, np.array(val_losses, dtype=object)),
+                        os.path.join(self.checkpoints_dir, 'val_losses.npy'))
+
+        if snapshot_name is not None and self.saved_main_folder is not None:
+            self._snapshot(snapshot_name)
+
+        if total_steps not in self.saved_steps:
+            self.saved_steps.append(total_steps)
+        self._apply_retention(protected_snapshot=snapshot_name)
+
+    def _snapshot(self, snapshot_name):
+        os.makedirs(self.saved_main_folder, exist_ok=True)
+        snapshot_dir = os.path.join(self.saved_main_folder, str(snapshot_name))
+        if os.path.exists(snapshot_dir):
+            shutil.rmtree(snapshot_dir)
+
+        def ignore(src, names):
+            # step checkpoints are represented by the current_state_dict links, temporary files are skipped
+            return [name for name in names
+                    if STEP_CHECKPOINT_PATTERN.match(name) or fnmatch.fnmatch(name, '*.tmp')]
+
+        shutil.copytree(self.model_dir, snapshot_dir, copy_function=link_or_copy, ignore=ignore)
+        print(f'model dir path -- {snapshot_dir}')
+
+    def _is_kept(self, step):
+        if self.keep_last_n is None and self.keep_every_k is None:
+            return True
+        if self.keep_last_n is not None and step in self.saved_steps[-self.keep_last_n:]:
+            return True
+        if self.keep_every_k is not None and step % self.keep_every_k == 0:
+            return True
+        return False
+
+    def _apply_retention(self, protected_snapshot=None):
+        removed_steps = [step for step in self.saved_steps if not self._is_kept(step)]
+        if not removed_steps:
+            return
+        for file_name in os.listdir(self.checkpoints_dir):
+            match = STEP_CHECKPOINT_PATTERN.match(file_name)
+            if match is not None and int(match.group(1)) in removed_steps:
+                os.remove(os.path.join(self.checkpoints_dir, file_name))
+        if self.saved_main_folder is not None:
+            for step in removed_steps:
+                snapshot_dir = os.path.join(self.saved_main_folder, str(step))
+                if str(step) != str(protected_snapshot) and os.path.isdir(snapshot_dir):
+                    shutil.rmtree(snapshot_dir)
+        self.saved_steps = [step for step in self.saved_steps if step not in removed_steps]
@@ -0,0 +1,220 @@
+import copy
+import os
+import shutil
+
+import torch
+
+from mpd import datasets, models
+from mpd.models.diffusion_models.diffusion_model_base import make_respaced_timesteps
+from mpd.trainer.train_loaders import get_loss, get_model, load_diffusion_model
+from mpd.trainer.trainer import train, get_num_epochs
+from mpd.utils.loading import load_params_from_yaml, save_params_to_yaml
+from torch_robotics.torch_utils.torch_utils import freeze_torch_model_params
+
+
+def get_distillation_timesteps(n_diffusion_steps, n_teacher_steps, timestep_respacing='uniform'):
+    # DDIM timesteps of the first teacher, every round keeps every other one
+    times = make_respaced_timesteps(n_diffusion_steps, n_teacher_steps, timestep_respacing)
+    if len(times) != n_teacher_steps:
+        raise ValueError(f'{n_teacher_steps} distinct sampling steps are not possible with {n_diffusion_steps} '
+                         f'diffusion steps ({timestep_respacing} respacing)')
+    return times
+
+
+def copy_normalizer(teacher_dir, model_dir, dataset):
+    normalizer_path = os.path.join(teacher_dir, datasets.NORMALIZER_FILE_NAME)
+    if os.path.exists(normalizer_path):
+        shutil.copy(normalizer_path, os.path.join(model_dir, datasets.NORMALIZER_FILE_NAME))
+    else:
+        dataset.save_normalizer(os.path.join(model_dir, datasets.NORMALIZER_FILE_NAME))
+
+
+@torch.no_grad()
+def load_expanded_state_dict(model, state_dict):
+    """
+    Loads the weights of a model with smaller conditioning inputs (e.g. a cfg checkpoint into a guidance distilled
+    model): matching tensors are copied, linear weights with more input features get the old weights in the first
+    columns and zeros in the new ones, so the new model initially gives the same outputs. Other tensors keep their
+    initialization.
+    """
+    new_state_dict = model.state_dict()
+    for key, value in new_state_dict.items():
+        if key not in state_dict:
+            continue
+        old_value = state_dict[key].to(value.device)
+        if old_value.shape == value.shape:
+            value.copy_(old_value)
+        elif value.ndim == 2 and old_value.ndim == 2 and old_value.shape[0] == value.shape[0] \
+                and old_value.shape[1] < value.shape[1]:
+            value.zero_()
+            value[:, :old_value.shape[1]].copy_(old_value)
+    model.load_state_dict(new_state_dict)
+
+
+def progressive_distillation(teacher_model_dir=None,
+                             results_dir=None,
+                             train_subset=None, train_dataloader=None,
+                             val_subset=None, val_dataloader=None,
+                             context_weight=0.01,
+                             n_teacher_steps=16,
+                             n_student_steps=2,
+                             timestep_respacing='uniform',
+                             num_train_steps_per_round=5000,
+                             batch_size=None,
+                             use_ema=True,
+                             tensor_args=None,
+                             **train_kwargs):
+    """
+    Progressive distillation of a trained cart pole diffusion model (EMA checkpoint of teacher_model_dir) into a
+    few-step student: the first round distills n_teacher_steps guided DDIM steps of the teacher (guidance weight
+    context_weight) into n_teacher_steps / 2 student steps, every next round halves the steps again with the previous
+    student as teacher, until n_student_steps.
+    Every round is a model dir results_dir/round_<k> (args.yaml with the student timesteps, normalizer of the teacher,
+    checkpoints), loaded by DiffusionPolicy like a trained model. The data must be normalized like the teacher data
+    (same dataset).
+    Returns the model dirs of the rounds.
+    """
+    teacher_args = load_params_from_yaml(os.path.join(teacher_model_dir, 'args.yaml'))
+    dataset = train_subset.dataset
+    times = get_distillation_timesteps(teacher_args['n_diffusion_steps'], n_teacher_steps, timestep_respacing)
+    steps_ratio = n_teacher_steps // n_student_steps
+    if n_teacher_steps % n_student_steps != 0 or steps_ratio & (steps_ratio - 1) != 0:
+        raise ValueError(f'n_teacher_steps / n_student_steps must be a power of 2 '
+                         f'({n_teacher_steps} / {n_student_steps})')
+
+    teacher_dir = teacher_model_dir
+    teacher = load_diffusion_model(model_dir=teacher_dir, args=teacher_args, state_dim=dataset.state_dim,
+                                   n_support_points=dataset.n_support_points, tensor_args=tensor_args)
+    round_dirs = []
+    n_round = 0
+    while len(times) > n_student_steps:
+        n_round += 1
+        round_dir = os.path.join(results_dir, f'round_{n_round}')
+        os.makedirs(round_dir, exist_ok=True)
+        print(f'\n------- DISTILLATION ROUND {n_round}: {len(times)} -> {len(times) // 2} steps -------\n')
+
+        # the student starts from the weights of its teacher
+        freeze_torch_model_params(teacher)
+        student = copy.deepcopy(teacher)
+        for param in student.parameters():
+            param.requires_grad_(True)
+        student.train()
+
+        loss_fn = get_loss(
+            loss_class='ProgressiveDistillationLoss',
+            teacher=teacher,
+            teacher_timesteps=times,
+            context_weight=context_weight if n_round == 1 else 0.,  # the students have the guidance distilled
+        )
+
+        # inference configuration of the student, same model as the teacher
+        student_args = dict(teacher_args,
+                            use_ema=use_ema,
+                            distilled_timesteps=times[::2],
+                            distilled_context_weight=context_weight,
+                            distillation_round=n_round,
+                            distillation_teacher_dir=teacher_model_dir)
+        save_params_to_yaml(student_args, os.path.join(round_dir, 'args.yaml'))
+        copy_normalizer(teacher_dir, round_dir, dataset)
+
+        train(
+            model=student,
+            train_dataloader=train_dataloader,
+            train_subset=train_subset,
+            val_dataloader=val_dataloader,
+            val_subset=val_subset,
+            epochs=get_num_epochs(num_train_steps_per_round, batch_size, len(train_subset)),
+            max_steps=num_train_steps_per_round,
+            model_dir=round_dir,
+            loss_fn=loss_fn,
+            val_loss_fn=loss_fn,
+            use_ema=use_ema,
+            tensor_args=tensor_args,
+            **train_kwargs
+        )
+        round_dirs.append(round_dir)
+
+        # the (ema) student is the teacher of the next round
+        teacher_dir, teacher_args, times = round_dir, student_args, times[::2]
+        teacher = load_diffusion_model(model_dir=teacher_dir, args=teacher_args, state_dim=dataset.state_dim,
+                                       n_support_points=dataset.n_support_points, tensor_args=tensor_args)
+
+    return round_dirs
+
+
+def guidance_distillation(teacher_model_dir=None,
+                          results_dir=None,
+                          train_subset=None, train_dataloader=None,
+                          val_subset=None, val_dataloader=None,
+                          guidance_weight_range=(0., 1.),
+                          guidance_emb_dim=32,
+                          num_train_steps=20000,
+                          batch_size=None,
+                          use_ema=True,
+                          tensor_args=None,
+                          **train_kwargs):
+    """
+    Fine-tunes a guidance distilled model (the cfg weight is an input of the denoiser) from the cfg checkpoint of
+    teacher_model_dir, for the guidance weights in guidance_weight_range.
+    The student is the model dir results_dir/guidance_distilled, loaded by DiffusionPolicy like a trained model
+    (context_weight is then an input of the model, one forward pass per step).
+    Returns the model dir of the student.
+    """
+    teacher_args = load_params_from_yaml(os.path.join(teacher_model_dir, 'args.yaml'))
+    dataset = train_subset.dataset
+    model_dir = os.path.join(results_dir, 'guidance_distilled')
+    os.makedirs(model_dir, exist_ok=True)
+
+    teacher = load_diffusion_model(model_dir=teacher_model_dir, args=teacher_args, state_dim=dataset.state_dim,
+                                   n_support_points=dataset.n_support_points, tensor_args=tensor_args)
+    freeze_torch_model_params(teacher)
+
+    # same model with the guidance weight embedding, initialized from the teacher
+    unet_configs = dict(
+        state_dim=dataset.state_dim,
+        n_support_points=dataset.n_support_points,
+        unet_input_dim=teacher_args['unet_input_dim'],
+        dim_mults=models.UNET_DIM_MULTS[teacher_args['unet_dim_mults_option']],
+        guidance_emb_dim=guidance_emb_dim,
+    )
+    student = get_model(
+        model_class=teacher_args['diffusion_model_class'],
+        model=models.ConditionedTemporalUnet(**unet_configs),
+        tensor_args=tensor_args,
+        variance_schedule=teacher_args['variance_schedule'],
+        n_diffusion_steps=teacher_args['n_diffusion_steps'],
+        predict_epsilon=teacher_args['predict_epsilon'],
+        **unet_configs
+    )
+    load_expanded_state_dict(student, teacher.state_dict())
+
+    loss_fn = get_loss(
+        loss_class='GuidanceDistillationLoss',
+        teacher=teacher,
+        guidance_weight_range=tuple(guidance_weight_range),
+    )
+
+    student_args = dict(teacher_args,
+                        use_ema=use_ema,
+                        guidance_emb_dim=guidance_emb_dim,
+                        guidance_weight_range=list(guidance_weight_range),
+                        distillation_teacher_dir=teacher_model_dir)
+    save_params_to_yaml(student_args, os.path.join(model_dir, 'args.yaml'))
+    copy_normalizer(teacher_model_dir, model_dir, dataset)
+
+    train(
+        model=student,
+        train_dataloader=train_dataloader,
+        train_subset=train_subset,
+        val_dataloader=val_dataloader,
+        val_subset=val_subset,
+        epochs=get_num_epochs(num_train_steps, batch_size, len(train_subset)),
+        max_steps=num_train_steps,
+        model_dir=model_dir,
+        loss_fn=loss_fn,
+        val_loss_fn=loss_fn,
+        use_ema=use_ema,
+        tensor_args=tensor_args,
+        **train_kwargs
+    )
+    return model_dir
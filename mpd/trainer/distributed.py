@@ -0,0 +1,117 @@
+import os
+
+import numpy as np
+import torch
+import torch.distributed as dist
+from torch._utils import _flatten_dense_tensors, _unflatten_dense_tensors
+
+
+# CPU data-parallel training: one process per core group, launched locally with
+#   torchrun --standalone --nproc_per_node=<N> scripts/train_diffusion/cart_pole_train.py --device cpu
+# Every process trains on its shard of the training indices, gradients are averaged with an all-reduce (gloo).
+# The diffusion losses call model.loss(...) instead of forward(), so the gradients are reduced explicitly after the
+# backward instead of wrapping the model in DistributedDataParallel.
+
+
+def is_distributed():
+    return dist.is_available() and dist.is_initialized()
+
+
+def get_rank():
+    return dist.get_rank() if is_distributed() else 0
+
+
+def get_world_size():
+    return dist.get_world_size() if is_distributed() else 1
+
+
+def is_main_process():
+    return get_rank() == 0
+
+
+def init_distributed(backend='gloo', num_threads=None):
+    """
+    Joins the process group described by the torchrun environment (RANK, WORLD_SIZE, MASTER_ADDR, MASTER_PORT).
+    Without it (plain python launch) nothing is done and the training stays single-process.
+    num_threads: intra-op threads per process, by default the cores are split between the processes
+    Returns (rank, world_size)
+    """
+    if is_distributed():
+        return get_rank(), get_world_size()
+    world_size = int(os.environ.get('WORLD_SIZE', 1))
+    if world_size <= 1:
+        return 0, 1
+
+    dist.init_process_group(backend=backend)
+    if num_threads is None:
+        num_threads = max(os.cpu_count() // world_size, 1)
+    torch.set_num_threads(num_threads)
+    print(f'process {get_rank()}/{world_size} -- backend {backend}, {num_threads} threads')
+    return get_rank(), world_size
+
+
+def cleanup_distributed():
+    if is_distributed():
+        dist.barrier()
+        dist.destroy_process_group()
+
+
+def shard_indices(indices, rank=None, world_size=None, block_size=1):
+    """
+    Strided shard of a list of indices: the blocks of block_size consecutive indices are dealt to the processes in
+    turn, so the order of the list is kept inside every shard (e.g. block_size=2 keeps the positive/negative pairs of
+    the interleaved index lists together).
+    All shards have the same length, the trailing blocks that cannot be dealt to every process are dropped, so the
+    processes run the same number of steps (an all-reduce per step).
+    """
+    rank = get_rank() if rank is None else rank
+    world_size = get_world_size() if world_size is None else world_size
+    if world_size == 1:
+        return indices
+
+    is_tensor = torch.is_tensor(indices)
+    indices = torch.as_tensor(np.asarray(indices) if not is_tensor else indices, dtype=torch.long)
+    n_blocks = len(indices) // block_size // world_size * world_size
+    blocks = indices[:n_blocks * block_size].reshape(n_blocks, block_size)
+    shard = blocks[rank::world_size].reshape(-1)
+    return shard if is_tensor else shard.tolist()
+
+
+def broadcast_parameters(model, src=0):
+    # same initial parameters and buffers on every process
+    if not is_distributed():
+        return
+    with torch.no_grad():
+        for tensor in list(model.parameters()) + list(model.buffers()):
+            dist.broadcast(tensor.data, src=src)
+
+
+def all_reduce_gradients(model):
+    # averages the gradients over the processes, as one flat buffer (one collective per step)
+    if not is_distributed():
+        return
+    grads = [p.grad for p in model.parameters() if p.grad is not None]
+    if not grads:
+        return
+    flat_grads = _flatten_dense_tensors(grads)
+    dist.all_reduce(flat_grads, op=dist.ReduceOp.SUM)
+    flat_grads /= get_world_size()
+    for grad, reduced_grad in zip(grads, _unflatten_dense_tensors(flat_grads, grads)):
+        grad.copy_(reduced_grad)
+
+
+def broadcast_object(obj, src=0):
+    if not is_distributed():
+        return obj
+    objects = [obj]
+    dist.broadcast_object_list(objects, src=src)
+    return objects[0]
+
+
+def all_gather_object(obj):
+    # [ obj of process 0, obj of process 1, ... ] on every process
+    if not is_distributed():
+        return [obj]
+    objects = [None] * get_world_size()
+    dist.all_gather_object(objects, obj)
+    return objects
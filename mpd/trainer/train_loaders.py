@@ -5,7 +5,9 @@ import torch
 from torch.utils.data import DataLoader, Subset, ConcatDataset, BatchSampler, random_split
 
 from mpd import models, losses, datasets, summaries
+from mpd.trainer.distributed import shard_indices, is_main_process
 from mpd.utils import model_loader, pretrain_helper
+from mpd.utils.loading import load_params_from_yaml
 from torch_robotics.torch_utils.torch_utils import freeze_torch_model_params
 
 
@@ -138,6 +140,19 @@ def get_loss(loss_class=None, **kwargs):
 #     def __len__(self):
 #         return (self.n1 - self.idx1) + (self.n2 - self.idx2) + (self.n3 - self.idx3) + (self.n4 - self.idx4) // (self.batch_size)
 
+def range_to_indices(index_range):
+    # range (or sequence) of dataset indices -> compact index tensor
+    if isinstance(index_range, range):
+        return torch.arange(index_range.start, index_range.stop, index_range.step, dtype=torch.long)
+    return torch.as_tensor(index_range, dtype=torch.long)
+
+
+def interleave_indices(indices_a, indices_b):
+    # a0, b0, a1, b1, ... (truncated to the shorter one, as zip)
+    n = min(len(indices_a), len(indices_b))
+    return torch.stack((indices_a[:n], indices_b[:n]), dim=1).reshape(-1)
+
+
 def get_specified_dataset(dataset_class=None,
                 dataset_subdir=None,
                 batch_size=2,
@@ -148,56 +163,54 @@ def get_specified_dataset(dataset_class=None,
                 normal_neg_range = None,
                 noisy_pos_range = None,
                 noisy_neg_range = None,
+                batch_loader=False,
+                prefetch=0,
                 **kwargs):
     DatasetClass = getattr(datasets, dataset_class)
     print('\n---------------Loading data')
     full_dataset = DatasetClass(dataset_subdir=dataset_subdir, **kwargs)
-    # data split
-    indices_normal_pos = list(normal_pos_range)
-    indices_normal_neg = list(normal_neg_range)
-    indices_noisy_pos = list(noisy_pos_range)
-    indices_noisy_neg = list(noisy_neg_range)
-
-    # train and validation subset
-    tran_pos_normal_data_len = tran_neg_normal_data_len  = int((1-val_set_size)*len(indices_normal_pos))
-
-    tran_pos_normal_data_indicies = indices_normal_pos[:tran_pos_normal_data_len]  # pos normal 0,1,... (15200)
-    vali_pos_normal_data_indicies = indices_normal_pos[tran_pos_normal_data_len:]  # val: pos normal 15200, 15201,... (800)
-
-    tran_neg_normal_data_indicies = indices_normal_neg[:tran_neg_normal_data_len]  # neg normal 16000,16001,... (15200)
-    vali_neg_normal_data_indicies = indices_normal_neg[tran_neg_normal_data_len:]  # val: neg normal 31200, 31201,... (800)
-
-    tran_pos_noisy_data_len = tran_neg_noisy_data_len  = int((1-val_set_size)*len(indices_noisy_pos))
-
-    tran_pos_noisy_data_indicies = indices_noisy_pos[:tran_pos_noisy_data_len]  # pos noisy 32000, 32001, ... (304000)
-    vali_pos_noisy_data_indicies = indices_noisy_pos[tran_pos_noisy_data_len:]  # val: pos noisy 336000, 336001,... (16000)
-
-    tran_neg_noisy_data_indicies = indices_noisy_neg[:tran_neg_noisy_data_len]  # neg noisy 352000, 352001, ... (304000)
-    vali_neg_noisy_data_indicies = indices_noisy_neg[tran_neg_noisy_data_len:]  # val: neg noisy 656000, 656001,... (16000)
-
-    # Interleave the two lists (train and validation)
-    train_normal_combined_indices = [val for pair in zip(tran_pos_normal_data_indicies, tran_neg_normal_data_indicies) for val in pair]
-    train_noisy_combined_indices = [val for pair in zip(tran_pos_noisy_data_indicies, tran_neg_noisy_data_indicies) for val in pair]
-    train_indices = train_normal_combined_indices + train_noisy_combined_indices
-
-    val_normal_combined_indices = [val for pair in zip(vali_pos_normal_data_indicies, vali_neg_normal_data_indicies) for val in pair]
-    val_noisy_combined_indices = [val for pair in zip(vali_pos_noisy_data_indicies, vali_neg_noisy_data_indicies) for val in pair]
-    validation_indices = val_normal_combined_indices + val_noisy_combined_indices
+    # data split (index tensors)
+    indices_normal_pos = range_to_indices(normal_pos_range)
+    indices_normal_neg = range_to_indices(normal_neg_range)
+    indices_noisy_pos = range_to_indices(noisy_pos_range)
+    indices_noisy_neg = range_to_indices(noisy_neg_range)
+
+    # train and validation subset: the first (1-val_set_size) of every range is used for training
+    tran_normal_data_len = int((1-val_set_size)*len(indices_normal_pos))  # pos normal 0,1,... (15200), neg normal 16000,16001,... (15200)
+    tran_noisy_data_len = int((1-val_set_size)*len(indices_noisy_pos))  # pos noisy 32000, 32001, ... (304000), neg noisy 352000, 352001, ... (304000)
+
+    # Interleave the pos/neg indices (train and validation)
+    train_normal_combined_indices = interleave_indices(indices_normal_pos[:tran_normal_data_len], indices_normal_neg[:tran_normal_data_len])
+    train_noisy_combined_indices = interleave_indices(indices_noisy_pos[:tran_noisy_data_len], indices_noisy_neg[:tran_noisy_data_len])
+    train_indices = torch.cat((train_normal_combined_indices, train_noisy_combined_indices))
+    # distributed training: every process trains on a shard, the pos/neg pairs and the normal/noisy order are kept
+    train_indices_shard = torch.cat((shard_indices(train_normal_combined_indices, block_size=2),
+                                     shard_indices(train_noisy_combined_indices, block_size=2)))
+
+    val_normal_combined_indices = interleave_indices(indices_normal_pos[tran_normal_data_len:], indices_normal_neg[tran_normal_data_len:])
+    val_noisy_combined_indices = interleave_indices(indices_noisy_pos[tran_noisy_data_len:], indices_noisy_neg[tran_noisy_data_len:])
+    validation_indices = torch.cat((val_normal_combined_indices, val_noisy_combined_indices))
 
     # train subset and validation subset
-    train_subset = Subset(full_dataset, train_indices)
+    train_subset = Subset(full_dataset, train_indices_shard)
     val_subset = Subset(full_dataset, validation_indices)
 
-    train_dataloader = DataLoader(train_subset, batch_size=batch_size, shuffle=False)
+    if batch_loader:
+        # whole batches gathered from the dataset fields, keeps the interleaved order
+        train_dataloader = datasets.TensorBatchLoader(full_dataset, train_indices_shard, batch_size=batch_size, prefetch=prefetch)
+        val_dataloader = datasets.TensorBatchLoader(full_dataset, validation_indices, batch_size=batch_size, prefetch=prefetch)
+    else:
+        train_dataloader = DataLoader(train_subset, batch_size=batch_size, shuffle=False)
+        val_dataloader = DataLoader(val_subset, batch_size=batch_size, shuffle=False)
     print(f'train_dataloader -- {len(train_dataloader)}')
-
-    val_dataloader = DataLoader(val_subset, batch_size=batch_size, shuffle=False)
     print(f'val_dataloader -- {len(val_dataloader)}')
 
-    if save_indices:
+    if save_indices and is_main_process():
         # save the indices of training and validation sets (for later evaluation)
-        torch.save(train_subset.indices, os.path.join(results_dir, f'train_subset_indices.pt'))
+        torch.save(train_indices, os.path.join(results_dir, f'train_subset_indices.pt'))
         torch.save(val_subset.indices, os.path.join(results_dir, f'val_subset_indices.pt'))
+        # save the fitted normalizer (for inference without the training data)
+        full_dataset.save_normalizer(os.path.join(results_dir, datasets.NORMALIZER_FILE_NAME))
 
     return train_subset, train_dataloader, val_subset, val_dataloader
 
@@ -208,6 +221,9 @@ def get_dataset(dataset_class=None,
                 val_set_size=0.05,
                 results_dir=None,
                 save_indices=False,
+                batch_loader=False,
+                shuffle=False,
+                prefetch=0,
                 **kwargs):
     DatasetClass = getattr(datasets, dataset_class)
     print('\n---------------Loading data')
@@ -217,20 +233,83 @@ def get_dataset(dataset_class=None,
 
     # split into train and validation
     train_subset, val_subset = random_split(full_dataset, [1-val_set_size, val_set_size])
+    train_indices = train_subset.indices
+    # distributed training: every process trains on a shard (same split on every process, same seed)
+    train_subset = Subset(full_dataset, shard_indices(train_indices))
     print(f'train_subset -- {train_subset}')
-    train_dataloader = DataLoader(train_subset, batch_size=batch_size)
+    if batch_loader:
+        # whole batches gathered from the dataset fields, no per-sample dicts and collate
+        train_dataloader = datasets.TensorBatchLoader(full_dataset, train_subset.indices, batch_size=batch_size,
+                                                      shuffle=shuffle, prefetch=prefetch)
+        val_dataloader = datasets.TensorBatchLoader(full_dataset, val_subset.indices, batch_size=batch_size,
+                                                    prefetch=prefetch)
+    else:
+        train_dataloader = DataLoader(train_subset, batch_size=batch_size, shuffle=shuffle)
+        val_dataloader = DataLoader(val_subset, batch_size=batch_size)
     print(f'train_dataloader -- {len(train_dataloader)}')
-    val_dataloader = DataLoader(val_subset, batch_size=batch_size)
     print(f'val_dataloader -- {len(val_dataloader)}')
 
-    if save_indices:
+    if save_indices and is_main_process():
         # save the indices of training and validation sets (for later evaluation)
-        torch.save(train_subset.indices, os.path.join(results_dir, f'train_subset_indices.pt'))
+        torch.save(train_indices, os.path.join(results_dir, f'train_subset_indices.pt'))
         torch.save(val_subset.indices, os.path.join(results_dir, f'val_subset_indices.pt'))
+        # save the fitted normalizer (for inference without the training data)
+        full_dataset.save_normalizer(os.path.join(results_dir, datasets.NORMALIZER_FILE_NAME))
 
     return train_subset, train_dataloader, val_subset, val_dataloader
 
 
+def get_normalizer(model_dir=None, dataset_class='InputsDataset', tensor_args=None, **kwargs):
+    """
+    Loads the normalizer saved with a trained model.
+    Models trained before the normalizer was saved fall back to loading the dataset once, and the normalizer is then
+    saved in model_dir for the next runs.
+    """
+    normalizer_path = os.path.join(model_dir, datasets.NORMALIZER_FILE_NAME)
+    if not os.path.exists(normalizer_path):
+        print(f'\n---------------Normalizer not found in {model_dir}, loading data')
+        train_subset, _, _, _ = get_dataset(dataset_class=dataset_class, **kwargs, tensor_args=tensor_args)
+        train_subset.dataset.save_normalizer(normalizer_path)
+    return datasets.InputsNormalizer.load(normalizer_path, tensor_args=tensor_args)
+
+
+def load_diffusion_model(model_dir=None, args=None, checkpoint_name=None, state_dim=None, n_support_points=None,
+                         tensor_args=None):
+    """
+    Builds the diffusion model of a trained model dir from its args.yaml and loads a checkpoint
+    (by default the ema model if it was trained with one). The model is in eval mode, not frozen.
+    """
+    if args is None:
+        args = load_params_from_yaml(os.path.join(model_dir, 'args.yaml'))
+    if checkpoint_name is None:
+        checkpoint_name = 'ema_model_current_state_dict.pth' if args['use_ema'] else 'model_current_state_dict.pth'
+
+    diffusion_configs = dict(
+        variance_schedule=args['variance_schedule'],
+        n_diffusion_steps=args['n_diffusion_steps'],
+        predict_epsilon=args['predict_epsilon'],
+    )
+    unet_configs = dict(
+        state_dim=state_dim,
+        n_support_points=n_support_points,
+        unet_input_dim=args['unet_input_dim'],
+        dim_mults=models.UNET_DIM_MULTS[args['unet_dim_mults_option']],
+        guidance_emb_dim=args.get('guidance_emb_dim', 0),
+    )
+    diffusion_model = get_model(
+        model_class=args['diffusion_model_class'],
+        model=models.ConditionedTemporalUnet(**unet_configs),
+        tensor_args=tensor_args,
+        **diffusion_configs,
+        **unet_configs
+    )
+    diffusion_model.load_state_dict(
+        torch.load(os.path.join(model_dir, 'checkpoints', checkpoint_name), map_location=tensor_args['device'])
+    )
+    diffusion_model.eval()
+    return diffusion_model
+
+
 def get_summary(summary_class=None, **kwargs):
     if summary_class is None:
         return None
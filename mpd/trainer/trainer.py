@@ -1,6 +1,5 @@
 import copy
 from math import ceil
-import shutil
 
 import numpy as np
 import os
@@ -8,8 +7,13 @@ import time
 import torch
 import wandb
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
 from tqdm.autonotebook import tqdm
 
+from mpd.trainer.checkpointing import CheckpointManager, get_rng_states, set_rng_states, load_training_state, \
+    get_process_state
+from mpd.trainer.distributed import is_distributed, is_main_process, get_rank, get_world_size, broadcast_parameters, \
+    all_reduce_gradients, broadcast_object, all_gather_object
 from torch_robotics.torch_utils.torch_timer import TimerCUDA
 from torch_robotics.torch_utils.torch_utils import dict_to_device, DEFAULT_TENSOR_ARGS, to_numpy
 
@@ -71,16 +75,61 @@ class EMA:
     """
     https://github.com/jannerm/diffuser
     (empirical) exponential moving average parameters
+
+    ema = beta * ema + (1 - beta) * current, as one in-place multi-tensor lerp over the flat parameter lists.
+    Floating point buffers are copied from the current model.
+    side_thread: the update runs on a background thread, call wait() before the parameters of the current model
+    change again (optimizer step) or before the ema model is used.
     """
 
-    def __init__(self, beta=0.995):
+    def __init__(self, beta=0.995, side_thread=False):
         super().__init__()
         self.beta = beta
+        self.side_thread = side_thread
+        self._tensors_cache = {}
+        self._executor = None
+        self._future = None
+        if side_thread:
+            self._executor = ThreadPoolExecutor(max_workers=1)
+
+    def _get_tensors(self, ema_model, current_model):
+        key = (id(ema_model), id(current_model))
+        if key not in self._tensors_cache:
+            ema_params = list(ema_model.parameters())
+            current_params = list(current_model.parameters())
+            ema_buffers, current_buffers = [], []
+            for ema_buffer, current_buffer in zip(ema_model.buffers(), current_model.buffers()):
+                if ema_buffer.is_floating_point():
+                    ema_buffers.append(ema_buffer)
+                    current_buffers.append(current_buffer)
+            self._tensors_cache[key] = (ema_params, current_params, ema_buffers, current_buffers)
+        return self._tensors_cache[key]
+
+    @torch.no_grad()
+    def _update(self, ema_model, current_model):
+        ema_params, current_params, ema_buffers, current_buffers = self._get_tensors(ema_model, current_model)
+        torch._foreach_lerp_(ema_params, current_params, 1 - self.beta)
+        if ema_buffers:
+            foreach_copy_(ema_buffers, current_buffers)
 
     def update_model_average(self, ema_model, current_model):
-        for ema_params, current_params in zip(ema_model.parameters(), current_model.parameters()):
-            old_weight, up_weight = ema_params.data, current_params.data
-            ema_params.data = self.update_average(old_weight, up_weight)
+        if self._executor is None:
+            self._update(ema_model, current_model)
+        else:
+            self.wait()
+            self._future = self._executor.submit(self._update, ema_model, current_model)
+
+    @torch.no_grad()
+    def reset_parameters(self, ema_model, current_model):
+        # same as ema_model.load_state_dict(current_model.state_dict()), without building the state dict
+        self.wait()
+        ema_params, current_params, ema_buffers, current_buffers = self._get_tensors(ema_model, current_model)
+        foreach_copy_(ema_params + ema_buffers, current_params + current_buffers)
+
+    def wait(self):
+        if self._future is not None:
+            self._future.result()
+            self._future = None
 
     def update_average(self, old, new):
         if old is None:
@@ -88,6 +137,36 @@ class EMA:
         return old * self.beta + (1 - self.beta) * new
 
 
+def foreach_copy_(dst, src):
+    if hasattr(torch, '_foreach_copy_'):
+        torch._foreach_copy_(dst, src)
+    else:
+        for d, s in zip(dst, src):
+            d.copy_(s)
+
+
+def get_amp_settings(device, use_amp=False, amp_dtype=None):
+    """
+    Mixed precision following the training device:
+    cpu: bfloat16 autocast (no loss scaling needed, same exponent range as float32)
+    cuda: float16 autocast with a GradScaler (or bfloat16 without scaler, if amp_dtype='bfloat16')
+    Returns (device_type, dtype, use_scaler)
+    """
+    device_type = torch.device(device).type
+    if amp_dtype is None:
+        dtype = torch.float16 if device_type == 'cuda' else torch.bfloat16
+    else:
+        dtype = getattr(torch, amp_dtype) if isinstance(amp_dtype, str) else amp_dtype
+    use_scaler = use_amp and device_type == 'cuda' and dtype == torch.float16
+    return device_type, dtype, use_scaler
+
+
+def get_grad_scaler(device_type, enabled):
+    if hasattr(torch, 'amp') and hasattr(torch.amp, 'GradScaler'):
+        return torch.amp.GradScaler(device_type, enabled=enabled)
+    return torch.cuda.amp.GradScaler(enabled=enabled)
+
+
 def do_summary(
         summary_fn,
         train_steps_current,
@@ -124,35 +203,54 @@ def train(model=None, train_dataloader=None, epochs=None, lr=None, steps_til_sum
           clip_grad_max_norm=1.0,
           val_loss_fn=None,
           optimizers=None, steps_per_validation=10, max_steps=None,
+          target_val_loss=None,
           use_ema: bool = True,
           ema_decay: float = 0.995, step_start_ema: int = 1000, update_ema_every: int = 10,
+          ema_side_thread: bool = False,
           use_amp=False,
+          amp_dtype=None,
           early_stopper_patience=-1,
           debug=False,
           model_saving_address = None,
+          async_checkpoint=True,
+          keep_last_n_checkpoints=None,
+          keep_every_k_steps=None,
+          resume_from=None,
           text_conditioner = None,
           tensor_args=DEFAULT_TENSOR_ARGS,
           **kwargs
           ):
 
     print(f'\n------- TRAINING STARTED -------\n')
-    print("Current CUDA device:", torch.cuda.current_device())
+    print(f"device {tensor_args['device']}")
     print(f"epochs {epochs}")
     print(f'model_dir -- {model_dir}')
     print(f'lr -- {lr}')
     print(f'model_saving_address -- {model_saving_address}')
+
+    # Distributed data-parallel (see distributed.py): the dataloaders hold the shard of this process, the gradients are
+    # averaged over the processes, the ema, summaries and checkpoints are done by the main process only
+    distributed = is_distributed()
+    main_process = is_main_process()
+    if distributed:
+        print(f'distributed training -- {get_world_size()} processes')
+        broadcast_parameters(model)
+
     ema_model = None
-    if use_ema:
+    if use_ema and main_process:
         # Exponential moving average model
-        ema = EMA(beta=ema_decay)
+        ema = EMA(beta=ema_decay, side_thread=ema_side_thread)
         ema_model = copy.deepcopy(model)
 
     # Model optimizers
     if optimizers is None:
         optimizers = [torch.optim.Adam(lr=lr, params=model.parameters())]
 
-    # Automatic Mixed Precision
-    scaler = torch.cuda.amp.GradScaler(enabled=use_amp)
+    # Automatic Mixed Precision (bfloat16 on cpu, float16 + loss scaling on cuda)
+    amp_device_type, amp_dtype, use_scaler = get_amp_settings(tensor_args['device'], use_amp, amp_dtype)
+    scaler = get_grad_scaler(amp_device_type, enabled=use_scaler)
+    if use_amp:
+        print(f'mixed precision -- {amp_device_type} {amp_dtype}, loss scaling {use_scaler}')
 
     if val_dataloader is not None:
         assert val_loss_fn is not None, "If validation set is passed, have to pass a validation loss_fn!"
@@ -170,17 +268,86 @@ def train(model=None, train_dataloader=None, epochs=None, lr=None, steps_til_sum
     early_stopper = EarlyStopper(patience=early_stopper_patience, min_delta=0)
 
     stop_training = False
+    # wall time (and samples) until the validation loss first reaches target_val_loss
+    time_to_target = None
+    t_train_start = time.time()
     train_steps_current = 0
+    start_epoch = 0
+    start_step_in_epoch = 0
+    epoch_rng_state = None
+    rng_states = None
+    total_val_loss = torch.inf
+    train_losses_l = []
+    validation_losses_l = []
+
+    # Resume the training state (models, optimizers, scaler, ema, rng, counters, position in the epoch)
+    training_state = None
+    if resume_from is not None:
+        training_state = load_training_state(resume_from, map_location=tensor_args['device'])
+        model.load_state_dict(training_state['model'])
+        if training_state.get('loss_history') is not None:
+            model.load_loss_history_state_dict(training_state['loss_history'])
+        if ema_model is not None:
+            ema_model.load_state_dict(training_state['ema_model'])
+        for optim, optim_state in zip(optimizers, training_state['optimizers']):
+            optim.load_state_dict(optim_state)
+        if training_state['scaler']:
+            scaler.load_state_dict(training_state['scaler'])
+        early_stopper.counter = training_state['early_stopper']['counter']
+        early_stopper.min_validation_loss = training_state['early_stopper']['min_validation_loss']
+        train_losses_l = training_state['train_losses']
+        validation_losses_l = training_state['validation_losses']
+        total_val_loss = training_state['total_val_loss']
+        train_steps_current = training_state['train_steps_current']
+        start_epoch = training_state['epoch']
+        start_step_in_epoch = training_state['step_in_epoch']
+        # rng states of this process (every process saved its own)
+        epoch_rng_state = get_process_state(training_state['epoch_rng_state'], get_rank())
+        rng_states = get_process_state(training_state['rng_states'], get_rank())
+        print(f'Resumed training from {resume_from} -- epoch {start_epoch}, step in epoch {start_step_in_epoch}, '
+              f'train_steps_current {train_steps_current}')
+
+    # Checkpoints are written on a background thread, snapshots in model_saving_address/<step> hard link model_dir
+    checkpoint_manager = None
+    if main_process:
+        checkpoint_manager = CheckpointManager(
+            model_dir, saved_main_folder=model_saving_address,
+            keep_last_n=keep_last_n_checkpoints, keep_every_k=keep_every_k_steps,
+            async_write=async_checkpoint
+        )
 
     # save models before training
-    save_models_to_disk([(model, 'model'), (ema_model, 'ema_model')], 0, 0, checkpoints_dir)
+    if training_state is None and main_process:
+        checkpoint_manager.save([(model, 'model'), (ema_model, 'ema_model')], 0, 0)
 
-    with tqdm(total=len(train_dataloader) * epochs, mininterval=1 if debug else 60) as pbar:
-        train_losses_l = []
-        validation_losses_l = []
-        for epoch in range(epochs):
+    epoch = start_epoch
+    with tqdm(total=len(train_dataloader) * epochs, initial=train_steps_current,
+              mininterval=1 if debug else 60, disable=not main_process) as pbar:
+        for epoch in range(start_epoch, epochs):
             model.train()  # set model to training mode
-            for step, train_batch_dict in enumerate(train_dataloader):
+
+            # the shuffling of the epoch is drawn from the torch rng when the iterator is created
+            start_step = 0
+            if training_state is not None and start_step_in_epoch > 0:
+                # resumed epoch: same permutation as before the interruption, skip the batches already trained on
+                start_step = start_step_in_epoch
+                torch.set_rng_state(epoch_rng_state.cpu())
+                if hasattr(train_dataloader, 'start_batch'):
+                    train_dataloader.start_batch = start_step
+                    train_batches = iter(train_dataloader)
+                else:
+                    train_batches = iter(train_dataloader)
+                    for _ in range(start_step):
+                        next(train_batches)
+                set_rng_states(rng_states)
+            else:
+                if training_state is not None:
+                    set_rng_states(rng_states)
+                epoch_rng_state = torch.get_rng_state()
+                train_batches = iter(train_dataloader)
+            training_state = None
+
+            for step, train_batch_dict in enumerate(train_batches, start=start_step):
                 ####################################################################################################
                 # TRAINING LOSS
                 ####################################################################################################
@@ -188,19 +355,22 @@ def train(model=None, train_dataloader=None, epochs=None, lr=None, steps_til_sum
                     train_batch_dict = dict_to_device(train_batch_dict, tensor_args['device'])
 
                     # Compute losses
-                    with torch.autocast(device_type='cuda', dtype=torch.float16, enabled=use_amp):
+                    with torch.autocast(device_type=amp_device_type, dtype=amp_dtype, enabled=use_amp):
                         train_losses, train_losses_info = loss_fn(model, train_batch_dict, train_subset.dataset)
 
                     train_loss_batch = 0.
                     train_losses_log = {}
                     for loss_name, loss in train_losses.items():
-                        single_loss = loss.mean()
+                        single_loss = loss.float().mean()
                         train_loss_batch += single_loss
                         train_losses_log[loss_name] = to_numpy(single_loss).item()
 
                 ####################################################################################################
                 # SUMMARY
-                if train_steps_current % steps_til_summary == 0:
+                if main_process and train_steps_current % steps_til_summary == 0:
+                    if ema_model is not None:
+                        ema.wait()
+
                     # TRAINING
                     print(f"\n-----------------------------------------")
                     print(f"train_steps_current: {train_steps_current}")
@@ -234,8 +404,10 @@ def train(model=None, train_dataloader=None, epochs=None, lr=None, steps_til_sum
                             total_val_loss = 0.
                             for step_val, batch_dict_val in enumerate(val_dataloader):
                                 batch_dict_val = dict_to_device(batch_dict_val, tensor_args['device'])
-                                val_loss, val_loss_info = loss_fn(
-                                    model, batch_dict_val, val_subset.dataset, step=train_steps_current)
+                                # no gradients (the importance loss history only follows the training batches)
+                                with torch.no_grad():
+                                    val_loss, val_loss_info = loss_fn(
+                                        model, batch_dict_val, val_subset.dataset, step=train_steps_current)
                                 for name, value in val_loss.items():
                                     single_loss = to_numpy(value)
                                     val_losses[name].append(single_loss)
@@ -256,6 +428,16 @@ def train(model=None, train_dataloader=None, epochs=None, lr=None, steps_til_sum
                         validation_losses_log = validation_losses
                         validation_losses_l.append((train_steps_current, validation_losses_log))
 
+                        if target_val_loss is not None and time_to_target is None \
+                                and sum(validation_losses.values()) <= target_val_loss:
+                            time_to_target = time.time() - t_train_start
+                            samples_to_target = train_steps_current * train_batch_dict[
+                                next(iter(train_batch_dict))].shape[0] * get_world_size()
+                            print(f"Target validation loss {target_val_loss} reached -- {time_to_target:.1f} sec, "
+                                  f"{train_steps_current} steps, {samples_to_target} samples")
+                            validation_losses_log = {**validation_losses_log,
+                                                     'time_to_target_val_loss': time_to_target}
+
                         # The validation summary is done only on one batch of the validation data
                         with TimerCUDA() as t_validation_summary:
                             do_summary(
@@ -273,6 +455,10 @@ def train(model=None, train_dataloader=None, epochs=None, lr=None, steps_til_sum
 
                     wandb.log({**train_losses_log, **validation_losses_log}, step=train_steps_current)
 
+                if distributed and train_steps_current % steps_til_summary == 0:
+                    # validation loss of the main process, same early stopping decision on every process
+                    total_val_loss = broadcast_object(total_val_loss)
+
                 ####################################################################################################
                 # Early stopping
                 if early_stopper.early_stop(total_val_loss):
@@ -282,10 +468,15 @@ def train(model=None, train_dataloader=None, epochs=None, lr=None, steps_til_sum
                 ####################################################################################################
                 # OPTIMIZE TRAIN LOSS BATCH
                 with TimerCUDA() as t_training_optimization:
+                    if ema_model is not None:
+                        # the optimizer step must not overlap with an ema update on the side thread
+                        ema.wait()
+
                     for optim in optimizers:
                         optim.zero_grad()
 
                     scaler.scale(train_loss_batch).backward()
+                    all_reduce_gradients(model)
 
                     if clip_grad:
                         for optim in optimizers:
@@ -305,10 +496,11 @@ def train(model=None, train_dataloader=None, epochs=None, lr=None, steps_til_sum
                             # update ema
                             if train_steps_current < step_start_ema:
                                 # reset parameters ema
-                                ema_model.load_state_dict(model.state_dict())
-                            ema.update_model_average(ema_model, model)
+                                ema.reset_parameters(ema_model, model)
+                            else:
+                                ema.update_model_average(ema_model, model)
 
-                if train_steps_current % steps_til_summary == 0:
+                if main_process and train_steps_current % steps_til_summary == 0:
                     print(f"t_training_optimization: {t_training_optimization.elapsed:.4f} sec")
 
                 ####################################################################################################
@@ -317,19 +509,40 @@ def train(model=None, train_dataloader=None, epochs=None, lr=None, steps_til_sum
                 pbar.update(1)
                 train_steps_current += 1
 
-                if (steps_til_checkpoint is not None) and (train_steps_current % steps_til_checkpoint == 0):
-                    save_models_to_disk([(model, 'model'), (ema_model, 'ema_model')],
-                                        epoch, train_steps_current, checkpoints_dir)
-                    save_losses_to_disk(train_losses_l, validation_losses_l, checkpoints_dir)
+                checkpoint_step = (steps_til_checkpoint is not None) and (train_steps_current % steps_til_checkpoint == 0)
+                if checkpoint_step:
+                    # the rng states of every process are saved (collective, called by all the processes)
+                    process_rng_states = all_gather_object((epoch_rng_state, get_rng_states()))
+                if main_process and checkpoint_step:
+                    if ema_model is not None:
+                        ema.wait()
+                    checkpoint_manager.save([(model, 'model'), (ema_model, 'ema_model')],
+                                            epoch, train_steps_current,
+                                            losses=(train_losses_l, validation_losses_l),
+                                            snapshot_name=train_steps_current)
+
+                    # training state to resume from this step
+                    end_of_epoch = step + 1 == len(train_dataloader)
+                    checkpoint_manager.save_training_state({
+                        'model': model.state_dict(),
+                        'ema_model': ema_model.state_dict() if ema_model is not None else None,
+                        'optimizers': [optim.state_dict() for optim in optimizers],
+                        'scaler': scaler.state_dict(),
+                        'early_stopper': {'counter': early_stopper.counter,
+                                          'min_validation_loss': early_stopper.min_validation_loss},
+                        'train_losses': train_losses_l,
+                        'validation_losses': validation_losses_l,
+                        'total_val_loss': total_val_loss,
+                        'train_steps_current': train_steps_current,
+                        'epoch': epoch + 1 if end_of_epoch else epoch,
+                        'step_in_epoch': 0 if end_of_epoch else step + 1,
+                        'epoch_rng_state': [states[0] for states in process_rng_states],
+                        'rng_states': [states[1] for states in process_rng_states],
+                        'loss_history': model.loss_history_state_dict()
+                        if hasattr(model, 'loss_history_state_dict') else None,
+                    })
                     print(f"\n-----------------------------------------")
-                    print(f'New model has been saved in the checkpoints dir!!!')
-                    saved_main_folder = model_saving_address
-                    os.makedirs(saved_main_folder, exist_ok=True)
-                    middle_model_dir = os.path.join(saved_main_folder, str(train_steps_current))
-                    # os.makedirs(middle_model_dir, exist_ok=True)
-                    print(f'model dir path -- {middle_model_dir}')
-                    shutil.copytree(model_dir, middle_model_dir)
-                    print(f'New model {train_steps_current} has been saved !!!')
+                    print(f'New model {train_steps_current} has been queued for saving !!!')
 
                 if stop_training or (max_steps is not None and train_steps_current == max_steps):
                     break
@@ -342,15 +555,18 @@ def train(model=None, train_dataloader=None, epochs=None, lr=None, steps_til_sum
             # update ema
             if train_steps_current < step_start_ema:
                 # reset parameters ema
-                ema_model.load_state_dict(model.state_dict())
-            ema.update_model_average(ema_model, model)
-
-        # Save model at end of training
-        save_models_to_disk([(model, 'model'), (ema_model, 'ema_model')],
-                            epoch, train_steps_current, checkpoints_dir)
-        save_losses_to_disk(train_losses_l, validation_losses_l, checkpoints_dir)
-        final_model_dir = os.path.join(saved_main_folder, 'final')
-        shutil.copytree(model_dir, final_model_dir)
-        print(f'Final model has been saved !!!')
+                ema.reset_parameters(ema_model, model)
+            else:
+                ema.update_model_average(ema_model, model)
+            ema.wait()
+
+        # Save model at end of training, and wait for all checkpoints to be written
+        if main_process:
+            checkpoint_manager.save([(model, 'model'), (ema_model, 'ema_model')],
+                                    epoch, train_steps_current,
+                                    losses=(train_losses_l, validation_losses_l),
+                                    snapshot_name='final')
+            checkpoint_manager.close()
+            print(f'Final model has been saved !!!')
 
         print(f'\n------- TRAINING FINISHED -------')
@@ -4,3 +4,8 @@ import yaml
 def load_params_from_yaml(path: str):
     with open(path, "r") as stream:
         return yaml.load(stream, Loader=yaml.FullLoader)
+
+
+def save_params_to_yaml(params: dict, path: str):
+    with open(path, "w") as stream:
+        yaml.dump(params, stream, default_flow_style=False)
@@ -0,0 +1,111 @@
+import numpy as np
+import os
+
+import torch
+from einops._torch_specific import allow_ops_in_compiled_graph  # requires einops>=0.6.1
+
+from experiment_launcher import single_experiment_yaml, run_experiment
+from mpd.envs import CartPoleVecEnv
+from mpd.inference import DiffusionPolicy, rollout_policy_batched
+from mpd.trainer import get_normalizer
+from mpd.utils.loading import load_params_from_yaml
+from torch_robotics.torch_utils.seed import fix_random_seed
+from torch_robotics.torch_utils.torch_utils import get_torch_device
+
+allow_ops_in_compiled_graph()
+
+
+MODEL_PATH = '/root/cartpoleDiff/cart_pole_diffusion_based_on_MPD/trained_models/180000_training_data/100000' # the absolute path of the trained model
+MODEL_ID = '100000' # number of training
+
+# 'linear': 4 state LMPC cart pole, 'nonlinear': 5 state NMPC cart pole
+DYNAMICS = 'linear'
+POSITION_INITIAL_RANGE = np.linspace(-1,1,5) 
+THETA_INITIAL_RANGE = np.linspace(-np.pi/4,np.pi/4,5) 
+WEIGHT_GUIDANC = 0.01 # non-conditioning weight
+ITERATIONS = 50 # control loop (steps)
+
+# closed loop cost (same weights as the MPC of each model)
+Q = {'linear': np.diag([10, 1, 10, 1]), 'nonlinear': np.diag([0.01, 0.01, 0, 0.001, 1000.0])}
+R = {'linear': 1., 'nonlinear': 0.1}
+
+RESULTS_SAVED_PATH = '/root/cartpoleDiff/cart_pole_diffusion_based_on_MPD/model_performance_saving/batched'
+
+
+@single_experiment_yaml
+def experiment(
+    #########################################################################################
+    n_samples: int = 1,
+
+    n_diffusion_steps_without_noise: int = 5,
+
+    # DDIM (respaced) sampling
+    ddim: bool = False,
+    n_ddim_steps: int = 10,
+    ddim_eta: float = 0.,
+    timestep_respacing: str = 'uniform',  # 'uniform', 'quadratic'
+
+    ##############################################################
+    device: str = 'cuda',
+
+    ##############################################################
+    # MANDATORY
+    seed: int = 30,
+    results_dir: str = 'logs',
+    ##############################################################
+    # **kwargs
+):
+    ##############################################################
+    fix_random_seed(seed)
+
+    device = get_torch_device(device)
+    tensor_args = {'device': device, 'dtype': torch.float32}
+
+    ################################################################
+    model_dir = MODEL_PATH 
+    args = load_params_from_yaml(os.path.join(model_dir, "args.yaml"))
+
+    # Load the normalizer saved with the model (the training data is not needed)
+    dataset = get_normalizer(model_dir=model_dir, **args, tensor_args=tensor_args)
+
+    ############################################################################
+    # diffusion policy: the model is loaded, compiled and warmed up once
+    policy = DiffusionPolicy(
+        model_dir=model_dir,
+        context_weight=WEIGHT_GUIDANC,
+        n_samples=n_samples,
+        dataset=dataset,
+        tensor_args=tensor_args,
+        n_diffusion_steps_without_noise=n_diffusion_steps_without_noise,
+        ddim=ddim,
+        n_sampling_steps=n_ddim_steps,
+        eta=ddim_eta,
+        timestep_respacing=timestep_respacing,
+    )
+
+    ############################################################################
+    # all initial states of the grid are rolled out together
+    env = CartPoleVecEnv(dynamics=DYNAMICS, tensor_args=tensor_args)
+    x0_grid = CartPoleVecEnv.initial_state_grid(POSITION_INITIAL_RANGE, THETA_INITIAL_RANGE, dynamics=DYNAMICS)
+    print(f'x0_grid -- {x0_grid.shape}')
+
+    results = rollout_policy_batched(policy, env, x0_grid, ITERATIONS, Q=Q[DYNAMICS], R=R[DYNAMICS])
+
+    for key, value in results['metrics'].items():
+        print(f'{key} -- {value}')
+
+    ########################## Results Saving ################################
+    results_folder = os.path.join(RESULTS_SAVED_PATH, 'model_'+ str(MODEL_ID), DYNAMICS)
+    os.makedirs(results_folder, exist_ok=True)
+
+    np.save(os.path.join(results_folder, 'x0_grid.npy'), x0_grid)
+    np.save(os.path.join(results_folder, 'x_diffusion.npy'), results['x_track'])
+    np.save(os.path.join(results_folder, 'u_diffusion.npy'), results['u_track'])
+    np.save(os.path.join(results_folder, 'u_horizon_diffusion.npy'), results['u_horizon_track'])
+    np.save(os.path.join(results_folder, 'cost_diffusion.npy'), results['cost'])
+    np.save(os.path.join(results_folder, 'sampling_time.npy'), results['sampling_time'])
+
+
+if __name__ == '__main__':
+    # Leave unchanged
+    run_experiment(experiment)
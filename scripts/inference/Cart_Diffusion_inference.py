@@ -10,10 +10,11 @@ import torch
 from einops._torch_specific import allow_ops_in_compiled_graph  # requires einops>=0.6.1
 
 from experiment_launcher import single_experiment_yaml, run_experiment
-from mpd.models import ConditionedTemporalUnet, UNET_DIM_MULTS
-from mpd.models.diffusion_models.sample_functions import guide_gradient_steps, ddpm_sample_fn, ddpm_cart_pole_sample_fn
-from mpd.trainer import get_dataset, get_model
+from mpd.inference import DiffusionPolicy
+from mpd.trainer import get_normalizer
+from mpd.controllers import get_cart_pole_nmpc
 from mpd.utils.loading import load_params_from_yaml
+from mpd.envs import DiscreteLinearDynamics, LINEAR_A, LINEAR_B, LINEAR_TS
 from torch_robotics.torch_utils.seed import fix_random_seed
 from torch_robotics.torch_utils.torch_timer import TimerCUDA
 from torch_robotics.torch_utils.torch_utils import get_torch_device, freeze_torch_model_params
@@ -53,52 +54,12 @@ initial_guess_u = [1000, -1000]
 RESULTS_SAVED_PATH = '/root/cartpoleDiff/cart_pole_diffusion_based_on_MPD/model_performance_saving/cart_pole_test1_84000'
 
 # lmpc cart pole dynamics
-def cart_pole_dynamics(x, u):
-    A = np.array([
-    [0, 1, 0, 0],
-    [0, -0.1, 3, 0],
-    [0, 0, 0, 1],
-    [0, -0.5, 30, 0]
-    ])
-
-    B = np.array([
-    [0],
-    [2],
-    [0],
-    [5]
-    ])
-
-    C = np.eye(4)
-
-    D = np.zeros((4,1))
-
-    # state space equation
-    sys_continuous = control.ss(A, B, C, D)
+CART_POLE_DYNAMICS = DiscreteLinearDynamics(LINEAR_A, LINEAR_B, LINEAR_TS)
 
-    # sampling time
-    Ts = 0.1
 
-    # convert to discrete time dynamics
-    sys_discrete = control.c2d(sys_continuous, Ts, method='zoh')
-
-    A_d = sys_discrete.A
-    B_d = sys_discrete.B
-    C_d = sys_discrete.C
-    D_d = sys_discrete.D
-
-    # States
-    x_pos = x[0]
-    x_dot = x[1]
-    theta = x[2]
-    theta_dot = x[3]
-
-    x_next = ca.vertcat(
-        A_d[0,0]*x_pos + A_d[0,1]*x_dot + A_d[0,2]*theta + A_d[0,3]*theta_dot + B_d[0,0]*u,
-        A_d[1,0]*x_pos + A_d[1,1]*x_dot + A_d[1,2]*theta + A_d[1,3]*theta_dot + B_d[1,0]*u,
-        A_d[2,0]*x_pos + A_d[2,1]*x_dot + A_d[2,2]*theta + A_d[2,3]*theta_dot + B_d[2,0]*u,
-        A_d[3,0]*x_pos + A_d[3,1]*x_dot + A_d[3,2]*theta + A_d[3,3]*theta_dot + B_d[3,0]*u,
-    )
-    return x_next
+def cart_pole_dynamics(x, u):
+    # discretized once at import, instead of control.ss + control.c2d at every call
+    return CART_POLE_DYNAMICS.step_casadi(x, u)
 
 
 ############### Dynamics Define ######################
@@ -197,48 +158,9 @@ def ThetaToRedTheta(theta):
     return (theta-np.pi)**2/-np.pi + np.pi
 
 def MPC_Solve( system_update, system_dynamic, x0:np.array, initial_guess_x:float, initial_guess_u:float, num_state:int, horizon:int, Q_cost:np.array, R_cost:float, ts: float, opts_setting ):
-    # casadi_Opti
-    optimizer_normal = ca.Opti()
-    
-    ##### normal mpc #####
-    # x and u mpc prediction along N
-    X_pre = optimizer_normal.variable(num_state, horizon + 1) 
-    U_pre = optimizer_normal.variable(1, horizon)
-    # set intial guess
-    optimizer_normal.set_initial(X_pre, initial_guess_x)
-    # optimizer_normal.set_initial(X_pre[0], initial_guess_x)
-    # optimizer_normal.set_initial(X_pre[1], 10*initial_guess_x)
-    # optimizer_normal.set_initial(X_pre[2], initial_guess_x)
-    # optimizer_normal.set_initial(X_pre[3], 10*initial_guess_x)
-    # optimizer_normal.set_initial(X_pre[4], initial_guess_x)
-    optimizer_normal.set_initial(U_pre, initial_guess_u)
-
-    optimizer_normal.subject_to(X_pre[:, 0] == x0)  # starting state
-
-    # cost 
-    cost = 0
-
-    # initial cost
-    cost += Q_cost[0,0]*X_pre[0, 0]**2 + Q_cost[1,1]*X_pre[1, 0]**2 + Q_cost[2,2]*X_pre[2, 0]**2 + Q_cost[3,3]*X_pre[3, 0]**2 + Q_cost[4,4]*X_pre[4, 0]**2
-
-    # state cost
-    for k in range(0,HOR-1):
-        x_next = system_update(system_dynamic,ts,X_pre[:, k],U_pre[:, k])
-        optimizer_normal.subject_to(X_pre[:, k + 1] == x_next)
-        cost += Q_cost[0,0]*X_pre[0, k+1]**2 + Q_cost[1,1]*X_pre[1, k+1]**2 + Q_cost[2,2]*X_pre[2, k+1]**2 + Q_cost[3,3]*X_pre[3, k+1]**2 + Q_cost[4,4]*X_pre[4, k+1]**2 + R_cost * U_pre[:, k]**2
-
-    # terminal cost
-    x_terminal = system_update(system_dynamic,ts,X_pre[:, horizon-1],U_pre[:, horizon-1])
-    optimizer_normal.subject_to(X_pre[:, horizon] == x_terminal)
-    cost += P[0,0]*X_pre[0, HOR]**2 + P[1,1]*X_pre[1, HOR]**2 + P[2,2]*X_pre[2, HOR]**2 + P[3,3]*X_pre[3, HOR]**2 + P[4,4]*X_pre[4, HOR]**2 + R_cost * U_pre[:, HOR-1]**2
-
-    optimizer_normal.minimize(cost)
-    optimizer_normal.solver('ipopt',opts_setting)
-    sol = optimizer_normal.solve()
-    X_sol = sol.value(X_pre)
-    U_sol = sol.value(U_pre)
-    Cost_sol = sol.value(cost)
-    return X_sol, U_sol, Cost_sol
+    # the NLP is built once per process and (dynamics, horizon, Q, R, P, Ts), later calls only update x0 and re-solve
+    nmpc = get_cart_pole_nmpc(system_update, system_dynamic, num_state, horizon, Q_cost, R_cost, P, ts, opts_setting)
+    return nmpc.solve(x0, initial_guess_x, initial_guess_u)
 
 # calMPCCost
 def calMPCCost(Q,R,P,u_hor:torch.tensor,x0:np.array, ModelUpdate_func, dt):
@@ -294,6 +216,12 @@ def experiment(
 
     n_diffusion_steps_without_noise: int = 5,
 
+    # DDIM (respaced) sampling
+    ddim: bool = False,
+    n_ddim_steps: int = 10,
+    ddim_eta: float = 0.,
+    timestep_respacing: str = 'uniform',  # 'uniform', 'quadratic'
+
     ##############################################################
     device: str = 'cuda',
 
@@ -333,14 +261,9 @@ def experiment(
     args = load_params_from_yaml(os.path.join(model_dir, "args.yaml"))
 
     #################################################################
-    # Load dataset
-    train_subset, train_dataloader, val_subset, val_dataloader = get_dataset(
-        dataset_class='InputsDataset',
-        **args,
-        tensor_args=tensor_args
-    )
-    dataset = train_subset.dataset
-    print(f'dataset -- {len(dataset)}')
+    # Load the normalizer saved with the model (the training data is not needed)
+    dataset = get_normalizer(model_dir=model_dir, **args, tensor_args=tensor_args)
+    print(f'dataset -- {dataset}')
 
     n_support_points = dataset.n_support_points
     print(f'n_support_points -- {n_support_points}')
@@ -371,6 +294,21 @@ def experiment(
     # x0 = np.array([[x_0 , 0, theta_0, 0]])  # np.array([[x_0 , 0, theta_0, 0]]) 
     initial_state = x0   
 
+    ############################################################################
+    # diffusion policy: the model is loaded, compiled and warmed up once
+    policy = DiffusionPolicy(
+        model_dir=model_dir,
+        context_weight=WEIGHT_GUIDANC,
+        n_samples=n_samples,
+        dataset=dataset,
+        tensor_args=tensor_args,
+        n_diffusion_steps_without_noise=n_diffusion_steps_without_noise,
+        ddim=ddim,
+        n_sampling_steps=n_ddim_steps,
+        eta=ddim_eta,
+        timestep_respacing=timestep_respacing,
+    )
+
     ############################################################################
     # sampling loop
     num_loop = ITERATIONS
@@ -401,60 +339,15 @@ def experiment(
         x0_D= np.copy(x0)
         x0_D = torch.tensor(x0_D).to(device) # load data to cuda
 
-        hard_conds = None
-        context = dataset.normalize_condition(x0_D.reshape(1,NUM_STATE))
-        context_weight = WEIGHT_GUIDANC
-
-        #########################################################################
-        # Load prior model
-        diffusion_configs = dict(
-            variance_schedule=args['variance_schedule'],
-            n_diffusion_steps=args['n_diffusion_steps'],
-            predict_epsilon=args['predict_epsilon'],
-        )
-        unet_configs = dict(
-            state_dim=dataset.state_dim,
-            n_support_points=dataset.n_support_points,
-            unet_input_dim=args['unet_input_dim'],
-            dim_mults=UNET_DIM_MULTS[args['unet_dim_mults_option']],
-        )
-        diffusion_model = get_model(
-            model_class=args['diffusion_model_class'],
-            model=ConditionedTemporalUnet(**unet_configs),
-            tensor_args=tensor_args,
-            **diffusion_configs,
-            **unet_configs
-        )
-        # 'ema_model_current_state_dict.pth'
-        diffusion_model.load_state_dict(
-            torch.load(os.path.join(model_dir, 'checkpoints', 'ema_model_current_state_dict.pth' if args['use_ema'] else 'model_current_state_dict.pth'),
-            map_location=tensor_args['device'])
-        )
-        diffusion_model.eval()
-        model = diffusion_model
-
-        model = torch.compile(model)
-
-
         ########
         # Sample u with classifier-free-guidance (CFG) diffusion model
         with TimerCUDA() as t_diffusion_time:
-            inputs_normalized_iters = model.run_CFG(
-                context, hard_conds, context_weight,
-                n_samples=n_samples, horizon=n_support_points,
-                return_chain=True,
-                sample_fn=ddpm_cart_pole_sample_fn,
-                n_diffusion_steps_without_noise=n_diffusion_steps_without_noise,
-            )
+            inputs_final = policy.act(x0_D)
         print(f't_model_sampling: {t_diffusion_time.elapsed:.4f} sec')
         single_Diffusion_time = np.round(t_diffusion_time.elapsed,4)
         Diffusion_total_time += single_Diffusion_time
         # t_total = timer_model_sampling.elapsed
 
-        ########
-        inputs_iters = dataset.unnormalize_states(inputs_normalized_iters)
-
-        inputs_final = inputs_iters[-1]
         print(f'control_inputs -- {inputs_final}')
 
         print(f'\n--------------------------------------\n')
@@ -10,10 +10,10 @@ import torch
 from einops._torch_specific import allow_ops_in_compiled_graph  # requires einops>=0.6.1
 
 from experiment_launcher import single_experiment_yaml, run_experiment
-from mpd.models import ConditionedTemporalUnet, UNET_DIM_MULTS
-from mpd.models.diffusion_models.sample_functions import guide_gradient_steps, ddpm_sample_fn, ddpm_cart_pole_sample_fn
-from mpd.trainer import get_dataset, get_model
+from mpd.inference import DiffusionPolicy
+from mpd.trainer import get_normalizer
 from mpd.utils.loading import load_params_from_yaml
+from mpd.envs import DiscreteLinearDynamics, LINEAR_A, LINEAR_B, LINEAR_TS
 from torch_robotics.torch_utils.seed import fix_random_seed
 from torch_robotics.torch_utils.torch_timer import TimerCUDA
 from torch_robotics.torch_utils.torch_utils import get_torch_device, freeze_torch_model_params
@@ -26,6 +26,8 @@ MODEL_FOLDER = '2406400_training_data'
 
 MODEL_PATH = '/root/cartpoleDiff/cart_pole_diffusion_based_on_MPD/data_trained_models/2406400_training_data/1000000'
 MODEL_ID = 1000000
+# guidance weight sweeps: launch with context_weight=<w>. With a guidance distilled model (cart_pole_guidance_distill.py,
+# MODEL_PATH = <results_dir>/guidance_distilled) every weight costs one model forward per step instead of two
 WEIGHT_GUIDANC = 0.01
 X0_IDX = 64 # range:[0,99]
 ITERATIONS = 50
@@ -33,52 +35,12 @@ HORIZON = 8
 U_SAVED_PATH = '/root/cartpoleDiff/cartpole_inference_u_results'
 
 # cart pole dynamics
+CART_POLE_DYNAMICS = DiscreteLinearDynamics(LINEAR_A, LINEAR_B, LINEAR_TS)
+
+
 def cart_pole_dynamics(x, u):
-    A = np.array([
-    [0, 1, 0, 0],
-    [0, -0.1, 3, 0],
-    [0, 0, 0, 1],
-    [0, -0.5, 30, 0]
-    ])
-
-    B = np.array([
-    [0],
-    [2],
-    [0],
-    [5]
-    ])
-
-    C = np.eye(4)
-
-    D = np.zeros((4,1))
-
-    # state space equation
-    sys_continuous = control.ss(A, B, C, D)
-
-    # sampling time
-    Ts = 0.1
-
-    # convert to discrete time dynamics
-    sys_discrete = control.c2d(sys_continuous, Ts, method='zoh')
-
-    A_d = sys_discrete.A
-    B_d = sys_discrete.B
-    C_d = sys_discrete.C
-    D_d = sys_discrete.D
-
-    # States
-    x_pos = x[0]
-    x_dot = x[1]
-    theta = x[2]
-    theta_dot = x[3]
-
-    x_next = ca.vertcat(
-        A_d[0,0]*x_pos + A_d[0,1]*x_dot + A_d[0,2]*theta + A_d[0,3]*theta_dot + B_d[0,0]*u,
-        A_d[1,0]*x_pos + A_d[1,1]*x_dot + A_d[1,2]*theta + A_d[1,3]*theta_dot + B_d[1,0]*u,
-        A_d[2,0]*x_pos + A_d[2,1]*x_dot + A_d[2,2]*theta + A_d[2,3]*theta_dot + B_d[2,0]*u,
-        A_d[3,0]*x_pos + A_d[3,1]*x_dot + A_d[3,2]*theta + A_d[3,3]*theta_dot + B_d[3,0]*u,
-    )
-    return x_next
+    # discretized once at import, instead of control.ss + control.c2d at every call
+    return CART_POLE_DYNAMICS.step_casadi(x, u)
 
 
 @single_experiment_yaml
@@ -91,8 +53,16 @@ def experiment(
 
     n_samples: int = 1,
 
+    context_weight: float = WEIGHT_GUIDANC,
+
     n_diffusion_steps_without_noise: int = 5,
 
+    # DDIM (respaced) sampling
+    ddim: bool = False,
+    n_ddim_steps: int = 10,
+    ddim_eta: float = 0.,
+    timestep_respacing: str = 'uniform',  # 'uniform', 'quadratic'
+
     ##############################################################
     device: str = 'cuda',
 
@@ -132,14 +102,9 @@ def experiment(
     args = load_params_from_yaml(os.path.join(model_dir, "args.yaml"))
 
     #################################################################
-    # Load dataset
-    train_subset, train_dataloader, val_subset, val_dataloader = get_dataset(
-        dataset_class='InputsDataset',
-        **args,
-        tensor_args=tensor_args
-    )
-    dataset = train_subset.dataset
-    print(f'dataset -- {len(dataset)}')
+    # Load the normalizer saved with the model (the training data is not needed)
+    dataset = get_normalizer(model_dir=model_dir, **args, tensor_args=tensor_args)
+    print(f'dataset -- {dataset}')
 
     n_support_points = dataset.n_support_points
     print(f'n_support_points -- {n_support_points}')
@@ -169,6 +134,21 @@ def experiment(
     #initial context
     x0 = np.array([[x_0 , 0, theta_0, 0]])  # np.array([[x_0 , 0, theta_0, 0]])  
 
+    ############################################################################
+    # diffusion policy: the model is loaded, compiled and warmed up once
+    policy = DiffusionPolicy(
+        model_dir=model_dir,
+        context_weight=context_weight,
+        n_samples=n_samples,
+        dataset=dataset,
+        tensor_args=tensor_args,
+        n_diffusion_steps_without_noise=n_diffusion_steps_without_noise,
+        ddim=ddim,
+        n_sampling_steps=n_ddim_steps,
+        eta=ddim_eta,
+        timestep_respacing=timestep_respacing,
+    )
+
     ############################################################################
     # sampling loop
     num_loop = ITERATIONS
@@ -181,58 +161,13 @@ def experiment(
     for i in range(0, num_loop):
         x0 = torch.tensor(x0).to(device) # load data to cuda
 
-        hard_conds = None
-        context = dataset.normalize_condition(x0)
-        context_weight = WEIGHT_GUIDANC
-
-        #########################################################################
-        # Load prior model
-        diffusion_configs = dict(
-            variance_schedule=args['variance_schedule'],
-            n_diffusion_steps=args['n_diffusion_steps'],
-            predict_epsilon=args['predict_epsilon'],
-        )
-        unet_configs = dict(
-            state_dim=dataset.state_dim,
-            n_support_points=dataset.n_support_points,
-            unet_input_dim=args['unet_input_dim'],
-            dim_mults=UNET_DIM_MULTS[args['unet_dim_mults_option']],
-        )
-        diffusion_model = get_model(
-            model_class=args['diffusion_model_class'],
-            model=ConditionedTemporalUnet(**unet_configs),
-            tensor_args=tensor_args,
-            **diffusion_configs,
-            **unet_configs
-        )
-        # 'ema_model_current_state_dict.pth'
-        diffusion_model.load_state_dict(
-            torch.load(os.path.join(model_dir, 'checkpoints', 'ema_model_current_state_dict.pth' if args['use_ema'] else 'model_current_state_dict.pth'),
-            map_location=tensor_args['device'])
-        )
-        diffusion_model.eval()
-        model = diffusion_model
-
-        model = torch.compile(model)
-
-
         ########
         # Sample u with classifier-free-guidance (CFG) diffusion model
         with TimerCUDA() as timer_model_sampling:
-            inputs_normalized_iters = model.run_CFG(
-                context, hard_conds, context_weight,
-                n_samples=n_samples, horizon=n_support_points,
-                return_chain=True,
-                sample_fn=ddpm_cart_pole_sample_fn,
-                n_diffusion_steps_without_noise=n_diffusion_steps_without_noise,
-            )
+            inputs_final = policy.act(x0)
         print(f't_model_sampling: {timer_model_sampling.elapsed:.3f} sec')
         # t_total = timer_model_sampling.elapsed
 
-        ########
-        inputs_iters = dataset.unnormalize_states(inputs_normalized_iters)
-
-        inputs_final = inputs_iters[-1]
         print(f'control_inputs -- {inputs_final}')
 
         print(f'\n--------------------------------------\n')
@@ -366,7 +301,7 @@ def experiment(
 
     ########################## Diffusion & MPC Control Inputs Results Saving ################################
 
-    results_folder = os.path.join(U_SAVED_PATH, 'model_'+ str(MODEL_ID), 'Weight_'+ str(WEIGHT_GUIDANC), 'x0_'+ str(X0_IDX))
+    results_folder = os.path.join(U_SAVED_PATH, 'model_'+ str(MODEL_ID), 'Weight_'+ str(context_weight), 'x0_'+ str(X0_IDX))
     os.makedirs(results_folder, exist_ok=True)
     
     # save the first u 
@@ -427,7 +362,7 @@ def experiment(
     plt.grid()
     # plt.show()
     # save figure 
-    figure_name = 'w_' + str(WEIGHT_GUIDANC) + 'x0_' + str(X0_IDX) + 'steps_' + str(ITERATIONS) + '.png'
+    figure_name = 'w_' + str(context_weight) + 'x0_' + str(X0_IDX) + 'steps_' + str(ITERATIONS) + '.png'
     figure_path = os.path.join(results_dir, figure_name)
     plt.savefig(figure_path)
 
@@ -13,6 +13,7 @@ from experiment_launcher import single_experiment_yaml, run_experiment
 from mpd.models import ConditionedTemporalUnet, UNET_DIM_MULTS
 from mpd.models.diffusion_models.sample_functions import guide_gradient_steps, ddpm_sample_fn, ddpm_cart_pole_sample_fn
 from mpd.trainer import get_dataset, get_model,get_specified_dataset
+from mpd.controllers import get_cart_pole_nmpc
 from mpd.utils.loading import load_params_from_yaml
 from torch_robotics.torch_utils.seed import fix_random_seed
 from torch_robotics.torch_utils.torch_timer import TimerCUDA
@@ -129,49 +130,13 @@ def dynamic_update_virtual_Casadi(x, u) -> ca.vertcat:
 
 
 def MPC_Solve( system_update, system_dynamic, x0:np.array, initial_guess_x:float, initial_guess_u:float, num_state:int, horizon:int, Q_cost:np.array, R_cost:float, ts: float, opts_setting ):
-    # casadi_Opti
-    optimizer_normal = ca.Opti()
-    
-    ##### normal mpc #####  
-    # x and u mpc prediction along N
-    X_pre = optimizer_normal.variable(num_state, horizon + 1) 
-    U_pre = optimizer_normal.variable(1, horizon)
-    # set intial guess
-    optimizer_normal.set_initial(X_pre, initial_guess_x)
-    optimizer_normal.set_initial(U_pre, initial_guess_u)
-
-    optimizer_normal.subject_to(X_pre[:, 0] == x0)  # starting state
-
-    # cost 
-    cost = 0
-
-    # initial cost
-    cost += Q_cost[0,0]*X_pre[0, 0]**2 + Q_cost[1,1]*X_pre[1, 0]**2 + Q_cost[2,2]*X_pre[2, 0]**2 + Q_cost[3,3]*X_pre[3, 0]**2 + Q_cost[4,4]*X_pre[4, 0]**2
-
-    # state cost
-    for k in range(0,HORIZON-1):
-        x_next = system_update(system_dynamic,ts,X_pre[:, k],U_pre[:, k])
-        optimizer_normal.subject_to(X_pre[:, k + 1] == x_next)
-        cost += Q_cost[0,0]*X_pre[0, k+1]**2 + Q_cost[1,1]*X_pre[1, k+1]**2 + Q_cost[2,2]*X_pre[2, k+1]**2 + Q_cost[3,3]*X_pre[3, k+1]**2 + Q_cost[4,4]*X_pre[4, k+1]**2 + R_cost * U_pre[:, k]**2
-
-    # terminal cost
-    x_terminal = system_update(system_dynamic,ts,X_pre[:, horizon-1],U_pre[:, horizon-1])
-    optimizer_normal.subject_to(X_pre[:, horizon] == x_terminal)
-    cost += P[0,0]*X_pre[0, HORIZON]**2 + P[1,1]*X_pre[1, HORIZON]**2 + P[2,2]*X_pre[2, HORIZON]**2 + P[3,3]*X_pre[3, HORIZON]**2 + P[4,4]*X_pre[4, HORIZON]**2 + R_cost * U_pre[:, HORIZON-1]**2
-
-    optimizer_normal.minimize(cost)
-    optimizer_normal.solver('ipopt',opts_setting)
+    # the NLP is built once per process and (dynamics, horizon, Q, R, P, Ts), later calls only update x0 and re-solve
+    nmpc = get_cart_pole_nmpc(system_update, system_dynamic, num_state, horizon, Q_cost, R_cost, P, ts, opts_setting)
 
     with TimerCUDA() as t_NMPC_sampling:
-        sol = optimizer_normal.solve()
+        X_sol, U_sol, Cost_sol = nmpc.solve(x0, initial_guess_x, initial_guess_u)
     print(f't_MPC_sampling: {t_NMPC_sampling.elapsed:.4f} sec')
     single_NMPC_time = np.round(t_NMPC_sampling.elapsed,4)
-    # NMPC_total_time += single_MPC_time
-
-    # sol = optimizer_normal.solve()
-    X_sol = sol.value(X_pre)
-    U_sol = sol.value(U_pre)
-    Cost_sol = sol.value(cost)
     return X_sol, U_sol, Cost_sol, single_NMPC_time
 
 
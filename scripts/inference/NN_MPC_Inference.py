@@ -14,6 +14,7 @@ from mpd.models import ConditionedTemporalUnet, UNET_DIM_MULTS
 from mpd.models.diffusion_models.sample_functions import guide_gradient_steps, ddpm_sample_fn, ddpm_cart_pole_sample_fn
 from mpd.trainer import get_dataset, get_model
 from mpd.utils.loading import load_params_from_yaml
+from mpd.envs import DiscreteLinearDynamics, LINEAR_A, LINEAR_B, LINEAR_TS
 from torch_robotics.torch_utils.seed import fix_random_seed
 from torch_robotics.torch_utils.torch_timer import TimerCUDA
 from torch_robotics.torch_utils.torch_utils import get_torch_device, freeze_torch_model_params
@@ -62,52 +63,12 @@ class AMPCNet_Inference(nn.Module):
         return x
 
 # cart pole dynamics
+CART_POLE_DYNAMICS = DiscreteLinearDynamics(LINEAR_A, LINEAR_B, LINEAR_TS)
+
+
 def cart_pole_dynamics(x, u):
-    A = np.array([
-    [0, 1, 0, 0],
-    [0, -0.1, 3, 0],
-    [0, 0, 0, 1],
-    [0, -0.5, 30, 0]
-    ])
-
-    B = np.array([
-    [0],
-    [2],
-    [0],
-    [5]
-    ])
-
-    C = np.eye(4)
-
-    D = np.zeros((4,1))
-
-    # state space equation
-    sys_continuous = control.ss(A, B, C, D)
-
-    # sampling time
-    Ts = 0.1
-
-    # convert to discrete time dynamics
-    sys_discrete = control.c2d(sys_continuous, Ts, method='zoh')
-
-    A_d = sys_discrete.A
-    B_d = sys_discrete.B
-    C_d = sys_discrete.C
-    D_d = sys_discrete.D
-
-    # States
-    x_pos = x[0]
-    x_dot = x[1]
-    theta = x[2]
-    theta_dot = x[3]
-
-    x_next = ca.vertcat(
-        A_d[0,0]*x_pos + A_d[0,1]*x_dot + A_d[0,2]*theta + A_d[0,3]*theta_dot + B_d[0,0]*u,
-        A_d[1,0]*x_pos + A_d[1,1]*x_dot + A_d[1,2]*theta + A_d[1,3]*theta_dot + B_d[1,0]*u,
-        A_d[2,0]*x_pos + A_d[2,1]*x_dot + A_d[2,2]*theta + A_d[2,3]*theta_dot + B_d[2,0]*u,
-        A_d[3,0]*x_pos + A_d[3,1]*x_dot + A_d[3,2]*theta + A_d[3,3]*theta_dot + B_d[3,0]*u,
-    )
-    return x_next
+    # discretized once at import, instead of control.ss + control.c2d at every call
+    return CART_POLE_DYNAMICS.step_casadi(x, u)
 
 
 @single_experiment_yaml
@@ -312,12 +273,8 @@ def experiment(
         u_horizon_track[i,:] = horizon_inputs
 
         # update states along the horizon
-        x_updated_by_u[0,:] = x0
         x0_horizon = np.squeeze(x0.numpy())
-        for z in range(0,horizon_inputs.shape[1]):
-            x_horizon_update = cart_pole_dynamics(x0_horizon, horizon_inputs[0,z])
-            x_updated_by_u[z+1,:] = x_horizon_update.T
-            x0_horizon = x_horizon_update
+        x_updated_by_u = CART_POLE_DYNAMICS.rollout_numpy(x0_horizon, horizon_inputs[0])
         x_horizon_track[i,:,:] = np.round(x_updated_by_u, decimals=4)
 
         # update cart pole state
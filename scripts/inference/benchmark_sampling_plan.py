@@ -0,0 +1,67 @@
+import torch
+
+from mpd.models import UNET_DIM_MULTS, ConditionedTemporalUnet
+from mpd.models.diffusion_models.temporal_unet import X_SIZE
+from mpd.trainer import get_model
+from torch_robotics.torch_utils.seed import fix_random_seed
+from torch_robotics.torch_utils.torch_timer import TimerCUDA
+from torch_robotics.torch_utils.torch_utils import get_torch_device
+
+############### Seetings ######################
+# latency of the cart pole DDPM sampler with the precomputed sampling plan against the generic per-step loop
+# (same seed, same samples up to float rounding), untrained model of the default architecture
+
+DEVICE = 'cuda'
+N_DIFFUSION_STEPS = 25
+N_DIFFUSION_STEPS_WITHOUT_NOISE = 5
+HORIZON = 8
+STATE_DIM = 1
+UNET_INPUT_DIM = 32
+UNET_DIM_MULTS_OPTION = 1
+WEIGHT_GUIDANC = 0.01
+BATCH_SIZES = [1, 25, 256]
+N_REPEATS = 50
+
+
+def Sample(model, context, use_sampling_plan, seed):
+    torch.manual_seed(seed)
+    return model.run_CFG(context, None, WEIGHT_GUIDANC, n_samples=context.shape[0], horizon=HORIZON,
+                         n_diffusion_steps_without_noise=N_DIFFUSION_STEPS_WITHOUT_NOISE,
+                         use_sampling_plan=use_sampling_plan)
+
+
+if __name__ == "__main__":
+    fix_random_seed(0)
+    device = get_torch_device(device=DEVICE)
+    tensor_args = {'device': device, 'dtype': torch.float32}
+
+    unet_configs = dict(
+        state_dim=STATE_DIM,
+        n_support_points=HORIZON,
+        unet_input_dim=UNET_INPUT_DIM,
+        dim_mults=UNET_DIM_MULTS[UNET_DIM_MULTS_OPTION],
+    )
+    model = get_model(
+        model_class='GaussianDiffusionModel',
+        model=ConditionedTemporalUnet(**unet_configs),
+        tensor_args=tensor_args,
+        n_diffusion_steps=N_DIFFUSION_STEPS,
+        predict_epsilon=True,
+        **unet_configs
+    )
+    model.eval()
+
+    print(f'\n----- sampling plan vs per-step loop ({N_DIFFUSION_STEPS} + {N_DIFFUSION_STEPS_WITHOUT_NOISE} steps)')
+    for batch_size in BATCH_SIZES:
+        context = torch.randn((batch_size, X_SIZE), **tensor_args)
+        max_abs_diff = (Sample(model, context, True, 0) - Sample(model, context, False, 0)).abs().max().item()
+
+        times = {}
+        for use_sampling_plan in (False, True):
+            Sample(model, context, use_sampling_plan, 0)  # warm up (plan construction)
+            with TimerCUDA() as t:
+                for i in range(N_REPEATS):
+                    Sample(model, context, use_sampling_plan, i)
+            times[use_sampling_plan] = t.elapsed / N_REPEATS
+        print(f'batch {batch_size:4d}: loop {times[False] * 1e3:8.2f} ms  plan {times[True] * 1e3:8.2f} ms  '
+              f'speedup x{times[False] / times[True]:.2f}  max abs diff {max_abs_diff:.2e}')
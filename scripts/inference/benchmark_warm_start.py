@@ -0,0 +1,66 @@
+import os
+
+import numpy as np
+import torch
+
+from mpd.envs import CartPoleVecEnv
+from mpd.inference import DiffusionPolicy, rollout_policy_batched
+from mpd.trainer import get_normalizer
+from mpd.utils.loading import load_params_from_yaml
+from torch_robotics.torch_utils.seed import fix_random_seed
+from torch_robotics.torch_utils.torch_utils import get_torch_device
+
+############### Seetings ######################
+# closed loop cost and sampling time of the receding horizon warm start (shifted previous plan, partially noised,
+# last k denoising steps) against cold sampling from pure noise, on the same grid of initial states
+
+MODEL_PATH = '/root/cartpoleDiff/cart_pole_diffusion_based_on_MPD/trained_models/180000_training_data/100000' # the absolute path of the trained model
+DEVICE = 'cuda'
+DYNAMICS = 'linear'  # 'linear': 4 state LMPC cart pole, 'nonlinear': 5 state NMPC cart pole
+POSITION_INITIAL_RANGE = np.linspace(-1,1,5)
+THETA_INITIAL_RANGE = np.linspace(-np.pi/4,np.pi/4,5)
+WEIGHT_GUIDANC = 0.01 # non-conditioning weight
+ITERATIONS = 50 # control loop (steps)
+N_DIFFUSION_STEPS_WITHOUT_NOISE = 5
+WARM_START_STEPS = [None, 20, 10, 5, 2]  # None: cold sampling
+
+# closed loop cost (same weights as the MPC of each model)
+Q = {'linear': np.diag([10, 1, 10, 1]), 'nonlinear': np.diag([0.01, 0.01, 0, 0.001, 1000.0])}
+R = {'linear': 1., 'nonlinear': 0.1}
+
+
+if __name__ == "__main__":
+    fix_random_seed(30)
+    device = get_torch_device(device=DEVICE)
+    tensor_args = {'device': device, 'dtype': torch.float32}
+
+    args = load_params_from_yaml(os.path.join(MODEL_PATH, "args.yaml"))
+    dataset = get_normalizer(model_dir=MODEL_PATH, **args, tensor_args=tensor_args)
+
+    # one policy (compiled once), k is changed between the runs
+    policy = DiffusionPolicy(
+        model_dir=MODEL_PATH,
+        context_weight=WEIGHT_GUIDANC,
+        dataset=dataset,
+        tensor_args=tensor_args,
+        n_diffusion_steps_without_noise=N_DIFFUSION_STEPS_WITHOUT_NOISE,
+    )
+
+    env = CartPoleVecEnv(dynamics=DYNAMICS, tensor_args=tensor_args)
+    x0_grid = CartPoleVecEnv.initial_state_grid(POSITION_INITIAL_RANGE, THETA_INITIAL_RANGE, dynamics=DYNAMICS)
+
+    print(f'\n----- warm start vs cold sampling ({len(x0_grid)} initial states, {ITERATIONS} steps, '
+          f'{args["n_diffusion_steps"]} diffusion steps)')
+    cold_metrics = None
+    for k in WARM_START_STEPS:
+        fix_random_seed(30)
+        policy.warm_start_steps = k
+        metrics = rollout_policy_batched(policy, env, x0_grid, ITERATIONS, Q=Q[DYNAMICS], R=R[DYNAMICS])['metrics']
+        if cold_metrics is None:
+            cold_metrics = metrics
+        name = 'cold' if k is None else f'warm k={k}'
+        print(f'{name:<12} cost {metrics["cost_mean"]:10.3f} (x{metrics["cost_mean"] / cold_metrics["cost_mean"]:.3f})  '
+              f'max {metrics["cost_max"]:10.3f}  '
+              f'final |x| {metrics["final_state_norm_mean"]:.4f}  '
+              f'{metrics["sampling_time_per_step_mean"] * 1e3:8.2f} ms/step '
+              f'(x{cold_metrics["sampling_time_per_step_mean"] / metrics["sampling_time_per_step_mean"]:.2f})')
@@ -15,10 +15,9 @@ from einops._torch_specific import allow_ops_in_compiled_graph  # requires einop
 
 from experiment_launcher import single_experiment_yaml, run_experiment
 from mp_baselines.planners.costs.cost_functions import CostCollision, CostComposite, CostGPTrajectory
-from mpd.models import ConditionedTemporalUnet, UNET_DIM_MULTS
 from mpd.models.diffusion_models.guides import GuideManagerCartPole
-from mpd.models.diffusion_models.sample_functions import guide_gradient_steps, ddpm_sample_fn, ddpm_cart_pole_sample_fn
-from mpd.trainer import get_dataset, get_model
+from mpd.inference import DiffusionPolicy
+from mpd.trainer import get_normalizer
 from mpd.utils.loading import load_params_from_yaml
 from torch_robotics.robots import RobotPanda
 from torch_robotics.torch_utils.seed import fix_random_seed
@@ -56,6 +55,12 @@ def experiment(
     n_guide_steps: int = 1,
     n_diffusion_steps_without_noise: int = 5,
 
+    # DDIM (respaced) sampling
+    ddim: bool = False,
+    n_ddim_steps: int = 10,
+    ddim_eta: float = 0.,
+    timestep_respacing: str = 'uniform',  # 'uniform', 'quadratic'
+
     weight_grad_cost_collision: float = 1e-2, # 
     weight_grad_cost_smoothness: float = 1e-7,
 
@@ -109,15 +114,9 @@ def experiment(
     args = load_params_from_yaml(os.path.join(model_dir, "args.yaml"))
 
     ########################################################################################################################
-    # Load dataset with env, robot, task
-    train_subset, train_dataloader, val_subset, val_dataloader = get_dataset(
-        dataset_class='InputsDataset',
-        **args,
-        tensor_args=tensor_args
-    )
-    dataset = train_subset.dataset
-    # print(f'train -- {train_subset}')
-    print(f'dataset -- {len(dataset)}')
+    # Load the normalizer saved with the model (the training data is not needed)
+    dataset = get_normalizer(model_dir=model_dir, **args, tensor_args=tensor_args)
+    print(f'dataset -- {dataset}')
 
     n_support_points = dataset.n_support_points
     print(f'n_support_points -- {n_support_points}')
@@ -194,64 +193,32 @@ def experiment(
     x0 = torch.tensor(x0)
     # print(f'x0 -- {x0}')
     # print(f'x0 -- {x0.size()}')
-    hard_conds = None
-    context = dataset.normalize_condition(x0)
-    context_mask  = torch.zeros(context.size(0),1).to(device) # context_mask=1: drop_prob in sampling = 1 and 0
     context_weight = 8
 
     ########################################################################################################################
-    # Load prior model
-    diffusion_configs = dict(
-        variance_schedule=args['variance_schedule'],
-        n_diffusion_steps=args['n_diffusion_steps'],
-        predict_epsilon=args['predict_epsilon'],
-    )
-    unet_configs = dict(
-        state_dim=dataset.state_dim,
-        n_support_points=dataset.n_support_points,
-        unet_input_dim=args['unet_input_dim'],
-        dim_mults=UNET_DIM_MULTS[args['unet_dim_mults_option']],
-    )
-    diffusion_model = get_model(
-        model_class=args['diffusion_model_class'],
-        model=ConditionedTemporalUnet(**unet_configs),
+    # diffusion policy: the model is loaded, compiled and warmed up once
+    policy = DiffusionPolicy(
+        model_dir=model_dir,
+        context_weight=context_weight,
+        n_samples=n_samples,
+        dataset=dataset,
         tensor_args=tensor_args,
-        **diffusion_configs,
-        **unet_configs
+        n_diffusion_steps_without_noise=n_diffusion_steps_without_noise,
+        ddim=ddim,
+        n_sampling_steps=n_ddim_steps,
+        eta=ddim_eta,
+        timestep_respacing=timestep_respacing,
     )
-    # 'ema_model_current_state_dict.pth'
-    diffusion_model.load_state_dict(
-        torch.load(os.path.join(model_dir, 'checkpoints', 'ema_model_current_state_dict.pth' if args['use_ema'] else 'model_current_state_dict.pth'),
-        map_location=tensor_args['device'])
-    )
-    diffusion_model.eval()
-    model = diffusion_model
-    # print(f'Diffusion_Model -- {model}')
-
-    freeze_torch_model_params(model)
-    model = torch.compile(model)
-    model.warmup_CFG(horizon=n_support_points, device=device, context = context, context_mask=context_mask)
 
 
     ########
     # Sample trajectories with the diffusion/cvae model
     with TimerCUDA() as timer_model_sampling:
-        inputs_normalized_iters = model.run_CFG(
-            context, hard_conds, context_weight,
-            n_samples=n_samples, horizon=n_support_points,
-            return_chain=True,
-            sample_fn=ddpm_cart_pole_sample_fn,
-            # **sample_fn_kwargs,
-            n_diffusion_steps_without_noise=n_diffusion_steps_without_noise,
-            # ddim=True
-        )
+        inputs_final = policy.act(x0)
     print(f't_model_sampling: {timer_model_sampling.elapsed:.3f} sec')
     t_total = timer_model_sampling.elapsed
 
     ########
-    inputs_iters = dataset.unnormalize_states(inputs_normalized_iters)
-
-    inputs_final = inputs_iters[-1]
     print(f'control_inputs -- {inputs_final}')
 
     # return inputs_final
@@ -0,0 +1,71 @@
+import os
+
+import numpy as np
+import torch
+
+from mpd.envs import CartPoleVecEnv
+from mpd.inference import DiffusionPolicy, rollout_policy_batched
+from mpd.utils.loading import load_params_from_yaml
+from torch_robotics.torch_utils.seed import fix_random_seed
+from torch_robotics.torch_utils.torch_utils import get_torch_device
+
+############### Seetings ######################
+# closed loop cost and per step latency of the progressively distilled students (cart_pole_distill.py) against the
+# teacher (full DDPM, and guided DDIM with the same number of steps as each student), on the x0 grid
+
+TEACHER_MODEL_PATH = '/root/cartpoleDiff/cart_pole_diffusion_based_on_MPD/trained_models/180000_training_data/100000'
+DISTILLATION_RESULTS_PATH = '/root/cartpoleDiff/cart_pole_diffusion_based_on_MPD/logs/distillation/0' # results_dir of cart_pole_distill.py
+DEVICE = 'cuda'
+DYNAMICS = 'linear'  # 'linear': 4 state LMPC cart pole, 'nonlinear': 5 state NMPC cart pole
+POSITION_INITIAL_RANGE = np.linspace(-1,1,5)
+THETA_INITIAL_RANGE = np.linspace(-np.pi/4,np.pi/4,5)
+WEIGHT_GUIDANC = 0.01 # guidance weight of the teacher (the one distilled into the students)
+ITERATIONS = 50 # control loop (steps)
+N_DIFFUSION_STEPS_WITHOUT_NOISE = 5
+
+# closed loop cost (same weights as the MPC of each model)
+Q = {'linear': np.diag([10, 1, 10, 1]), 'nonlinear': np.diag([0.01, 0.01, 0, 0.001, 1000.0])}
+R = {'linear': 1., 'nonlinear': 0.1}
+
+
+def Evaluate(name, policy, env, x0_grid, unet_calls_per_step):
+    fix_random_seed(30)
+    metrics = rollout_policy_batched(policy, env, x0_grid, ITERATIONS, Q=Q[DYNAMICS], R=R[DYNAMICS])['metrics']
+    print(f'{name:<28} cost {metrics["cost_mean"]:10.3f}  max {metrics["cost_max"]:10.3f}  '
+          f'final |x| {metrics["final_state_norm_mean"]:.4f}  '
+          f'{metrics["sampling_time_per_step_mean"] * 1e3:8.2f} ms/step  {unet_calls_per_step:3d} unet calls/step')
+    return metrics
+
+
+if __name__ == "__main__":
+    device = get_torch_device(device=DEVICE)
+    tensor_args = {'device': device, 'dtype': torch.float32}
+
+    env = CartPoleVecEnv(dynamics=DYNAMICS, tensor_args=tensor_args)
+    x0_grid = CartPoleVecEnv.initial_state_grid(POSITION_INITIAL_RANGE, THETA_INITIAL_RANGE, dynamics=DYNAMICS)
+
+    student_dirs = sorted(
+        (os.path.join(DISTILLATION_RESULTS_PATH, d) for d in os.listdir(DISTILLATION_RESULTS_PATH)
+         if d.startswith('round_')),
+        key=lambda d: int(d.rsplit('_', 1)[-1])
+    )
+    teacher_args = load_params_from_yaml(os.path.join(TEACHER_MODEL_PATH, 'args.yaml'))
+
+    print(f'\n----- distilled students vs teacher ({len(x0_grid)} initial states, {ITERATIONS} steps)')
+    # teacher: ddpm over all diffusion steps (the fused cfg batch is one unet call)
+    teacher = DiffusionPolicy(model_dir=TEACHER_MODEL_PATH, context_weight=WEIGHT_GUIDANC, tensor_args=tensor_args,
+                              n_diffusion_steps_without_noise=N_DIFFUSION_STEPS_WITHOUT_NOISE)
+    Evaluate('teacher ddpm', teacher, env, x0_grid,
+             teacher_args['n_diffusion_steps'] + N_DIFFUSION_STEPS_WITHOUT_NOISE)
+
+    for student_dir in student_dirs:
+        student = DiffusionPolicy(model_dir=student_dir, tensor_args=tensor_args)
+        n_steps = len(student.args['distilled_timesteps'])
+
+        # same number of guided DDIM steps with the teacher
+        teacher = DiffusionPolicy(model_dir=TEACHER_MODEL_PATH, context_weight=WEIGHT_GUIDANC, tensor_args=tensor_args,
+                                  ddim=True, n_sampling_steps=n_steps,
+                                  timestep_respacing=list(student.args['distilled_timesteps']))
+        Evaluate(f'teacher ddim {n_steps} steps', teacher, env, x0_grid, n_steps)
+        Evaluate(f'student {n_steps} steps (round {student.args["distillation_round"]})', student, env, x0_grid,
+                 n_steps)
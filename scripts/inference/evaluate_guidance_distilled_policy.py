@@ -0,0 +1,51 @@
+import numpy as np
+import torch
+
+from mpd.envs import CartPoleVecEnv
+from mpd.inference import DiffusionPolicy, rollout_policy_batched
+from torch_robotics.torch_utils.seed import fix_random_seed
+from torch_robotics.torch_utils.torch_utils import get_torch_device
+
+############### Seetings ######################
+# guidance weight sweep: closed loop cost and per step latency of the guidance distilled model
+# (cart_pole_guidance_distill.py, one forward pass per step) against the cfg teacher (conditional + unconditional)
+
+TEACHER_MODEL_PATH = '/root/cartpoleDiff/cart_pole_diffusion_based_on_MPD/trained_models/180000_training_data/100000'
+STUDENT_MODEL_PATH = '/root/cartpoleDiff/cart_pole_diffusion_based_on_MPD/logs/guidance_distillation/0/guidance_distilled'
+DEVICE = 'cuda'
+DYNAMICS = 'linear'  # 'linear': 4 state LMPC cart pole, 'nonlinear': 5 state NMPC cart pole
+POSITION_INITIAL_RANGE = np.linspace(-1,1,5)
+THETA_INITIAL_RANGE = np.linspace(-np.pi/4,np.pi/4,5)
+WEIGHTS_GUIDANC = [0., 0.01, 0.1, 0.5, 1.0]
+ITERATIONS = 50 # control loop (steps)
+N_DIFFUSION_STEPS_WITHOUT_NOISE = 5
+
+# closed loop cost (same weights as the MPC of each model)
+Q = {'linear': np.diag([10, 1, 10, 1]), 'nonlinear': np.diag([0.01, 0.01, 0, 0.001, 1000.0])}
+R = {'linear': 1., 'nonlinear': 0.1}
+
+
+if __name__ == "__main__":
+    device = get_torch_device(device=DEVICE)
+    tensor_args = {'device': device, 'dtype': torch.float32}
+
+    env = CartPoleVecEnv(dynamics=DYNAMICS, tensor_args=tensor_args)
+    x0_grid = CartPoleVecEnv.initial_state_grid(POSITION_INITIAL_RANGE, THETA_INITIAL_RANGE, dynamics=DYNAMICS)
+
+    # the guidance weight is changed between the runs, the models are compiled once
+    policies = {
+        'cfg teacher': DiffusionPolicy(model_dir=TEACHER_MODEL_PATH, tensor_args=tensor_args,
+                                       n_diffusion_steps_without_noise=N_DIFFUSION_STEPS_WITHOUT_NOISE),
+        'guidance distilled': DiffusionPolicy(model_dir=STUDENT_MODEL_PATH, tensor_args=tensor_args,
+                                              n_diffusion_steps_without_noise=N_DIFFUSION_STEPS_WITHOUT_NOISE),
+    }
+
+    print(f'\n----- guidance weight sweep ({len(x0_grid)} initial states, {ITERATIONS} steps)')
+    for w in WEIGHTS_GUIDANC:
+        for name, policy in policies.items():
+            fix_random_seed(30)
+            policy.context_weight = w
+            metrics = rollout_policy_batched(policy, env, x0_grid, ITERATIONS, Q=Q[DYNAMICS], R=R[DYNAMICS])['metrics']
+            print(f'w={w:<6} {name:<20} cost {metrics["cost_mean"]:10.3f}  max {metrics["cost_max"]:10.3f}  '
+                  f'final |x| {metrics["final_state_norm_mean"]:.4f}  '
+                  f'{metrics["sampling_time_per_step_mean"] * 1e3:8.2f} ms/step')
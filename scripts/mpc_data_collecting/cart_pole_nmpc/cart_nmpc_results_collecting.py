@@ -8,6 +8,9 @@ import time
 from multiprocessing import Pool, Manager, Array
 import multiprocessing
 
+from mpd.controllers import get_cart_pole_nmpc
+from mpd.datasets.shard_store import ShardStore, SHARD_STORE_DIR_NAME
+
 ############### Seetings ######################
 # Attention: this py file can only set the initial range of position and theta, initial x_dot and theta_dot are always 0
 
@@ -17,6 +20,13 @@ MAX_CORE_CPU = 25
 SAVE_PATH =  "/MPC_DynamicSys/sharedVol/train_data/nmpc/multi_normal"
 FOLDER_PATH = '/root/cartpoleDiff/cart_pole_diffusion_based_on_MPD/training_data_collecting/nmpc_cart_pole_collecting'
 
+# every group is appended by its worker as one shard (u, x0, j) to the sharded dataset store (meta: idx_group,
+# size_normal_data), no concatenation of per index files afterwards. The shards are appended in completion order, the
+# store is read in the layout of the full file (normal data of the groups in idx_group order, then the noisy data)
+SHARD_STORE_PATH = os.path.join(FOLDER_PATH, SHARD_STORE_DIR_NAME)
+# the per index and the full .pt files (previous format) are still saved until the training configs read the store
+SAVE_FULL_PT_FILES = True
+
 # control steps
 CONTROL_STEPS = 80
 
@@ -187,48 +197,9 @@ def ThetaToRedTheta(theta):
 
 
 def MPC_Solve( system_update, system_dynamic, x0:np.array, initial_guess_x:float, initial_guess_u:float, num_state:int, horizon:int, Q_cost:np.array, R_cost:float, ts: float, opts_setting ):
-    # casadi_Opti
-    optimizer_normal = ca.Opti()
-    
-    ##### normal mpc #####
-    # x and u mpc prediction along N
-    X_pre = optimizer_normal.variable(num_state, horizon + 1) 
-    U_pre = optimizer_normal.variable(1, horizon)
-    # set intial guess
-    optimizer_normal.set_initial(X_pre, initial_guess_x)
-    # optimizer_normal.set_initial(X_pre[0], initial_guess_x)
-    # optimizer_normal.set_initial(X_pre[1], 10*initial_guess_x)
-    # optimizer_normal.set_initial(X_pre[2], initial_guess_x)
-    # optimizer_normal.set_initial(X_pre[3], 10*initial_guess_x)
-    # optimizer_normal.set_initial(X_pre[4], initial_guess_x)
-    optimizer_normal.set_initial(U_pre, initial_guess_u)
-
-    optimizer_normal.subject_to(X_pre[:, 0] == x0)  # starting state
-
-    # cost 
-    cost = 0
-
-    # initial cost
-    cost += Q_cost[0,0]*X_pre[0, 0]**2 + Q_cost[1,1]*X_pre[1, 0]**2 + Q_cost[2,2]*X_pre[2, 0]**2 + Q_cost[3,3]*X_pre[3, 0]**2 + Q_cost[4,4]*X_pre[4, 0]**2
-
-    # state cost
-    for k in range(0,HOR-1):
-        x_next = system_update(system_dynamic,ts,X_pre[:, k],U_pre[:, k])
-        optimizer_normal.subject_to(X_pre[:, k + 1] == x_next)
-        cost += Q_cost[0,0]*X_pre[0, k+1]**2 + Q_cost[1,1]*X_pre[1, k+1]**2 + Q_cost[2,2]*X_pre[2, k+1]**2 + Q_cost[3,3]*X_pre[3, k+1]**2 + Q_cost[4,4]*X_pre[4, k+1]**2 + R_cost * U_pre[:, k]**2
-
-    # terminal cost
-    x_terminal = system_update(system_dynamic,ts,X_pre[:, horizon-1],U_pre[:, horizon-1])
-    optimizer_normal.subject_to(X_pre[:, horizon] == x_terminal)
-    cost += P[0,0]*X_pre[0, HOR]**2 + P[1,1]*X_pre[1, HOR]**2 + P[2,2]*X_pre[2, HOR]**2 + P[3,3]*X_pre[3, HOR]**2 + P[4,4]*X_pre[4, HOR]**2 + R_cost * U_pre[:, HOR-1]**2
-
-    optimizer_normal.minimize(cost)
-    optimizer_normal.solver('ipopt',opts_setting)
-    sol = optimizer_normal.solve()
-    X_sol = sol.value(X_pre)
-    U_sol = sol.value(U_pre)
-    Cost_sol = sol.value(cost)
-    return X_sol, U_sol, Cost_sol
+    # the NLP is built once per process and (dynamics, horizon, Q, R, P, Ts), later calls only update x0 and re-solve
+    nmpc = get_cart_pole_nmpc(system_update, system_dynamic, num_state, horizon, Q_cost, R_cost, P, ts, opts_setting)
+    return nmpc.solve(x0, initial_guess_x, initial_guess_u)
 
 
 # Opt
@@ -332,9 +303,10 @@ def RunMPCForSingle_IniState_IniGuess(x_ini_guess: float, u_ini_guess:float,idx_
         torch_j_ini_memory_tensor = torch.Tensor(j_ini_memory)
         torch_j_random_memory_tensor = torch.Tensor(j_random_memory)
 
-        torch.save(torch_u_ini_memory_tensor, os.path.join(FOLDER_PATH , f'pure_u_data_' + 'idx-' + str(idx_group_of_control_step) + '_test1.pt'))
-        torch.save(torch_x_ini_memory_tensor , os.path.join(FOLDER_PATH , f'pure_x_data_' + 'idx-' + str(idx_group_of_control_step) + '_test1.pt'))
-        torch.save(torch_j_ini_memory_tensor, os.path.join(FOLDER_PATH , f'pure_j_data_' + 'idx-' + str(idx_group_of_control_step) + '_test1.pt'))
+        if SAVE_FULL_PT_FILES:
+            torch.save(torch_u_ini_memory_tensor, os.path.join(FOLDER_PATH , f'pure_u_data_' + 'idx-' + str(idx_group_of_control_step) + '_test1.pt'))
+            torch.save(torch_x_ini_memory_tensor , os.path.join(FOLDER_PATH , f'pure_x_data_' + 'idx-' + str(idx_group_of_control_step) + '_test1.pt'))
+            torch.save(torch_j_ini_memory_tensor, os.path.join(FOLDER_PATH , f'pure_j_data_' + 'idx-' + str(idx_group_of_control_step) + '_test1.pt'))
         
         # cat
         u_data = torch.cat((torch_u_ini_memory_tensor, torch_u_random_memory_tensor), dim=0)
@@ -345,10 +317,16 @@ def RunMPCForSingle_IniState_IniGuess(x_ini_guess: float, u_ini_guess:float,idx_
         print(f'x_size -- {x_data.size()}')
         print(f'j_size -- {j_data.size()}')
 
-        # save data in PT file for training
-        torch.save(u_data, os.path.join(FOLDER_PATH , f'u_data_' + 'idx-' + str(idx_group_of_control_step) + '_test1.pt'))
-        torch.save(x_data, os.path.join(FOLDER_PATH , f'x_data_' + 'idx-' + str(idx_group_of_control_step) + '_test1.pt'))
-        torch.save(j_data, os.path.join(FOLDER_PATH , f'j_data_' + 'idx-' + str(idx_group_of_control_step) + '_test1.pt'))
+        # append the group to the sharded store for training (normal data first, then noisy data)
+        ShardStore(SHARD_STORE_PATH).append(
+            {'u': u_data, 'x0': x_data, 'j': j_data},
+            meta={'idx_group': int(idx_group_of_control_step), 'size_normal_data': len(torch_u_ini_memory_tensor)},
+            dtype='float32'
+        )
+        if SAVE_FULL_PT_FILES:
+            torch.save(u_data, os.path.join(FOLDER_PATH , f'u_data_' + 'idx-' + str(idx_group_of_control_step) + '_test1.pt'))
+            torch.save(x_data, os.path.join(FOLDER_PATH , f'x_data_' + 'idx-' + str(idx_group_of_control_step) + '_test1.pt'))
+            torch.save(j_data, os.path.join(FOLDER_PATH , f'j_data_' + 'idx-' + str(idx_group_of_control_step) + '_test1.pt'))
 
         # plots
         t = np.arange(0, CONTROL_STEPS*TS, TS) # np.arange(len(joint_states[1])) * panda.opt.timestep
@@ -477,10 +455,11 @@ def sub_main():
         # J combine j_normal + j_noisy
         J_training_data = torch.cat((j_all_normal, j_all_noisy), dim=0)
 
-        # data saving
-        torch.save(u_training_data, os.path.join(SAVE_PATH, U_DATA_NAME))
-        torch.save(x0_conditioning_data, os.path.join(SAVE_PATH, X0_CONDITION_DATA_NAME))
-        torch.save(J_training_data, os.path.join(SAVE_PATH, J_DATA_NAME))
+        # data saving (the groups are already in the sharded store)
+        if SAVE_FULL_PT_FILES:
+            torch.save(u_training_data, os.path.join(SAVE_PATH, U_DATA_NAME))
+            torch.save(x0_conditioning_data, os.path.join(SAVE_PATH, X0_CONDITION_DATA_NAME))
+            torch.save(J_training_data, os.path.join(SAVE_PATH, J_DATA_NAME))
 
     # end_time = time.time()
 
@@ -2,6 +2,8 @@ import torch
 import numpy as np
 import os
 
+from mpd.datasets.shard_store import ShardStore, SHARD_STORE_DIR_NAME
+
 IDX_NUM = 50
 FOLDER_PATH = '/root/cartpoleDiff/cart_pole_diffusion_based_on_MPD/training_data_collecting/nmpc_cart_pole_collecting'
 
@@ -22,42 +24,31 @@ data_idxs = np.arange(0, 50, 1)
 for idx in data_idxs:
     print(f'idx -- {idx}')
 
-tensor_u_list = []
-tensor_x_list = []
-tensor_j_list = []
-
-# u data cat
-for idx in data_idxs:
-    file_name = 'pure_u_data_' + 'idx-' + str(idx) + '_test1.pt'
-    file_path = os.path.join(FOLDER_PATH , file_name)
-    tensor = torch.load(file_path)
-    tensor_u_list.append(tensor)
-
-
-concatenated_u_tensor = torch.cat(tensor_u_list, dim=0)
-print(f'u size -- {concatenated_u_tensor.size()}')
-torch.save(concatenated_u_tensor, os.path.join(FOLDER_PATH , f'pure_u_data_' + 'cat' + '_test1.pt'))
-
-# x data cat
-for idx in data_idxs:
-    file_name = 'pure_x_data_' + 'idx-' + str(idx) + '_test1.pt'
-    file_path = os.path.join(FOLDER_PATH , file_name)
-    tensor = torch.load(file_path)
-    tensor_x_list.append(tensor)
-
-
-concatenated_x_tensor = torch.cat(tensor_x_list, dim=0)
-print(f'x size -- {concatenated_x_tensor.size()}')
-torch.save(concatenated_x_tensor, os.path.join(FOLDER_PATH , f'pure_x_data_' + 'cat' + '_test1.pt'))
-
-# j data cat
-for idx in data_idxs:
-    file_name = 'pure_j_data_' + 'idx-' + str(idx) + '_test1.pt'
-    file_path = os.path.join(FOLDER_PATH , file_name)
-    tensor = torch.load(file_path)
-    tensor_j_list.append(tensor)
-
-
-concatenated_j_tensor = torch.cat(tensor_j_list, dim=0)
-print(f'j size -- {concatenated_j_tensor.size()}')
-torch.save(concatenated_j_tensor, os.path.join(FOLDER_PATH , f'pure_j_data_' + 'cat' + '_test1.pt'))
\ No newline at end of file
+# The pure (initial guess only, no noisy data) data of an index is the normal block of its shard in the training store
+# of the collector (first meta size_normal_data rows, ShardStore.get_layout). It is appended as a shard of its own
+# store PURE_SHARD_STORE_PATH (one shard per index) instead of being concatenated and saved as a new full copy, the
+# training store is only read. Indices already in the pure store are skipped, so the script can be run again after
+# each collection round.
+SHARD_STORE_PATH = os.path.join(FOLDER_PATH, SHARD_STORE_DIR_NAME)
+PURE_SHARD_STORE_PATH = os.path.join(FOLDER_PATH, 'pure_' + SHARD_STORE_DIR_NAME)
+
+store = ShardStore(SHARD_STORE_PATH)
+shards = store.read_manifest()['shards']
+fields = {name: store.load_field_shards(name) for name in ('u', 'x0', 'j')}
+
+pure_store = ShardStore(PURE_SHARD_STORE_PATH)
+stored_idxs = {shard['meta'].get('idx_group') for shard in pure_store.read_manifest()['shards']}
+
+collected_idxs = set()
+for i, start, stop in store.get_layout(noisy=False):
+    idx = shards[i]['meta'].get('idx_group')
+    collected_idxs.add(idx)
+    if idx not in data_idxs.tolist() or idx in stored_idxs:
+        continue
+    pure_store.append({name: np.asarray(field[i][start:stop]) for name, field in fields.items()},
+                      meta={'idx_group': idx, 'source': shards[i]['name']}, dtype='float32')
+
+missing_idxs = [idx for idx in data_idxs.tolist() if idx not in collected_idxs]
+if missing_idxs:
+    print(f'indices not collected yet -- {missing_idxs}')
+print(f'samples in pure store -- {len(pure_store)}')
@@ -0,0 +1,26 @@
+import os
+
+from mpd.datasets import convert_inputs_to_memmap, dataset_base_dir, U_DATA_NAME, X0_CONDITION_DATA_NAME
+
+############### Seetings ######################
+# converts the u / x0 .pt training files into the memory-mapped format read by InputsMemmapDataset
+# (train with dataset_class='InputsMemmapDataset')
+
+DATASET_SUBDIR = 'CartPole-NMPC'
+
+# file names in the dataset subdir
+U_FILE_NAME = U_DATA_NAME
+X0_FILE_NAME = X0_CONDITION_DATA_NAME
+
+# 'float32' or 'float16'
+DTYPE = 'float32'
+
+# number of samples copied at once
+CHUNK_SIZE = 65536
+
+
+if __name__ == "__main__":
+    out_dir = convert_inputs_to_memmap(os.path.join(dataset_base_dir, DATASET_SUBDIR),
+                                       u_data_name=U_FILE_NAME, x0_condition_data_name=X0_FILE_NAME,
+                                       dtype=DTYPE, chunk_size=CHUNK_SIZE)
+    print(f'memmap dataset saved in -- {out_dir}')
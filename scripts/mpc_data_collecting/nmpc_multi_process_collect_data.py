@@ -5,15 +5,23 @@ import torch
 import os
 import matplotlib.pyplot as plt
 import time
-from multiprocessing import Pool, Manager, Array
+from multiprocessing import Pool, shared_memory
 import multiprocessing
 
+from mpd.controllers import CartPoleNMPC, get_cart_pole_nmpc
+from mpd.datasets.shard_store import ShardStore, SHARD_STORE_DIR_NAME
+
 ############### Seetings ######################
 # Attention: this py file can only set the initial range of position and theta, initial x_dot and theta_dot are always 0
 
 # data saving folder
 SAVE_PATH =  "/MPC_DynamicSys/sharedVol/train_data/nmpc/multi_normal"
 
+# each collection round is appended as one shard (u, x0, j) to the sharded dataset store, existing data is not rewritten
+SHARD_STORE_PATH = os.path.join(SAVE_PATH, SHARD_STORE_DIR_NAME)
+# the round is still saved as full u / x0 / j .pt files (previous format) until the training configs read the store
+SAVE_FULL_PT_FILES = True
+
 # control steps
 CONTROL_STEPS = 80
 
@@ -38,6 +46,12 @@ INITIAL_GUESS_NUM = 2
 initial_guess_x = [5, 0]
 initial_guess_u = [1000, -10000]
 
+# solve mode
+# 'initial_guess': every solve starts from the constant initial guess above (cold start, keeps the multimodal data)
+# 'warm_start': 0th step from the initial guess, then the nominal solve starts from the shifted previous nominal solution
+#               and each noisy solve from the nominal solution at the same step (primal and dual)
+SOLVE_MODE = 'initial_guess'
+
 # save data round to 4 digit
 ROUND_DIG = 6
 
@@ -51,6 +65,7 @@ filename_idx = '_ini_'+str(NUM_INITIAL_X)+'x'+str(NUM_INIYIAL_THETA)+'_noise_'+s
 U_DATA_NAME = 'u' + filename_idx # 400000: training data amount, 8: horizon length, 1:channels --> 400000-8-1: tensor size for data trainig 
 X0_CONDITION_DATA_NAME = 'x0' + filename_idx # 400000-4: tensor size for conditioning data in training
 J_DATA_NAME = 'j'+ filename_idx
+SOLVER_STATS_NAME = 'solver_stats_{}' + filename_idx.replace('.pt', '.npy') # per solve mode, for comparing the modes
 
 np.random.seed(42)
 
@@ -140,48 +155,25 @@ def ThetaToRedTheta(theta):
     return (theta-np.pi)**2/-np.pi + np.pi
 
 
-def MPC_Solve( system_update, system_dynamic, x0:np.array, initial_guess_x:float, initial_guess_u:float, num_state:int, horizon:int, Q_cost:np.array, R_cost:float, ts: float, opts_setting ):
-    # casadi_Opti
-    optimizer_normal = ca.Opti()
-    
-    ##### normal mpc #####  
-    # x and u mpc prediction along N
-    X_pre = optimizer_normal.variable(num_state, horizon + 1) 
-    U_pre = optimizer_normal.variable(1, horizon)
-    # set intial guess
-    optimizer_normal.set_initial(X_pre, initial_guess_x)
-    optimizer_normal.set_initial(U_pre, initial_guess_u)
-
-    optimizer_normal.subject_to(X_pre[:, 0] == x0)  # starting state
-
-    # cost 
-    cost = 0
-
-    # initial cost
-    cost += Q_cost[0,0]*X_pre[0, 0]**2 + Q_cost[1,1]*X_pre[1, 0]**2 + Q_cost[2,2]*X_pre[2, 0]**2 + Q_cost[3,3]*X_pre[3, 0]**2 + Q_cost[4,4]*X_pre[4, 0]**2
-
-    # state cost
-    for k in range(0,HOR-1):
-        x_next = system_update(system_dynamic,ts,X_pre[:, k],U_pre[:, k])
-        optimizer_normal.subject_to(X_pre[:, k + 1] == x_next)
-        cost += Q_cost[0,0]*X_pre[0, k+1]**2 + Q_cost[1,1]*X_pre[1, k+1]**2 + Q_cost[2,2]*X_pre[2, k+1]**2 + Q_cost[3,3]*X_pre[3, k+1]**2 + Q_cost[4,4]*X_pre[4, k+1]**2 + R_cost * U_pre[:, k]**2
-
-    # terminal cost
-    x_terminal = system_update(system_dynamic,ts,X_pre[:, horizon-1],U_pre[:, horizon-1])
-    optimizer_normal.subject_to(X_pre[:, horizon] == x_terminal)
-    cost += P[0,0]*X_pre[0, HOR]**2 + P[1,1]*X_pre[1, HOR]**2 + P[2,2]*X_pre[2, HOR]**2 + P[3,3]*X_pre[3, HOR]**2 + P[4,4]*X_pre[4, HOR]**2 + R_cost * U_pre[:, HOR-1]**2
-
-    optimizer_normal.minimize(cost)
-    optimizer_normal.solver('ipopt',opts_setting)
-    sol = optimizer_normal.solve()
-    X_sol = sol.value(X_pre)
-    U_sol = sol.value(U_pre)
-    Cost_sol = sol.value(cost)
-    return X_sol, U_sol, Cost_sol
+def MPC_Solve( system_update, system_dynamic, x0:np.array, initial_guess_x:float, initial_guess_u:float, num_state:int, horizon:int, Q_cost:np.array, R_cost:float, ts: float, opts_setting, initial_lam_g=None ):
+    # the NLP is built once per process and (dynamics, horizon, Q, R, P, Ts), later calls only update x0 and re-solve
+    nmpc = get_cart_pole_nmpc(system_update, system_dynamic, num_state, horizon, Q_cost, R_cost, P, ts, opts_setting)
+    X_sol, U_sol, Cost_sol = nmpc.solve(x0, initial_guess_x, initial_guess_u, initial_lam_g)
+    return X_sol, U_sol, Cost_sol, nmpc
 
 
 # Opt
 opts_setting = {'ipopt.max_iter':20000, 'ipopt.acceptable_tol':1e-8, 'ipopt.acceptable_obj_change_tol':1e-6, 'ipopt.print_level': 0, 'print_time': 0, 'ipopt.sb': 'yes'}
+# IPOPT only uses the initial multipliers with warm_start_init_point
+opts_setting_warm_start = dict(opts_setting, **{'ipopt.warm_start_init_point': 'yes'})
+
+
+def MPC_Solve_Guess(x0, x_ini_guess, u_ini_guess, warm_start=None):
+    # warm_start: (X_guess, U_guess, lam_g_guess) or None for the constant initial guess
+    if warm_start is None:
+        return MPC_Solve(EulerForwardCartpole_virtual_Casadi, dynamic_update_virtual_Casadi, x0, x_ini_guess, u_ini_guess, NUM_STATE, HOR, Q, R, TS, opts_setting)
+    X_guess, U_guess, lam_g_guess = warm_start
+    return MPC_Solve(EulerForwardCartpole_virtual_Casadi, dynamic_update_virtual_Casadi, x0, X_guess, U_guess, NUM_STATE, HOR, Q, R, TS, opts_setting_warm_start, lam_g_guess)
 
 
 
@@ -193,20 +185,20 @@ def AssignDataTo1DBuffer( Buffer1D, Data: np.array, dim_data, Idx_start_basic, I
     Buffer1D[ startIdx:end_idx ] = Data_flat
 
 
-def MPC_NormalData_Process(x0, x_ini_guess, u_ini_guess, idx_group_of_control_step, u_result_normal, j_result_normal, x_result_normal, idx_control_step=0) -> float:
+def MPC_NormalData_Process(x0, x_ini_guess, u_ini_guess, idx_group_of_control_step, u_result_normal, j_result_normal, x_result_normal, idx_control_step=0, warm_start=None):
     u_for_normal_x = np.zeros(HOR)
     
-    X_sol, U_sol, Cost_sol = MPC_Solve(EulerForwardCartpole_virtual_Casadi, dynamic_update_virtual_Casadi, x0, x_ini_guess, u_ini_guess, NUM_STATE, HOR, Q, R, TS, opts_setting)
+    X_sol, U_sol, Cost_sol, nmpc = MPC_Solve_Guess(x0, x_ini_guess, u_ini_guess, warm_start)
     u_for_normal_x = U_sol.reshape(HOR,1)
     j_for_normal_x = np.array(Cost_sol)
     # save normal x,u,j data in 0th step 
     idx_0step_normal_data = idx_group_of_control_step*(CONTROL_STEPS) + idx_control_step
     
     
-    # shared memory with manager list
-    x_result_normal[idx_0step_normal_data] = x0.tolist()
-    u_result_normal[idx_0step_normal_data] = u_for_normal_x.tolist()
-    j_result_normal[idx_0step_normal_data] = j_for_normal_x.tolist()
+    # write directly into the shared memory buffers
+    x_result_normal[idx_0step_normal_data] = x0
+    u_result_normal[idx_0step_normal_data] = u_for_normal_x
+    j_result_normal[idx_0step_normal_data] = j_for_normal_x
     
     # print normal
     print('-----------------------------------------normal result--------------------------------------------------------')
@@ -215,12 +207,16 @@ def MPC_NormalData_Process(x0, x_ini_guess, u_ini_guess, idx_group_of_control_st
     # print(f'x0_new-- {X_sol[:,0]}')
     # print(f'cost-- {Cost_sol}')
     
-    return U_sol[0]
+    # nominal solution (for warm starts) and solver stats (ipopt iterations, wall time)
+    nominal_solution = (X_sol, U_sol, nmpc.lam_g)
+    solve_stats = np.array([nmpc.iter_count, nmpc.solve_time])
+    return U_sol[0], nominal_solution, solve_stats
 
-def MPC_NoiseData_Process( x0, x_ini_guess, u_ini_guess, idx_group_of_control_step, u_result_noise, j_result_noise, x_result_noise, idx_control_step=0, bAll = False):
+def MPC_NoiseData_Process( x0, x_ini_guess, u_ini_guess, idx_group_of_control_step, u_result_noise, j_result_noise, x_result_noise, idx_control_step=0, bAll = False, warm_start=None):
     noisey_x = np.zeros((NUM_NOISY_DATA, NUM_STATE))
     u_for_noisy_x = np.zeros((NUM_NOISY_DATA, HOR, 1))
     j_for_noisy_x = np.zeros((NUM_NOISY_DATA))
+    solve_stats = np.zeros(2)
     for idx_noisy in range(0,NUM_NOISY_DATA):
         if (bAll == True): 
             noise = np.random.normal(NOISE_MEAN, NOISE_SD, size = NUM_STATE)
@@ -231,7 +227,8 @@ def MPC_NoiseData_Process( x0, x_ini_guess, u_ini_guess, idx_group_of_control_st
         
         noisy_state[IDX_THETA_RED] = ThetaToRedTheta(noisy_state[IDX_THETA])
         noisey_x[idx_noisy,:] = noisy_state
-        X_noise_sol, U_noisy_sol, Cost_noise_sol = MPC_Solve(EulerForwardCartpole_virtual_Casadi, dynamic_update_virtual_Casadi, noisey_x[idx_noisy,:], x_ini_guess, u_ini_guess, NUM_STATE, HOR, Q, R, TS, opts_setting)
+        X_noise_sol, U_noisy_sol, Cost_noise_sol, nmpc = MPC_Solve_Guess(noisey_x[idx_noisy,:], x_ini_guess, u_ini_guess, warm_start)
+        solve_stats += [nmpc.iter_count, nmpc.solve_time]
         
         # gey u, j by x
         u_for_noisy_x[idx_noisy,:,:] = U_noisy_sol.reshape(1,HOR,1)
@@ -242,22 +239,35 @@ def MPC_NoiseData_Process( x0, x_ini_guess, u_ini_guess, idx_group_of_control_st
     idx_start_0step_nosie_data = idx_group_of_control_step*CONTROLSTEP_X_NUMNOISY + idx_control_step*NUM_NOISY_DATA
     idx_end_0step_nosie_data = idx_start_0step_nosie_data + NUM_NOISY_DATA
     
-    # shared memory with manager list
-    x_result_noise[idx_start_0step_nosie_data:idx_end_0step_nosie_data] = noisey_x.tolist()
-    u_result_noise[idx_start_0step_nosie_data:idx_end_0step_nosie_data] = u_for_noisy_x.tolist()
-    j_result_noise[idx_start_0step_nosie_data:idx_end_0step_nosie_data] = j_for_noisy_x.tolist()
-
-def RunMPCForSingle_IniState_IniGuess(x_ini_guess: float, u_ini_guess:float,idx_group_of_control_step:int,x0_state:np.array, 
-                                      x_result_normal:torch.tensor, u_result_normal:torch.tensor, j_result_normal:torch.tensor,
-                                      x_result_noisy:torch.tensor, u_result_noisy:torch.tensor, j_result_noisy:torch.tensor):
+    # write directly into the shared memory buffers
+    x_result_noise[idx_start_0step_nosie_data:idx_end_0step_nosie_data] = noisey_x
+    u_result_noise[idx_start_0step_nosie_data:idx_end_0step_nosie_data] = u_for_noisy_x
+    j_result_noise[idx_start_0step_nosie_data:idx_end_0step_nosie_data] = j_for_noisy_x
+
+    return solve_stats
+
+def RunMPCForSingle_IniState_IniGuess(x_ini_guess: float, u_ini_guess:float,idx_group_of_control_step:int,x0_state:np.array):
+    # result buffers attached once per worker in InitWorkerSharedBuffers
+    x_result_normal = SHARED_RESULTS['x_normal']
+    u_result_normal = SHARED_RESULTS['u_normal']
+    j_result_normal = SHARED_RESULTS['j_normal']
+    x_result_noisy = SHARED_RESULTS['x_noise']
+    u_result_noisy = SHARED_RESULTS['u_noise']
+    j_result_noisy = SHARED_RESULTS['j_noise']
+    solver_stats = SHARED_RESULTS['solver_stats']
+
+    warm_start = SOLVE_MODE == 'warm_start'
+    group_stats = np.zeros(2)
 
     ################ generate data for 0th step ##########################################################
     try:
-        # normal at x0
-        u0 = MPC_NormalData_Process(x0_state, x_ini_guess, u_ini_guess, idx_group_of_control_step, u_result_normal, j_result_normal, x_result_normal)
+        # normal at x0, no previous solution yet -> initial guess
+        u0, nominal_solution, normal_stats = MPC_NormalData_Process(x0_state, x_ini_guess, u_ini_guess, idx_group_of_control_step, u_result_normal, j_result_normal, x_result_normal)
         
         # noisy at x0
-        MPC_NoiseData_Process(x0_state, x_ini_guess, u_ini_guess, idx_group_of_control_step, u_result_noisy, j_result_noisy, x_result_noisy)
+        noisy_stats = MPC_NoiseData_Process(x0_state, x_ini_guess, u_ini_guess, idx_group_of_control_step, u_result_noisy, j_result_noisy, x_result_noisy,
+                                            warm_start=nominal_solution if warm_start else None)
+        group_stats += normal_stats + noisy_stats
         
         ############################################## generate data for control step loop ##############################################
         # main mpc loop
@@ -266,14 +276,21 @@ def RunMPCForSingle_IniState_IniGuess(x_ini_guess: float, u_ini_guess:float,idx_
             x0_next = EulerForwardCartpole_virtual(TS,x0_state,u0)
             
             ################################################# normal mpc loop to update state #################################################
-            u0_cur = MPC_NormalData_Process(x0_next, x_ini_guess, u_ini_guess, idx_group_of_control_step, u_result_normal, j_result_normal, x_result_normal,idx_control_step)
+            shifted_solution = CartPoleNMPC.shift_solution(*nominal_solution) if warm_start else None
+            u0_cur, nominal_solution, normal_stats = MPC_NormalData_Process(x0_next, x_ini_guess, u_ini_guess, idx_group_of_control_step, u_result_normal, j_result_normal, x_result_normal,idx_control_step,
+                                                                            warm_start=shifted_solution)
 
             ################################## noise  ##################################
-            MPC_NoiseData_Process(x0_next, x_ini_guess, u_ini_guess, idx_group_of_control_step, u_result_noisy, j_result_noisy, x_result_noisy, idx_control_step, True)
+            noisy_stats = MPC_NoiseData_Process(x0_next, x_ini_guess, u_ini_guess, idx_group_of_control_step, u_result_noisy, j_result_noisy, x_result_noisy, idx_control_step, True,
+                                                warm_start=nominal_solution if warm_start else None)
+            group_stats += normal_stats + noisy_stats
             
             # update
             x0_state = x0_next
             u0 = u0_cur
+
+        solver_stats[idx_group_of_control_step] = group_stats
+        print(f'group {idx_group_of_control_step} ({SOLVE_MODE}) -- ipopt iterations: {int(group_stats[0])}, solver wall time: {group_stats[1]:.2f} s')
             
             
         #save data each group into folder seperately
@@ -326,22 +343,49 @@ SIZE_NORMAL_DATA = INITIAL_GUESS_NUM*num_datagroup*(CONTROL_STEPS)
 SIZE_NOISE_DATA = INITIAL_GUESS_NUM*num_datagroup*CONTROLSTEP_X_NUMNOISY
 x_normal_shape = (SIZE_NORMAL_DATA,NUM_STATE)
 u_normal_shape = (SIZE_NORMAL_DATA,HOR,1)
-j_normal_shape = (SIZE_NORMAL_DATA)
+j_normal_shape = (SIZE_NORMAL_DATA,)
 x_noise_shape = (SIZE_NOISE_DATA,NUM_STATE)
 u_noise_shape = (SIZE_NOISE_DATA,HOR,1)
-j_noise_shape = (SIZE_NOISE_DATA)
+j_noise_shape = (SIZE_NOISE_DATA,)
+
+# typed result buffers in shared memory, workers write into their own index slices (no manager process, no pickling)
+RESULT_DTYPE = np.float64
+RESULT_SHAPES = {
+    'x_normal': x_normal_shape,
+    'u_normal': u_normal_shape,
+    'j_normal': j_normal_shape,
+    'x_noise': x_noise_shape,
+    'u_noise': u_noise_shape,
+    'j_noise': j_noise_shape,
+    'solver_stats': (INITIAL_GUESS_NUM*num_datagroup, 2), # ipopt iterations, solver wall time per group
+}
+
+# per process views on the shared buffers, filled by InitWorkerSharedBuffers
+SHARED_MEMORY_BLOCKS = {}
+SHARED_RESULTS = {}
+
+
+def CreateSharedBuffers():
+    blocks = {}
+    for name, shape in RESULT_SHAPES.items():
+        nbytes = int(np.prod(shape)) * np.dtype(RESULT_DTYPE).itemsize
+        blocks[name] = shared_memory.SharedMemory(create=True, size=nbytes)
+        np.ndarray(shape, dtype=RESULT_DTYPE, buffer=blocks[name].buf).fill(0.0)
+    return blocks
+
+
+def InitWorkerSharedBuffers(shared_memory_names):
+    # attach once per worker, keep the blocks referenced so the views stay valid
+    for name, shm_name in shared_memory_names.items():
+        SHARED_MEMORY_BLOCKS[name] = shared_memory.SharedMemory(name=shm_name)
+        SHARED_RESULTS[name] = np.ndarray(RESULT_SHAPES[name], dtype=RESULT_DTYPE, buffer=SHARED_MEMORY_BLOCKS[name].buf)
+
 
 def main():
     MAX_CORE_CPU = 30
     start_time = time.time()
-    with Manager() as manager:
-        x_normal_shared_memory = manager.list([[0.0] * x_normal_shape[1]] * x_normal_shape[0])
-        u_normal_shared_memory = manager.list([[[0.0] for _ in range(u_normal_shape[1])] for _ in range(u_normal_shape[0])])
-        j_normal_shared_memory = manager.list([0.0] * j_normal_shape)
-        x_noise_shared_memory = manager.list([[0.0] * x_noise_shape[1]] * x_noise_shape[0])
-        u_noise_shared_memory = manager.list([[[0.0] for _ in range(u_noise_shape[1])] for _ in range(u_noise_shape[0])])
-        j_noise_shared_memory = manager.list([0.0] * j_noise_shape)
-        
+    shared_blocks = CreateSharedBuffers()
+    try:
         argument_each_group = []
         for idx_ini_guess in range(0, INITIAL_GUESS_NUM): 
             for turn in range(0,num_datagroup):
@@ -356,21 +400,22 @@ def main():
                 theta_red_0 = ThetaToRedTheta(theta_0)
                 x0 = np.array([x_0, 0.0, theta_0, 0, theta_red_0])
                 
-                argument_each_group.append((x_ini_guess, u_ini_guess, idx_group_of_control_step, x0, 
-                                            x_normal_shared_memory, u_normal_shared_memory, j_normal_shared_memory,
-                                            x_noise_shared_memory, u_noise_shared_memory, j_noise_shared_memory))
-   
-        with Pool(processes=MAX_CORE_CPU) as pool:
+                argument_each_group.append((x_ini_guess, u_ini_guess, idx_group_of_control_step, x0))
+
+        shared_memory_names = {name: block.name for name, block in shared_blocks.items()}
+        with Pool(processes=MAX_CORE_CPU, initializer=InitWorkerSharedBuffers, initargs=(shared_memory_names,)) as pool:
             pool.starmap(RunMPCForSingle_IniState_IniGuess, argument_each_group)
-                
-        # shared memory with manager list
-        x_all_normal = torch.from_numpy(np.array(x_normal_shared_memory))
-        u_all_normal = torch.from_numpy(np.array(u_normal_shared_memory))
-        j_all_normal = torch.from_numpy(np.array(j_normal_shared_memory))
-        
-        x_all_noisy = torch.from_numpy(np.array(x_noise_shared_memory))
-        u_all_noisy = torch.from_numpy(np.array(u_noise_shared_memory))
-        j_all_noisy = torch.from_numpy(np.array(j_noise_shared_memory))
+
+        # copy out of the shared memory buffers before they are released
+        results = {name: np.ndarray(shape, dtype=RESULT_DTYPE, buffer=shared_blocks[name].buf).copy()
+                   for name, shape in RESULT_SHAPES.items()}
+        x_all_normal = torch.from_numpy(results['x_normal'])
+        u_all_normal = torch.from_numpy(results['u_normal'])
+        j_all_normal = torch.from_numpy(results['j_normal'])
+
+        x_all_noisy = torch.from_numpy(results['x_noise'])
+        u_all_noisy = torch.from_numpy(results['u_noise'])
+        j_all_noisy = torch.from_numpy(results['j_noise'])
 
         # show the first saved u and x0
         print(f'first_u -- {u_all_normal[0,:,0]}')
@@ -389,9 +434,34 @@ def main():
         J_training_data = torch.cat((j_all_normal, j_all_noisy), dim=0)
 
         # data saving
-        torch.save(u_training_data, os.path.join(SAVE_PATH, U_DATA_NAME))
-        torch.save(x0_conditioning_data, os.path.join(SAVE_PATH, X0_CONDITION_DATA_NAME))
-        torch.save(J_training_data, os.path.join(SAVE_PATH, J_DATA_NAME))
+        ShardStore(SHARD_STORE_PATH).append(
+            {'u': u_training_data, 'x0': x0_conditioning_data, 'j': J_training_data},
+            meta={'source': U_DATA_NAME, 'size_normal_data': SIZE_NORMAL_DATA, 'size_noise_data': SIZE_NOISE_DATA,
+                  'solve_mode': SOLVE_MODE},
+            dtype='float32'
+        )
+        if SAVE_FULL_PT_FILES:
+            torch.save(u_training_data, os.path.join(SAVE_PATH, U_DATA_NAME))
+            torch.save(x0_conditioning_data, os.path.join(SAVE_PATH, X0_CONDITION_DATA_NAME))
+            torch.save(J_training_data, os.path.join(SAVE_PATH, J_DATA_NAME))
+
+        # solver stats per group, savings w.r.t. the other solve mode if it was collected before
+        solver_stats = results['solver_stats']
+        np.save(os.path.join(SAVE_PATH, SOLVER_STATS_NAME.format(SOLVE_MODE)), solver_stats)
+        print(f'{SOLVE_MODE} -- mean ipopt iterations per group: {solver_stats[:,0].mean():.1f}, mean solver wall time per group: {solver_stats[:,1].mean():.2f} s')
+        other_mode = 'initial_guess' if SOLVE_MODE == 'warm_start' else 'warm_start'
+        other_stats_path = os.path.join(SAVE_PATH, SOLVER_STATS_NAME.format(other_mode))
+        if os.path.exists(other_stats_path):
+            other_stats = np.load(other_stats_path)
+            cold_stats, warm_stats = (other_stats, solver_stats) if SOLVE_MODE == 'warm_start' else (solver_stats, other_stats)
+            savings = 1 - warm_stats / cold_stats
+            for idx_group in range(savings.shape[0]):
+                print(f'group {idx_group} -- warm start saves {100*savings[idx_group,0]:.1f}% ipopt iterations, {100*savings[idx_group,1]:.1f}% solver wall time')
+
+    finally:
+        for block in shared_blocks.values():
+            block.close()
+            block.unlink()
 
     end_time = time.time()
 
@@ -0,0 +1,122 @@
+import copy
+import sys
+
+import numpy as np
+import torch
+
+from mpd.models import UNET_DIM_MULTS, ConditionedTemporalUnet
+from mpd.trainer import get_dataset, get_model, get_loss
+from mpd.trainer.trainer import get_amp_settings, get_grad_scaler
+from torch_robotics.torch_utils.seed import fix_random_seed
+from torch_robotics.torch_utils.torch_timer import TimerCUDA
+from torch_robotics.torch_utils.torch_utils import get_torch_device, dict_to_device
+
+############### Seetings ######################
+# numerical parity of the mixed precision training (bfloat16 on cpu, float16 + loss scaling on cuda) against float32,
+# for GaussianDiffusionCartPoleLoss: two copies of the same model are trained on the same batches with the same
+# diffusion timesteps, noises and cfg masks, the loss curves are compared
+
+DEVICE = 'cpu'  # 'cuda'
+AMP_DTYPE = None  # None: device default
+DATASET_CLASS = 'InputsDataset'
+DATASET_SUBDIR = 'CartPole-NMPC'
+BATCH_SIZE = 256
+N_STEPS = 500
+SMOOTHING_WINDOW = 50
+LR = 1e-4
+N_DIFFUSION_STEPS = 25
+UNET_INPUT_DIM = 32
+UNET_DIM_MULTS_OPTION = 1
+MAX_REL_DIFF_SMOOTHED_LOSS = 0.05  # tolerance on the smoothed loss curves
+
+
+def TrainStep(model, optimizer, scaler, loss_fn, batch_dict, dataset, step, amp_device_type, amp_dtype, use_amp):
+    # same diffusion noise for both precisions
+    torch.manual_seed(step)
+    with torch.autocast(device_type=amp_device_type, dtype=amp_dtype, enabled=use_amp):
+        losses, _ = loss_fn(model, batch_dict, dataset)
+    loss = sum(loss.float().mean() for loss in losses.values())
+    optimizer.zero_grad()
+    scaler.scale(loss).backward()
+    scaler.unscale_(optimizer)
+    torch.nn.utils.clip_grad_norm_(model.parameters(), max_norm=1.0)
+    scaler.step(optimizer)
+    scaler.update()
+    return loss.item()
+
+
+def Smooth(x, window):
+    return np.convolve(x, np.ones(window) / window, mode='valid')
+
+
+if __name__ == "__main__":
+    fix_random_seed(0)
+    device = get_torch_device(device=DEVICE)
+    tensor_args = {'device': device, 'dtype': torch.float32}
+    amp_device_type, amp_dtype, use_scaler = get_amp_settings(device, use_amp=True, amp_dtype=AMP_DTYPE)
+
+    train_subset, train_dataloader, _, _ = get_dataset(
+        dataset_class=DATASET_CLASS,
+        dataset_subdir=DATASET_SUBDIR,
+        batch_size=BATCH_SIZE,
+        batch_loader=True,
+        shuffle=True,
+        tensor_args=tensor_args
+    )
+    dataset = train_subset.dataset
+
+    unet_configs = dict(
+        state_dim=dataset.state_dim,
+        n_support_points=dataset.n_support_points,
+        unet_input_dim=UNET_INPUT_DIM,
+        dim_mults=UNET_DIM_MULTS[UNET_DIM_MULTS_OPTION],
+    )
+    model_fp32 = get_model(
+        model_class='GaussianDiffusionModel',
+        model=ConditionedTemporalUnet(**unet_configs),
+        tensor_args=tensor_args,
+        n_diffusion_steps=N_DIFFUSION_STEPS,
+        predict_epsilon=True,
+        **unet_configs
+    )
+    model_amp = copy.deepcopy(model_fp32)
+    loss_fn = get_loss(loss_class='GaussianDiffusionCartPoleLoss')
+
+    runs = {
+        'float32': (model_fp32, False, get_grad_scaler(amp_device_type, enabled=False)),
+        f'{amp_dtype}': (model_amp, True, get_grad_scaler(amp_device_type, enabled=use_scaler)),
+    }
+    optimizers = {name: torch.optim.Adam(lr=LR, params=model.parameters()) for name, (model, _, _) in runs.items()}
+    losses = {name: [] for name in runs}
+    times = {name: 0. for name in runs}
+
+    batches = iter(train_dataloader)
+    for step in range(N_STEPS):
+        try:
+            batch_dict = next(batches)
+        except StopIteration:
+            batches = iter(train_dataloader)
+            batch_dict = next(batches)
+        batch_dict = dict_to_device(batch_dict, device)
+        for name, (model, use_amp, scaler) in runs.items():
+            with TimerCUDA() as t:
+                losses[name].append(TrainStep(model, optimizers[name], scaler, loss_fn, batch_dict, dataset, step,
+                                              amp_device_type, amp_dtype, use_amp))
+            times[name] += t.elapsed
+
+    loss_fp32, loss_amp = (np.array(l) for l in losses.values())
+    smoothed_fp32, smoothed_amp = Smooth(loss_fp32, SMOOTHING_WINDOW), Smooth(loss_amp, SMOOTHING_WINDOW)
+    rel_diff = np.abs(smoothed_amp - smoothed_fp32) / np.abs(smoothed_fp32)
+
+    print(f'\n----- {amp_device_type}: float32 vs {amp_dtype} (loss scaling {use_scaler}), {N_STEPS} steps')
+    for name in runs:
+        print(f'{name:<16} final smoothed loss {Smooth(np.array(losses[name]), SMOOTHING_WINDOW)[-1]:.5f}  '
+              f'{times[name] / N_STEPS * 1e3:8.2f} ms/step')
+    print(f'first step loss abs diff {abs(loss_amp[0] - loss_fp32[0]):.2e}')
+    print(f'smoothed loss rel diff: max {rel_diff.max():.2%}, final {rel_diff[-1]:.2%}')
+    print(f'speedup x{times["float32"] / times[f"{amp_dtype}"]:.2f}')
+
+    if rel_diff.max() > MAX_REL_DIFF_SMOOTHED_LOSS:
+        print(f'PARITY CHECK FAILED (tolerance {MAX_REL_DIFF_SMOOTHED_LOSS:.0%})')
+        sys.exit(1)
+    print('parity check passed')
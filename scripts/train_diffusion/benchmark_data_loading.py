@@ -0,0 +1,59 @@
+import torch
+from torch.utils.data import DataLoader
+
+from mpd.datasets import TensorBatchLoader
+from mpd.trainer import get_dataset
+from torch_robotics.torch_utils.torch_timer import TimerCUDA
+from torch_robotics.torch_utils.torch_utils import get_torch_device, dict_to_device
+
+############### Seetings ######################
+# samples/s of the training batches: DataLoader over a Subset (per-sample dicts + collate) vs TensorBatchLoader
+
+DATASET_CLASS = 'InputsDataset'  # 'InputsMemmapDataset'
+DATASET_SUBDIR = 'CartPole-NMPC'
+BATCH_SIZE = 512
+N_BATCHES = 200  # batches timed per loader
+PREFETCH = 2
+
+
+def benchmark(name, dataloader, device):
+    # one warm-up batch, then N_BATCHES timed batches moved to the training device
+    n_samples = 0
+    batches = iter(dataloader)
+    dict_to_device(next(batches), device)
+    with TimerCUDA() as t:
+        for i, batch_dict in enumerate(batches):
+            batch_dict = dict_to_device(batch_dict, device)
+            n_samples += next(iter(batch_dict.values())).shape[0]
+            if i + 1 == N_BATCHES:
+                break
+    print(f'{name:<40} {n_samples / t.elapsed:12.0f} samples/s  ({t.elapsed:.3f} sec, {n_samples} samples)')
+    return n_samples / t.elapsed
+
+
+if __name__ == "__main__":
+    device = get_torch_device(device='cuda')
+    tensor_args = {'device': device, 'dtype': torch.float32}
+
+    train_subset, _, _, _ = get_dataset(
+        dataset_class=DATASET_CLASS,
+        dataset_subdir=DATASET_SUBDIR,
+        batch_size=BATCH_SIZE,
+        tensor_args=tensor_args
+    )
+    dataset = train_subset.dataset
+
+    results = {
+        'DataLoader (Subset)': benchmark(
+            'DataLoader (Subset)', DataLoader(train_subset, batch_size=BATCH_SIZE, shuffle=True), device),
+        'TensorBatchLoader': benchmark(
+            'TensorBatchLoader', TensorBatchLoader(dataset, train_subset.indices, batch_size=BATCH_SIZE, shuffle=True),
+            device),
+        'TensorBatchLoader (prefetch)': benchmark(
+            'TensorBatchLoader (prefetch)',
+            TensorBatchLoader(dataset, train_subset.indices, batch_size=BATCH_SIZE, shuffle=True, prefetch=PREFETCH),
+            device),
+    }
+    baseline = results['DataLoader (Subset)']
+    for name, samples_per_sec in results.items():
+        print(f'{name:<40} speedup x{samples_per_sec / baseline:.1f}')
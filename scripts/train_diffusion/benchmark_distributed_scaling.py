@@ -0,0 +1,103 @@
+import os
+import time
+
+import torch
+import torch.distributed as dist
+import torch.multiprocessing as mp
+
+from mpd.models import UNET_DIM_MULTS, ConditionedTemporalUnet
+from mpd.trainer import get_dataset, get_model, get_loss
+from mpd.trainer.distributed import init_distributed, cleanup_distributed, broadcast_parameters, all_reduce_gradients
+from torch_robotics.torch_utils.seed import fix_random_seed
+from torch_robotics.torch_utils.torch_utils import dict_to_device
+
+############### Seetings ######################
+# training samples/s of the CPU data-parallel training (gloo) vs the number of processes,
+# same per-process batch size (the global batch grows with the processes), cores split between the processes
+
+PROCESS_COUNTS = [1, 2, 4, 8, 16]
+DATASET_CLASS = 'InputsDataset'
+DATASET_SUBDIR = 'CartPole-NMPC'
+BATCH_SIZE = 256  # per process
+N_WARMUP_STEPS = 5
+N_STEPS = 50
+N_DIFFUSION_STEPS = 25
+UNET_INPUT_DIM = 32
+UNET_DIM_MULTS_OPTION = 1
+MASTER_PORT = '29511'
+
+
+def RunProcess(rank, world_size, results):
+    os.environ.update(RANK=str(rank), WORLD_SIZE=str(world_size), MASTER_ADDR='127.0.0.1', MASTER_PORT=MASTER_PORT)
+    init_distributed(backend='gloo')
+    fix_random_seed(0)
+    tensor_args = {'device': torch.device('cpu'), 'dtype': torch.float32}
+
+    train_subset, train_dataloader, _, _ = get_dataset(
+        dataset_class=DATASET_CLASS,
+        dataset_subdir=DATASET_SUBDIR,
+        batch_size=BATCH_SIZE,
+        batch_loader=True,
+        shuffle=True,
+        tensor_args=tensor_args
+    )
+    dataset = train_subset.dataset
+
+    unet_configs = dict(
+        state_dim=dataset.state_dim,
+        n_support_points=dataset.n_support_points,
+        unet_input_dim=UNET_INPUT_DIM,
+        dim_mults=UNET_DIM_MULTS[UNET_DIM_MULTS_OPTION],
+    )
+    model = get_model(
+        model_class='GaussianDiffusionModel',
+        model=ConditionedTemporalUnet(**unet_configs),
+        tensor_args=tensor_args,
+        n_diffusion_steps=N_DIFFUSION_STEPS,
+        predict_epsilon=True,
+        **unet_configs
+    )
+    broadcast_parameters(model)
+    loss_fn = get_loss(loss_class='GaussianDiffusionCartPoleLoss')
+    optimizer = torch.optim.Adam(lr=1e-4, params=model.parameters())
+
+    batches = iter(train_dataloader)
+    for step in range(N_WARMUP_STEPS + N_STEPS):
+        if step == N_WARMUP_STEPS:
+            if world_size > 1:
+                dist.barrier()
+            t_start = time.perf_counter()
+        try:
+            batch_dict = next(batches)
+        except StopIteration:
+            batches = iter(train_dataloader)
+            batch_dict = next(batches)
+        batch_dict = dict_to_device(batch_dict, tensor_args['device'])
+        losses, _ = loss_fn(model, batch_dict, dataset)
+        loss = sum(loss.mean() for loss in losses.values())
+        optimizer.zero_grad()
+        loss.backward()
+        all_reduce_gradients(model)
+        optimizer.step()
+    if world_size > 1:
+        dist.barrier()
+    elapsed = time.perf_counter() - t_start
+
+    if rank == 0:
+        results[world_size] = world_size * BATCH_SIZE * N_STEPS / elapsed
+    cleanup_distributed()
+
+
+if __name__ == "__main__":
+    results = mp.Manager().dict()
+    for world_size in PROCESS_COUNTS:
+        if world_size > os.cpu_count():
+            break
+        mp.spawn(RunProcess, args=(world_size, results), nprocs=world_size, join=True)
+        print(f'{world_size:>3} processes: {results[world_size]:10.0f} samples/s')
+
+    print(f'\n----- scaling (batch size {BATCH_SIZE} per process, {os.cpu_count()} cores)')
+    for world_size, samples_per_sec in results.items():
+        speedup = samples_per_sec / results[PROCESS_COUNTS[0]]
+        print(f'{world_size:>3} processes: {samples_per_sec:10.0f} samples/s  speedup x{speedup:.2f}  '
+              f'efficiency {speedup / world_size * PROCESS_COUNTS[0]:.0%}')
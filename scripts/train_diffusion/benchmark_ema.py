@@ -0,0 +1,64 @@
+import copy
+
+import torch
+
+from mpd.models import ConditionedTemporalUnet, UNET_DIM_MULTS
+from mpd.trainer.trainer import EMA
+from torch_robotics.torch_utils.torch_timer import TimerCUDA
+from torch_robotics.torch_utils.torch_utils import get_torch_device
+
+############### Seetings ######################
+# per-update cost of the EMA for the ConditionedTemporalUnet sizes of UNET_DIM_MULTS:
+# python loop (previous implementation) vs fused multi-tensor lerp, and load_state_dict vs fused copy for the reset
+
+DEVICE = 'cuda'
+STATE_DIM = 1
+N_SUPPORT_POINTS = 64
+UNET_INPUT_DIM = 32
+CONDITION_DIM = 5
+EMA_DECAY = 0.995
+N_UPDATES = 200
+
+
+def loop_update_model_average(ema, ema_model, current_model):
+    # previous implementation, kept here as the reference
+    for ema_params, current_params in zip(ema_model.parameters(), current_model.parameters()):
+        old_weight, up_weight = ema_params.data, current_params.data
+        ema_params.data = ema.update_average(old_weight, up_weight)
+
+
+def time_per_update(fn):
+    fn()  # warm-up
+    with TimerCUDA() as t:
+        for _ in range(N_UPDATES):
+            fn()
+    return t.elapsed / N_UPDATES * 1e6
+
+
+if __name__ == "__main__":
+    device = get_torch_device(device=DEVICE)
+
+    for dim_mults_option, dim_mults in UNET_DIM_MULTS.items():
+        model = ConditionedTemporalUnet(
+            n_support_points=N_SUPPORT_POINTS, state_dim=STATE_DIM, unet_input_dim=UNET_INPUT_DIM,
+            dim_mults=dim_mults, conditioning_embed_dim=CONDITION_DIM
+        ).to(device)
+        ema_model = copy.deepcopy(model)
+        ema = EMA(beta=EMA_DECAY)
+        n_params = sum(p.numel() for p in model.parameters())
+
+        def fused_update_side_thread(ema_side_thread=EMA(beta=EMA_DECAY, side_thread=True)):
+            ema_side_thread.update_model_average(ema_model, model)
+            ema_side_thread.wait()
+
+        results = {
+            'update: python loop': time_per_update(lambda: loop_update_model_average(ema, ema_model, model)),
+            'update: fused lerp': time_per_update(lambda: ema.update_model_average(ema_model, model)),
+            'update: fused lerp (side thread + wait)': time_per_update(fused_update_side_thread),
+            'reset: load_state_dict': time_per_update(lambda: ema_model.load_state_dict(model.state_dict())),
+            'reset: fused copy': time_per_update(lambda: ema.reset_parameters(ema_model, model)),
+        }
+
+        print(f'\n----- unet_dim_mults_option {dim_mults_option} {dim_mults}, {n_params} parameters, {device}')
+        for name, us in results.items():
+            print(f'{name:<45} {us:10.1f} us/update')
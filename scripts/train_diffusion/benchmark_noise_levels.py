@@ -0,0 +1,132 @@
+import time
+
+import torch
+
+from mpd.models import UNET_DIM_MULTS, ConditionedTemporalUnet
+from mpd.trainer import get_dataset, get_model, get_loss
+from torch_robotics.torch_utils.seed import fix_random_seed
+from torch_robotics.torch_utils.torch_utils import get_torch_device, dict_to_device
+
+############### Seetings ######################
+# time to a target validation loss with K noise levels per trajectory (diffusion data echoing),
+# stratified timesteps and importance weighting, against the one timestep per trajectory baseline.
+# The validation loss uses fixed timesteps and noises (same for every config), so the runs are comparable.
+
+DEVICE = 'cuda'
+DATASET_CLASS = 'InputsDataset'
+DATASET_SUBDIR = 'CartPole-NMPC'
+BATCH_SIZE = 512
+LR = 1e-4
+N_DIFFUSION_STEPS = 25
+UNET_INPUT_DIM = 32
+UNET_DIM_MULTS_OPTION = 1
+TARGET_VAL_LOSS = 0.05
+MAX_TIME = 1800  # sec per config
+STEPS_PER_VALIDATION = 200
+N_VAL_BATCHES = 20
+
+# (n_noise_levels, timestep_sampling, importance_weighting)
+CONFIGS = [
+    (1, 'uniform', False),
+    (1, 'stratified', False),
+    (4, 'stratified', False),
+    (8, 'stratified', False),
+    (4, 'stratified', True),
+]
+
+
+@torch.no_grad()
+def FixedNoiseValidationLoss(model, val_batches, dataset):
+    # same timesteps / noises / cfg masks for every config
+    rng_state = torch.get_rng_state()
+    cuda_rng_state = torch.cuda.get_rng_state_all() if torch.cuda.is_available() else None
+    torch.manual_seed(1234)
+    torch.cuda.manual_seed_all(1234)
+    losses = []
+    for batch_dict in val_batches:
+        x = batch_dict[f'{dataset.field_key_inputs}_normalized']
+        context = batch_dict[f'{dataset.field_key_condition}_normalized']
+        t = torch.randint(0, model.n_diffusion_steps, (x.shape[0],), device=x.device).long()
+        loss, _ = model.p_losses(x, context, t, None)
+        losses.append(loss.item())
+    torch.set_rng_state(rng_state)
+    if cuda_rng_state is not None:
+        torch.cuda.set_rng_state_all(cuda_rng_state)
+    return sum(losses) / len(losses)
+
+
+def TimeToTarget(n_noise_levels, timestep_sampling, importance_weighting, train_dataloader, val_batches, dataset,
+                 tensor_args):
+    fix_random_seed(0)
+    unet_configs = dict(
+        state_dim=dataset.state_dim,
+        n_support_points=dataset.n_support_points,
+        unet_input_dim=UNET_INPUT_DIM,
+        dim_mults=UNET_DIM_MULTS[UNET_DIM_MULTS_OPTION],
+    )
+    model = get_model(
+        model_class='GaussianDiffusionModel',
+        model=ConditionedTemporalUnet(**unet_configs),
+        tensor_args=tensor_args,
+        n_diffusion_steps=N_DIFFUSION_STEPS,
+        predict_epsilon=True,
+        n_noise_levels=n_noise_levels,
+        timestep_sampling=timestep_sampling,
+        importance_weighting=importance_weighting,
+        **unet_configs
+    )
+    loss_fn = get_loss(loss_class='GaussianDiffusionCartPoleLoss')
+    optimizer = torch.optim.Adam(lr=LR, params=model.parameters())
+
+    step, val_loss = 0, float('inf')
+    t_start = time.perf_counter()
+    t_validation = 0.
+    while time.perf_counter() - t_start - t_validation < MAX_TIME:
+        for batch_dict in train_dataloader:
+            batch_dict = dict_to_device(batch_dict, tensor_args['device'])
+            losses, _ = loss_fn(model, batch_dict, dataset)
+            loss = sum(loss.mean() for loss in losses.values())
+            optimizer.zero_grad()
+            loss.backward()
+            optimizer.step()
+            step += 1
+
+            if step % STEPS_PER_VALIDATION == 0:
+                # validation time is not counted
+                t_validation_start = time.perf_counter()
+                val_loss = FixedNoiseValidationLoss(model, val_batches, dataset)
+                t_validation += time.perf_counter() - t_validation_start
+                if val_loss <= TARGET_VAL_LOSS:
+                    return time.perf_counter() - t_start - t_validation, step, val_loss
+            if time.perf_counter() - t_start - t_validation >= MAX_TIME:
+                break
+    return None, step, val_loss
+
+
+if __name__ == "__main__":
+    device = get_torch_device(device=DEVICE)
+    tensor_args = {'device': device, 'dtype': torch.float32}
+
+    train_subset, train_dataloader, _, val_dataloader = get_dataset(
+        dataset_class=DATASET_CLASS,
+        dataset_subdir=DATASET_SUBDIR,
+        batch_size=BATCH_SIZE,
+        batch_loader=True,
+        shuffle=True,
+        tensor_args=tensor_args
+    )
+    dataset = train_subset.dataset
+    val_batches = []
+    for batch_dict in val_dataloader:
+        val_batches.append(dict_to_device(batch_dict, device))
+        if len(val_batches) == N_VAL_BATCHES:
+            break
+
+    print(f'\n----- time to validation loss {TARGET_VAL_LOSS} (batch size {BATCH_SIZE}, max {MAX_TIME} sec)')
+    for config in CONFIGS:
+        elapsed, steps, val_loss = TimeToTarget(*config, train_dataloader, val_batches, dataset, tensor_args)
+        n_noise_levels, timestep_sampling, importance_weighting = config
+        name = f'K={n_noise_levels} {timestep_sampling}{" + importance" if importance_weighting else ""}'
+        result = f'{elapsed:8.1f} sec' if elapsed is not None else 'not reached'
+        print(f'{name:<32} {result:>12}  {steps:7d} steps  {steps * BATCH_SIZE:10d} samples loaded  '
+              f'val loss {val_loss:.4f}')
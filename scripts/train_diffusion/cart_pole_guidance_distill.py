@@ -0,0 +1,100 @@
+import torch
+
+from experiment_launcher import single_experiment_yaml, run_experiment
+from mpd.trainer import get_dataset, guidance_distillation
+from torch_robotics.torch_utils.seed import fix_random_seed
+from torch_robotics.torch_utils.torch_utils import get_torch_device
+
+
+@single_experiment_yaml
+def experiment(
+    ########################################################################
+    # Teacher (trained model dir with args.yaml, normalizer.pt and checkpoints)
+    teacher_model_dir: str = '/root/cartpoleDiff/cart_pole_diffusion_based_on_MPD/trained_models/180000_training_data/100000',
+    guidance_weight_min: float = 0.,  # range of the cfg weights w the student is trained for
+    guidance_weight_max: float = 1.,
+    guidance_emb_dim: int = 32,
+
+    # Dataset (the data the teacher was trained on)
+    dataset_subdir: str = 'CartPole-LMPC',
+    dataset_class: str = 'InputsDataset',
+    batch_loader: bool = True,
+    prefetch: int = 0,
+    include_velocity: bool = False,
+
+    ########################################################################
+    # Training parameters
+    batch_size: int = 512,
+    lr: float = 1e-4,
+    num_train_steps: int = 20000,
+
+    use_ema: bool = True,
+    use_amp: bool = False,
+    amp_dtype: str = None,
+
+    steps_til_summary: int = 1000,
+    steps_til_ckpt: int = 5000,
+
+    ########################################################################
+    device: str = 'cuda',
+
+    debug: bool = True,
+
+    ########################################################################
+    # MANDATORY
+    seed: int = 0,
+    results_dir: str = 'logs',
+
+    ########################################################################
+    # WandB
+    wandb_mode: str = 'disabled',  # "online", "offline" or "disabled"
+    wandb_entity: str = 'scoreplan',
+    wandb_project: str = 'test_train',
+    **kwargs
+):
+    fix_random_seed(seed)
+
+    device = get_torch_device(device=device)
+    print(f'device --{device}')
+    tensor_args = {'device': device, 'dtype': torch.float32}
+
+    # Dataset
+    train_subset, train_dataloader, val_subset, val_dataloader = get_dataset(
+        dataset_class=dataset_class,
+        include_velocity=include_velocity,
+        dataset_subdir=dataset_subdir,
+        batch_size=batch_size,
+        batch_loader=batch_loader,
+        shuffle=True,
+        prefetch=prefetch,
+        results_dir=results_dir,
+        tensor_args=tensor_args
+    )
+
+    # Guidance distilled student (w as input), results_dir/guidance_distilled is its model dir
+    model_dir = guidance_distillation(
+        teacher_model_dir=teacher_model_dir,
+        results_dir=results_dir,
+        train_subset=train_subset,
+        train_dataloader=train_dataloader,
+        val_subset=val_subset,
+        val_dataloader=val_dataloader,
+        guidance_weight_range=(guidance_weight_min, guidance_weight_max),
+        guidance_emb_dim=guidance_emb_dim,
+        num_train_steps=num_train_steps,
+        batch_size=batch_size,
+        use_ema=use_ema,
+        lr=lr,
+        steps_til_summary=steps_til_summary,
+        steps_til_checkpoint=steps_til_ckpt,
+        clip_grad=True,
+        use_amp=use_amp,
+        amp_dtype=amp_dtype,
+        debug=debug,
+        tensor_args=tensor_args
+    )
+    print(f'guidance distilled model -- {model_dir}')
+
+if __name__ == '__main__':
+    # Leave unchanged
+    run_experiment(experiment)
@@ -7,6 +7,7 @@ from experiment_launcher import single_experiment_yaml, run_experiment
 from mpd import trainer
 from mpd.models import UNET_DIM_MULTS, ConditionedTemporalUnet
 from mpd.trainer import get_dataset, get_model, get_loss, get_summary
+from mpd.trainer.distributed import init_distributed, cleanup_distributed
 from mpd.trainer.trainer import get_num_epochs
 from torch_robotics.torch_utils.seed import fix_random_seed
 from torch_robotics.torch_utils.torch_utils import get_torch_device
@@ -19,6 +20,9 @@ def experiment(
     ########################################################################
     # Dataset
     dataset_subdir: str = 'CartPole-LMPC',
+    dataset_class: str = 'InputsDataset',  # 'InputsMemmapDataset': converted memmap format, read lazily
+    batch_loader: bool = False,  # True: gather whole batches from the dataset fields instead of DataLoader + collate
+    prefetch: int = 0,  # batches prepared ahead on a background thread (batch_loader only)
     include_velocity: bool = False,
 
     ########################################################################
@@ -27,6 +31,9 @@ def experiment(
     variance_schedule: str = 'exponential',  # cosine
     n_diffusion_steps: int = 25,
     predict_epsilon: bool = True,
+    n_noise_levels: int = 1,  # timesteps and noises per trajectory in the loss
+    timestep_sampling: str = 'uniform',  # 'stratified'
+    importance_weighting: bool = False,  # timesteps sampled and weighted from the loss history per timestep
 
     # Unet
     unet_input_dim: int = 32,
@@ -42,19 +49,28 @@ def experiment(
     num_train_steps: int = 5000, # 50000
 
     use_ema: bool = True,
-    use_amp: bool = False,
+    ema_side_thread: bool = False,  # fused ema update on a background thread
+    use_amp: bool = False,  # bfloat16 autocast on cpu, float16 + loss scaling on cuda
+    amp_dtype: str = None,  # None: device default, 'bfloat16' or 'float16'
 
     # model saving address
     model_saving_address = '/root/cartpoleDiff/cart_pole_diffusion_based_on_MPD/data_trained_models',
 
     # Summary parameters
     steps_til_summary: int = 2000,
+    target_val_loss: float = None,  # reports the time to reach this validation loss
     summary_class: str = 'SummaryTrajectoryGeneration',
 
     steps_til_ckpt: int = 5000,
+    keep_last_n_checkpoints: int = None,  # retention of the step checkpoints, None keeps all
+    keep_every_k_steps: int = None,
+    resume_from: str = None,  # model dir (or its checkpoints/training_state.pth) of the training to resume
 
     ########################################################################
     device: str = 'cuda',
+    # CPU data-parallel: launch with torchrun --standalone --nproc_per_node=<N> ... --device cpu
+    distributed_backend: str = 'gloo',
+    num_threads_per_process: int = None,  # None: cores split between the processes
 
     debug: bool = True,
 
@@ -70,6 +86,7 @@ def experiment(
     wandb_project: str = 'test_train',
     **kwargs
 ):
+    _, world_size = init_distributed(backend=distributed_backend, num_threads=num_threads_per_process)
     fix_random_seed(seed)
 
     device = get_torch_device(device=device)
@@ -78,10 +95,12 @@ def experiment(
 
     # Dataset
     train_subset, train_dataloader, val_subset, val_dataloader = get_dataset(
-        dataset_class='InputsDataset',
+        dataset_class=dataset_class,
         include_velocity=include_velocity,
         dataset_subdir=dataset_subdir,
         batch_size=batch_size,
+        batch_loader=batch_loader,
+        prefetch=prefetch,
         results_dir=results_dir,
         save_indices=True,
         tensor_args=tensor_args
@@ -103,6 +122,9 @@ def experiment(
         variance_schedule=variance_schedule,
         n_diffusion_steps=n_diffusion_steps,
         predict_epsilon=predict_epsilon,
+        n_noise_levels=n_noise_levels,
+        timestep_sampling=timestep_sampling,
+        importance_weighting=importance_weighting,
     )
 
     unet_configs = dict(
@@ -149,22 +171,29 @@ def experiment(
         train_subset=train_subset,
         val_dataloader=val_dataloader,
         val_subset=train_subset,
-        epochs=get_num_epochs(num_train_steps, batch_size, len(dataset)),
+        epochs=get_num_epochs(num_train_steps, batch_size, len(dataset) // world_size),
         model_dir=results_dir,
         # summary_fn=summary_fn,
         lr=lr,
         loss_fn=loss_fn,
         val_loss_fn=val_loss_fn,
         steps_til_summary=steps_til_summary,
+        target_val_loss=target_val_loss,
         steps_til_checkpoint=steps_til_ckpt,
         clip_grad=True,
         use_ema=use_ema,
+        ema_side_thread=ema_side_thread,
         use_amp=use_amp,
+        amp_dtype=amp_dtype,
         debug=debug,
         model_saving_address = model_saving_address,
+        keep_last_n_checkpoints=keep_last_n_checkpoints,
+        keep_every_k_steps=keep_every_k_steps,
+        resume_from=resume_from,
         #text_conditioner = text_conditioner,
         tensor_args=tensor_args
     )
+    cleanup_distributed()
 
     # print(f'DEBUG MODE: {debug}')
 
@@ -0,0 +1,109 @@
+import importlib
+import os
+from unittest import mock
+
+import pytest
+
+torch = pytest.importorskip('torch')
+
+# tiny cart pole model: control inputs [ batch x horizon x 1 ], conditioned on the initial state
+STATE_DIM = 1
+N_SUPPORT_POINTS = 8
+N_DIFFUSION_STEPS = 10
+
+# conditioning data loaded by temporal_unet at import time (X_SIZE), replaced by a small [ n x CONDITION_DIM ] tensor
+# when the training data is not there
+CONDITION_DATA_PATH = ('/root/cartpoleDiff/cart_pole_diffusion_based_on_MPD/training_data/Panda-Data/panda_test4/'
+                       'x_data_cat_test4.pt')
+CONDITION_DIM = 4
+
+
+def import_models():
+    if os.path.exists(CONDITION_DATA_PATH):
+        return importlib.import_module('mpd.models')
+    torch_load = torch.load
+
+    def load(f, *args, **kwargs):
+        if f == CONDITION_DATA_PATH:
+            return torch.zeros(16, CONDITION_DIM)
+        return torch_load(f, *args, **kwargs)
+
+    with mock.patch.object(torch, 'load', load):
+        return importlib.import_module('mpd.models')
+
+
+try:
+    import_models()
+except ImportError:
+    # missing dependencies, the tests that need mpd.models are skipped (import_or_skip)
+    pass
+
+
+def import_or_skip(name):
+    try:
+        return importlib.import_module(name)
+    except ImportError as e:
+        pytest.skip(f'{name} cannot be imported here: {e}')
+
+
+@pytest.fixture
+def models():
+    return import_or_skip('mpd.models')
+
+
+@pytest.fixture
+def make_diffusion_model(models):
+    def make(n_diffusion_steps=N_DIFFUSION_STEPS, predict_epsilon=True, guidance_emb_dim=0, seed=0):
+        torch.manual_seed(seed)
+        unet = models.ConditionedTemporalUnet(
+            state_dim=STATE_DIM, n_support_points=N_SUPPORT_POINTS, unet_input_dim=8,
+            dim_mults=models.UNET_DIM_MULTS[0], guidance_emb_dim=guidance_emb_dim
+        )
+        diffusion_model = models.GaussianDiffusionModel(
+            model=unet, variance_schedule='cosine', n_diffusion_steps=n_diffusion_steps,
+            predict_epsilon=predict_epsilon, device='cpu'
+        )
+        return diffusion_model.eval()
+    return make
+
+
+@pytest.fixture
+def condition_dim(models):
+    return models.X_SIZE
+
+
+@pytest.fixture
+def model_dir(tmp_path, make_diffusion_model, condition_dim):
+    """
+    Trained model dir of the tiny model (args.yaml, normalizer, checkpoint), loadable by DiffusionPolicy.
+    """
+    datasets = import_or_skip('mpd.datasets')
+    normalization = import_or_skip('mpd.datasets.normalization')
+    yaml = import_or_skip('yaml')
+
+    diffusion_model = make_diffusion_model()
+    os.makedirs(tmp_path / 'checkpoints')
+    torch.save(diffusion_model.state_dict(), tmp_path / 'checkpoints' / 'model_current_state_dict.pth')
+    with open(tmp_path / 'args.yaml', 'w') as stream:
+        yaml.dump(dict(
+            diffusion_model_class='GaussianDiffusionModel',
+            variance_schedule='cosine',
+            n_diffusion_steps=N_DIFFUSION_STEPS,
+            predict_epsilon=True,
+            unet_input_dim=8,
+            unet_dim_mults_option=0,
+            use_ema=False,
+        ), stream)
+
+    normalizer = normalization.DatasetNormalizer({
+        'inputs': torch.randn(64, N_SUPPORT_POINTS, STATE_DIM),
+        'condition': torch.randn(64, condition_dim),
+    }, normalization.LimitsNormalizer)
+    torch.save({
+        'normalizer': normalizer.state_dict(),
+        'field_key_inputs': 'inputs',
+        'field_key_condition': 'condition',
+        'n_support_points': N_SUPPORT_POINTS,
+        'state_dim': STATE_DIM,
+    }, tmp_path / datasets.NORMALIZER_FILE_NAME)
+    return str(tmp_path)
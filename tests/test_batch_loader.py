@@ -0,0 +1,69 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from conftest import import_or_skip
+
+
+class IndexDataset:
+    # get_batch gives back the gathered indices
+    def __init__(self, n):
+        self.n = n
+
+    def __len__(self):
+        return self.n
+
+    def get_batch(self, indices):
+        return {'idx': indices.clone()}
+
+
+@pytest.fixture
+def loader_class():
+    return import_or_skip('mpd.datasets.batch_loader').TensorBatchLoader
+
+
+def batches_of(loader):
+    return [batch['idx'].tolist() for batch in loader]
+
+
+@pytest.mark.parametrize('prefetch', [0, 2])
+def test_keeps_the_order_of_the_indices(loader_class, prefetch):
+    indices = [9, 3, 4, 8, 0, 1, 7]
+    loader = loader_class(IndexDataset(10), indices, batch_size=3, prefetch=prefetch)
+    assert len(loader) == 3
+    assert batches_of(loader) == [[9, 3, 4], [8, 0, 1], [7]]
+
+    loader = loader_class(IndexDataset(10), indices, batch_size=3, drop_last=True, prefetch=prefetch)
+    assert len(loader) == 2
+    assert batches_of(loader) == [[9, 3, 4], [8, 0, 1]]
+
+
+@pytest.mark.parametrize('prefetch', [0, 2])
+def test_resume_from_start_batch(loader_class, prefetch):
+    loader = loader_class(IndexDataset(10), batch_size=4, prefetch=prefetch)
+    full_epoch = batches_of(loader)
+
+    loader.start_batch = 1
+    assert batches_of(loader) == full_epoch[1:]
+    # only the resumed epoch starts late
+    assert batches_of(loader) == full_epoch
+
+
+def test_resumed_shuffled_epoch_matches(loader_class):
+    dataset = IndexDataset(20)
+    loader = loader_class(dataset, batch_size=4, shuffle=True, generator=torch.Generator().manual_seed(0))
+    epoch = batches_of(loader)
+    assert sorted(sum(epoch, [])) == list(range(20))
+
+    # same generator state: the resumed loader draws the same permutation and skips the batches already seen
+    resumed = loader_class(dataset, batch_size=4, shuffle=True, generator=torch.Generator().manual_seed(0))
+    resumed.start_batch = 2
+    assert batches_of(resumed) == epoch[2:]
+
+
+def test_early_stop_with_prefetch(loader_class):
+    loader = loader_class(IndexDataset(100), batch_size=2, prefetch=1)
+    for i, _ in enumerate(loader):
+        if i == 3:
+            break
+    assert len(batches_of(loader)) == 50
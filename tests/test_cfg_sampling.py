@@ -0,0 +1,88 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from conftest import N_DIFFUSION_STEPS, N_SUPPORT_POINTS, STATE_DIM
+
+
+def cfg_inputs(condition_dim, batch_size=4):
+    torch.manual_seed(1)
+    x = torch.randn(batch_size, N_SUPPORT_POINTS, STATE_DIM)
+    t = torch.randint(0, N_DIFFUSION_STEPS, (batch_size,))
+    context = torch.randn(batch_size, condition_dim)
+    return x, t, context, torch.zeros(batch_size, 1), torch.ones(batch_size, 1)
+
+
+@pytest.mark.parametrize('w', [0.01, 0.5, 2.])
+def test_fused_cfg_matches_two_pass(make_diffusion_model, condition_dim, w):
+    model = make_diffusion_model()
+    model.w = w
+    x, t, context, context_nonmask, context_mask = cfg_inputs(condition_dim)
+    with torch.no_grad():
+        x_start_fused = model.predict_start_CFG(x, t, context, context_nonmask, context_mask, fused_cfg=True)
+        x_start_two_pass = model.predict_start_CFG(x, t, context, context_nonmask, context_mask, fused_cfg=False)
+    torch.testing.assert_close(x_start_fused, x_start_two_pass, rtol=1e-4, atol=1e-5)
+
+
+def test_fused_cfg_sampling_matches_two_pass(make_diffusion_model, condition_dim):
+    model = make_diffusion_model()
+    _, _, context, _, _ = cfg_inputs(condition_dim)
+    samples = {}
+    for fused_cfg in (True, False):
+        torch.manual_seed(2)
+        samples[fused_cfg] = model.run_CFG(context, None, context_weight=0.5, n_samples=context.shape[0],
+                                           horizon=N_SUPPORT_POINTS, fused_cfg=fused_cfg, use_sampling_plan=False)
+    torch.testing.assert_close(samples[True], samples[False], rtol=1e-4, atol=1e-4)
+
+
+@pytest.mark.parametrize('timestep_respacing', ['uniform', 'quadratic'])
+@pytest.mark.parametrize('n_sampling_steps', [1, 4])
+def test_respaced_timesteps_cover_the_chain(models, timestep_respacing, n_sampling_steps):
+    diffusion_model_base = models.diffusion_models.diffusion_model_base
+    times = diffusion_model_base.make_respaced_timesteps(N_DIFFUSION_STEPS, n_sampling_steps, timestep_respacing)
+    assert times == sorted(set(times), reverse=True)
+    assert len(times) == n_sampling_steps
+    # the first step always starts from pure noise
+    assert times[0] == N_DIFFUSION_STEPS - 1
+    assert n_sampling_steps == 1 or times[-1] == 0
+
+
+def test_explicit_timesteps_start_at_the_last_diffusion_step(models):
+    make_respaced_timesteps = models.diffusion_models.diffusion_model_base.make_respaced_timesteps
+    assert make_respaced_timesteps(N_DIFFUSION_STEPS, 2, [4, N_DIFFUSION_STEPS - 1]) == [N_DIFFUSION_STEPS - 1, 4]
+    # a distilled student [99, 49] with a warm start of 3 steps
+    with pytest.raises(ValueError):
+        make_respaced_timesteps(3, 2, [99, 49])
+    with pytest.raises(ValueError):
+        make_respaced_timesteps(N_DIFFUSION_STEPS, 2, [N_DIFFUSION_STEPS - 2, 0])
+
+
+def test_alphas_cumprod_at_the_end_of_the_chain(make_diffusion_model):
+    model = make_diffusion_model()
+    t = torch.tensor([-1, 0, N_DIFFUSION_STEPS - 1])
+    alphas = model.alphas_cumprod_at(t, (3, N_SUPPORT_POINTS, STATE_DIM)).reshape(-1)
+    assert alphas[0] == 1.
+    torch.testing.assert_close(alphas[1:], model.alphas_cumprod[t[1:]])
+
+
+@pytest.mark.parametrize('eta', [0., 1.])
+def test_ddim_final_step_returns_the_predicted_x_start(make_diffusion_model, condition_dim, eta):
+    model = make_diffusion_model()
+    model.w = 0.5
+    x, t, context, context_nonmask, context_mask = cfg_inputs(condition_dim)
+    t_next = torch.full_like(t, -1)
+    with torch.no_grad():
+        x_start = model.predict_start_CFG(x, t, context, context_nonmask, context_mask).clamp(-1., 1.)
+        x_final = model.ddim_cart_pole_step(x, t, t_next, context, context_nonmask, context_mask, eta=eta)
+    torch.testing.assert_close(x_final, x_start)
+
+
+def test_ddim_sampling_is_finite(make_diffusion_model, condition_dim):
+    model = make_diffusion_model()
+    _, _, context, _, _ = cfg_inputs(condition_dim)
+    chain = model.run_CFG(context, None, context_weight=0.5, n_samples=context.shape[0], horizon=N_SUPPORT_POINTS,
+                          ddim=True, n_sampling_steps=4, return_chain=True)
+    # initial noise + one recorded state per DDIM step
+    assert chain.shape == (5, context.shape[0], N_SUPPORT_POINTS, STATE_DIM)
+    assert torch.isfinite(chain).all()
+    assert chain[-1].abs().max() <= 1.
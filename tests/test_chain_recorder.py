@@ -0,0 +1,50 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from conftest import N_SUPPORT_POINTS, STATE_DIM, import_or_skip
+
+
+@pytest.fixture
+def chain_recorder_class():
+    return import_or_skip('mpd.models.diffusion_models.helpers').ChainRecorder
+
+
+def record(chain_recorder_class, n_steps, **kwargs):
+    # states 0 (initial noise), 1, ..., n_steps (final sample), one value per state
+    chain = chain_recorder_class(torch.zeros(1), **kwargs)
+    for step in range(1, n_steps + 1):
+        chain.append(torch.full((1,), float(step)))
+    return chain.stack(torch.full((1,), float(n_steps)))[0].tolist()
+
+
+def test_records_every_step(chain_recorder_class):
+    assert record(chain_recorder_class, 5) == [0, 1, 2, 3, 4, 5]
+
+
+def test_stride_keeps_the_initial_and_final_states(chain_recorder_class):
+    assert record(chain_recorder_class, 5, stride=2) == [0, 2, 4, 5]
+    assert record(chain_recorder_class, 6, stride=3) == [0, 3, 6]
+
+
+def test_last_bounds_the_recorded_steps(chain_recorder_class):
+    assert record(chain_recorder_class, 10, last=3) == [8, 9, 10]
+    assert record(chain_recorder_class, 10, stride=4, last=2) == [8, 10]
+
+
+def test_clone_keeps_in_place_updates_out_of_the_chain(chain_recorder_class):
+    x = torch.zeros(1)
+    chain = chain_recorder_class(x, clone=True)
+    for _ in range(3):
+        x.add_(1.)
+        chain.append(x)
+    assert chain.stack(x)[0].tolist() == [0, 1, 2, 3]
+
+
+def test_sampler_chain_length(make_diffusion_model, condition_dim):
+    model = make_diffusion_model()
+    context = torch.zeros(2, condition_dim)
+    for use_sampling_plan in (True, False):
+        chain = model.run_CFG(context, None, context_weight=0.5, n_samples=2, horizon=N_SUPPORT_POINTS,
+                              return_chain=True, chain_stride=4, chain_last=2, use_sampling_plan=use_sampling_plan)
+        assert chain.shape == (2, 2, N_SUPPORT_POINTS, STATE_DIM)
@@ -0,0 +1,74 @@
+import os
+
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from conftest import import_or_skip
+
+
+@pytest.fixture
+def checkpointing():
+    return import_or_skip('mpd.trainer.checkpointing')
+
+
+def make_model(step):
+    model = torch.nn.Linear(2, 2)
+    model.submodules = {}
+    torch.nn.init.constant_(model.weight, float(step))
+    return model
+
+
+def saved_steps_on_disk(checkpoints_dir, checkpointing):
+    return sorted(int(match.group(1)) for match in map(checkpointing.STEP_CHECKPOINT_PATTERN.match,
+                                                          os.listdir(checkpoints_dir)) if match is not None)
+
+
+@pytest.mark.parametrize('async_write', [True, False])
+def test_retention(tmp_path, checkpointing, async_write):
+    model_dir, saved_main_folder = str(tmp_path / 'model'), str(tmp_path / 'saved')
+    manager = checkpointing.CheckpointManager(model_dir, saved_main_folder=saved_main_folder, keep_last_n=2,
+                                              keep_every_k=3, async_write=async_write)
+    for step in range(1, 8):
+        manager.save([(make_model(step), 'model')], epoch=0, total_steps=step, snapshot_name=step)
+    manager.close()
+
+    # last 2 checkpoints (6, 7) and every 3rd step (3, 6)
+    checkpoints_dir = os.path.join(model_dir, 'checkpoints')
+    assert saved_steps_on_disk(checkpoints_dir, checkpointing) == [3, 6, 7]
+    assert sorted(int(name) for name in os.listdir(saved_main_folder)) == [3, 6, 7]
+
+    # the current checkpoint is the latest one, also in the snapshot directories
+    current = torch.load(os.path.join(checkpoints_dir, 'model_current_state_dict.pth'))
+    assert (current['weight'] == 7.).all()
+    snapshot = torch.load(os.path.join(saved_main_folder, '3', 'checkpoints', 'model_current_state_dict.pth'))
+    assert (snapshot['weight'] == 3.).all()
+
+
+def test_keep_everything_by_default(tmp_path, checkpointing):
+    manager = checkpointing.CheckpointManager(str(tmp_path), async_write=False)
+    for step in range(1, 5):
+        manager.save([(make_model(step), 'model')], epoch=0, total_steps=step)
+    assert saved_steps_on_disk(os.path.join(str(tmp_path), 'checkpoints'), checkpointing) == [1, 2, 3, 4]
+
+
+def test_process_states(checkpointing):
+    assert checkpointing.get_process_state(['rank 0', 'rank 1'], 1) == 'rank 1'
+    with pytest.raises(ValueError):
+        checkpointing.get_process_state(['rank 0'], 1)
+
+
+def test_rng_states_round_trip(checkpointing):
+    rng_states = checkpointing.get_rng_states()
+    expected = torch.rand(3)
+    checkpointing.set_rng_states(rng_states)
+    assert torch.equal(torch.rand(3), expected)
+
+
+def test_loss_history_round_trip(make_diffusion_model):
+    model = make_diffusion_model()
+    model.update_loss_history(torch.tensor([0, 0, 3]), torch.tensor([1., 2., 3.]))
+    restored = make_diffusion_model()
+    restored.load_loss_history_state_dict(model.loss_history_state_dict())
+    assert torch.equal(restored.loss_sq_history, model.loss_sq_history)
+    assert restored.loss_history_counts.tolist()[:4] == [2, 0, 0, 1]
@@ -0,0 +1,79 @@
+import os
+
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from conftest import N_DIFFUSION_STEPS, N_SUPPORT_POINTS, STATE_DIM, import_or_skip
+
+
+@pytest.fixture
+def policy_class():
+    return import_or_skip('mpd.inference').DiffusionPolicy
+
+
+def test_warm_start_across_consecutive_act_calls(model_dir, policy_class, condition_dim):
+    tensor_args = {'device': 'cpu', 'dtype': torch.float32}
+    policy = policy_class(model_dir=model_dir, compile_model=False, tensor_args=tensor_args, warm_start_steps=3)
+
+    seeds = []
+    warm_start = policy.model.warm_start
+
+    def warm_start_spy(x_warm_start, n_warm_start_steps, shape):
+        seeds.append((x_warm_start.clone(), n_warm_start_steps))
+        return warm_start(x_warm_start, n_warm_start_steps, shape)
+
+    policy.model.warm_start = warm_start_spy
+
+    x0 = torch.zeros(condition_dim)
+    inputs_1 = policy.act(x0)
+    # first call: no previous plan, cold sampling
+    assert seeds == []
+    assert inputs_1.shape == (1, N_SUPPORT_POINTS, STATE_DIM)
+    previous = policy.previous_inputs_normalized.clone()
+
+    inputs_2 = policy.act(x0)
+    # second call: the previous plan shifted by one control step, noised to the timestep k - 1
+    assert len(seeds) == 1
+    seed, n_steps = seeds[0]
+    assert n_steps == 3
+    assert torch.equal(seed[:, :-1], previous[:, 1:])
+    assert torch.equal(seed[:, -1], previous[:, -1])
+    assert inputs_2.shape == inputs_1.shape
+    assert torch.isfinite(inputs_2).all()
+
+    # reset: the next call is cold again
+    policy.reset()
+    policy.act(x0)
+    assert len(seeds) == 1
+
+
+def test_shift_horizon():
+    shift_horizon = import_or_skip('mpd.inference.diffusion_policy').shift_horizon
+    x = torch.arange(4.).reshape(1, 4, 1)
+    assert shift_horizon(x, 1, pad='last')[0, :, 0].tolist() == [1, 2, 3, 3]
+    assert shift_horizon(x, 2, pad='zeros')[0, :, 0].tolist() == [2, 3, 0, 0]
+    assert torch.equal(shift_horizon(x, 0), x)
+
+
+@pytest.mark.parametrize('sample_kwargs', [dict(use_sampling_plan=False), dict(ddim=True, n_sampling_steps=2)])
+def test_warm_start_samplers(model_dir, policy_class, condition_dim, sample_kwargs):
+    tensor_args = {'device': 'cpu', 'dtype': torch.float32}
+    policy = policy_class(model_dir=model_dir, compile_model=False, tensor_args=tensor_args, warm_start_steps=3,
+                          **sample_kwargs)
+    x0 = torch.zeros(2, condition_dim)
+    inputs_1 = policy.act_batch(x0)
+    inputs_2 = policy.act_batch(x0)
+    assert inputs_2.shape == inputs_1.shape == (2, 1, N_SUPPORT_POINTS, STATE_DIM)
+    assert torch.isfinite(inputs_2).all()
+
+
+def test_distilled_student_refuses_a_warm_start(model_dir, policy_class):
+    loading = import_or_skip('mpd.utils.loading')
+    args_path = os.path.join(model_dir, 'args.yaml')
+    args = loading.load_params_from_yaml(args_path)
+    args['distilled_timesteps'] = [N_DIFFUSION_STEPS - 1, 4]
+    loading.save_params_to_yaml(args, args_path)
+    tensor_args = {'device': 'cpu', 'dtype': torch.float32}
+    with pytest.raises(ValueError):
+        policy_class(model_dir=model_dir, compile_model=False, tensor_args=tensor_args, warm_start_steps=3)
@@ -0,0 +1,57 @@
+import copy
+
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from conftest import import_or_skip
+
+
+@pytest.fixture
+def trainer():
+    return import_or_skip('mpd.trainer.trainer')
+
+
+def make_models():
+    torch.manual_seed(0)
+    current_model = torch.nn.Sequential(torch.nn.Linear(4, 8), torch.nn.BatchNorm1d(8), torch.nn.Linear(8, 2))
+    ema_model = copy.deepcopy(current_model)
+    return ema_model, current_model
+
+
+def train_step(model):
+    # new parameters and batch norm statistics, as after an optimizer step in train mode
+    with torch.no_grad():
+        for param in model.parameters():
+            param.add_(torch.randn_like(param))
+    model.train()
+    model(torch.randn(16, 4))
+
+
+@pytest.mark.parametrize('side_thread', [False, True])
+def test_fused_update_matches_per_parameter_update(trainer, side_thread):
+    ema = trainer.EMA(beta=0.9, side_thread=side_thread)
+    ema_model, current_model = make_models()
+    # previous update, one parameter at a time
+    reference = [param.detach().clone() for param in ema_model.parameters()]
+    for _ in range(3):
+        train_step(current_model)
+        ema.update_model_average(ema_model, current_model)
+        ema.wait()
+        reference = [ema.update_average(old, new.detach()) for old, new in zip(reference, current_model.parameters())]
+
+    for param, expected in zip(ema_model.parameters(), reference):
+        torch.testing.assert_close(param, expected)
+    for ema_buffer, current_buffer in zip(ema_model.buffers(), current_model.buffers()):
+        if ema_buffer.is_floating_point():
+            torch.testing.assert_close(ema_buffer, current_buffer)
+
+
+def test_reset_parameters(trainer):
+    ema = trainer.EMA(beta=0.9)
+    ema_model, current_model = make_models()
+    train_step(current_model)
+    ema.reset_parameters(ema_model, current_model)
+    for name, tensor in current_model.state_dict().items():
+        if tensor.is_floating_point():
+            torch.testing.assert_close(ema_model.state_dict()[name], tensor)
@@ -0,0 +1,52 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from conftest import N_DIFFUSION_STEPS, N_SUPPORT_POINTS, STATE_DIM, import_or_skip
+
+GUIDANCE_EMB_DIM = 16
+
+
+@pytest.fixture
+def distillation():
+    return import_or_skip('mpd.trainer.distillation')
+
+
+@pytest.fixture
+def student(make_diffusion_model, distillation):
+    # freshly expanded from the cfg teacher, before any distillation step
+    teacher = make_diffusion_model()
+    student = make_diffusion_model(guidance_emb_dim=GUIDANCE_EMB_DIM, seed=1)
+    distillation.load_expanded_state_dict(student, teacher.state_dict())
+    return teacher, student
+
+
+@pytest.mark.parametrize('w', [0., 0.5, 2.])
+def test_expanded_student_matches_the_conditional_teacher(student, condition_dim, w):
+    teacher, student = student
+    assert student.guidance_distilled and not teacher.guidance_distilled
+    torch.manual_seed(1)
+    batch_size = 4
+    x = torch.randn(batch_size, N_SUPPORT_POINTS, STATE_DIM)
+    t = torch.randint(0, N_DIFFUSION_STEPS, (batch_size,))
+    context = torch.randn(batch_size, condition_dim)
+    context_nonmask = torch.zeros(batch_size, 1)
+    with torch.no_grad():
+        out_teacher = teacher.model(x, t, context, context_nonmask)
+        out_student = student.model(x, t, context, context_nonmask,
+                                    guidance_weight=torch.full((batch_size,), w))
+    # the guidance weight embedding only feeds zero initialized weights
+    torch.testing.assert_close(out_student, out_teacher)
+
+
+@pytest.mark.parametrize('w', [0.01, 0.5])
+def test_distilled_plan_matches_the_generic_loop(student, condition_dim, w):
+    _, student = student
+    torch.manual_seed(3)
+    context = torch.randn(3, condition_dim)
+    samples = {}
+    for use_sampling_plan in (True, False):
+        torch.manual_seed(4)
+        samples[use_sampling_plan] = student.run_CFG(context, None, context_weight=w, n_samples=context.shape[0],
+                                                     horizon=N_SUPPORT_POINTS, use_sampling_plan=use_sampling_plan)
+    torch.testing.assert_close(samples[True], samples[False], rtol=1e-4, atol=1e-4)
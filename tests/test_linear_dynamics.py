@@ -0,0 +1,51 @@
+import pytest
+
+np = pytest.importorskip('numpy')
+torch = pytest.importorskip('torch')
+
+from conftest import import_or_skip
+
+HORIZON = 8
+
+
+@pytest.fixture
+def envs():
+    return import_or_skip('mpd.envs')
+
+
+@pytest.fixture
+def dynamics(envs):
+    return envs.DiscreteLinearDynamics(envs.LINEAR_A, envs.LINEAR_B, envs.LINEAR_TS)
+
+
+def step_loop(step_fn, x0, u_horizon):
+    # states along the horizon with one step call per control input, including x0
+    states = [x0]
+    for k in range(u_horizon.shape[-1]):
+        states.append(step_fn(states[-1], u_horizon[..., k]))
+    return states
+
+
+def test_discretization_is_cached(envs, dynamics):
+    other = envs.DiscreteLinearDynamics(envs.LINEAR_A, envs.LINEAR_B, envs.LINEAR_TS)
+    assert other.A_d is dynamics.A_d and other.B_d is dynamics.B_d
+    assert dynamics.rollout_matrices(HORIZON)[0] is dynamics.rollout_matrices(HORIZON)[0]
+
+
+def test_numpy_rollout_matches_the_step_loop(dynamics):
+    rng = np.random.default_rng(0)
+    x0 = rng.standard_normal((3, dynamics.state_dim))
+    u_horizon = rng.standard_normal((3, HORIZON))
+    states = np.stack(step_loop(dynamics.step_numpy, x0, u_horizon), axis=-2)
+    np.testing.assert_allclose(dynamics.rollout_numpy(x0, u_horizon), states, rtol=1e-10, atol=1e-10)
+
+
+def test_torch_rollout_matches_the_step_loop(dynamics):
+    torch.manual_seed(0)
+    x0 = torch.randn(3, dynamics.state_dim, dtype=torch.float64)
+    u_horizon = torch.randn(3, HORIZON, dtype=torch.float64)
+    states = torch.stack(step_loop(dynamics.step_torch, x0, u_horizon), dim=-2)
+    torch.testing.assert_close(dynamics.rollout_torch(x0, u_horizon), states)
+    # same dynamics as the numpy front-end
+    np.testing.assert_allclose(states.numpy(), dynamics.rollout_numpy(x0.numpy(), u_horizon.numpy()), rtol=1e-10,
+                               atol=1e-10)
@@ -0,0 +1,66 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from conftest import N_DIFFUSION_STEPS, N_SUPPORT_POINTS, STATE_DIM
+
+
+def test_expanded_batch_repeats_context_and_mask(make_diffusion_model, condition_dim):
+    diffusion_model = make_diffusion_model()
+    diffusion_model.drop_prob = 0.5
+    batch_size, n_noise_levels = 6, 3
+    x = torch.randn(batch_size, N_SUPPORT_POINTS, STATE_DIM)
+    context = torch.randn(batch_size, condition_dim)
+
+    denoiser_inputs = {}
+
+    def record_inputs(module, args):
+        denoiser_inputs['x'], denoiser_inputs['t'], denoiser_inputs['context'], denoiser_inputs['mask'] = args[:4]
+
+    hook = diffusion_model.model.register_forward_pre_hook(record_inputs)
+    try:
+        t, _ = diffusion_model.sample_timesteps(batch_size, n_noise_levels)
+        diffusion_model.p_losses(x, context, t, None)
+    finally:
+        hook.remove()
+
+    assert denoiser_inputs['x'].shape == (batch_size * n_noise_levels, N_SUPPORT_POINTS, STATE_DIM)
+    assert torch.equal(denoiser_inputs['t'], t)
+    torch.testing.assert_close(denoiser_inputs['context'], context.repeat_interleave(n_noise_levels, dim=0))
+    # one mask draw per clean sample, shared by its K noise levels
+    mask = denoiser_inputs['mask'].reshape(batch_size, n_noise_levels)
+    assert torch.equal(mask, mask[:, :1].expand_as(mask))
+
+
+def test_stratified_timesteps_cover_every_stratum(make_diffusion_model):
+    diffusion_model = make_diffusion_model()
+    diffusion_model.timestep_sampling = 'stratified'
+    # batch_size * n_noise_levels == n_diffusion_steps: one timestep per stratum
+    batch_size, n_noise_levels = 5, 2
+    torch.manual_seed(0)
+    for _ in range(10):
+        t, weights = diffusion_model.sample_timesteps(batch_size, n_noise_levels)
+        assert weights is None
+        assert sorted(t.tolist()) == list(range(N_DIFFUSION_STEPS))
+        # the k-th noise level of every sample falls in the k-th band
+        t = t.reshape(batch_size, n_noise_levels)
+        assert (t[:, 0] < N_DIFFUSION_STEPS // 2).all() and (t[:, 1] >= N_DIFFUSION_STEPS // 2).all()
+
+
+@pytest.mark.parametrize('timestep_sampling', ['uniform', 'stratified'])
+def test_importance_weights_are_unbiased(make_diffusion_model, timestep_sampling):
+    diffusion_model = make_diffusion_model()
+    diffusion_model.timestep_sampling = timestep_sampling
+    diffusion_model.importance_weighting = True
+    # history past the warmup, p(t) grows with t
+    diffusion_model.loss_sq_history.copy_(torch.arange(1., N_DIFFUSION_STEPS + 1) ** 2)
+    diffusion_model.loss_history_counts.fill_(diffusion_model.importance_warmup)
+    probs = diffusion_model.timestep_probs()
+    assert not torch.allclose(probs, torch.full_like(probs, 1. / N_DIFFUSION_STEPS))
+
+    torch.manual_seed(0)
+    t, weights = diffusion_model.sample_timesteps(50000, 2)
+    torch.testing.assert_close(weights, 1. / (N_DIFFUSION_STEPS * probs[t]))
+    # E_p[ w(t) f(t) ] is the uniform mean of f
+    f = torch.linspace(0.5, 2., N_DIFFUSION_STEPS)
+    torch.testing.assert_close((weights * f[t]).mean(), f.mean(), rtol=2e-2, atol=0.)
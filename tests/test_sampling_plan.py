@@ -0,0 +1,38 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from conftest import N_SUPPORT_POINTS
+
+
+def sample(model, context, w, seed, **kwargs):
+    torch.manual_seed(seed)
+    return model.run_CFG(context, None, context_weight=w, n_samples=context.shape[0], horizon=N_SUPPORT_POINTS,
+                         **kwargs)
+
+
+@pytest.mark.parametrize('w', [0.01, 0.5])
+def test_plan_matches_the_generic_loop(make_diffusion_model, condition_dim, w):
+    model = make_diffusion_model()
+    torch.manual_seed(3)
+    context = torch.randn(3, condition_dim)
+    # same noise draws: initial noise, then one draw per step with noise (none at t=0)
+    x_plan = sample(model, context, w, seed=4, use_sampling_plan=True)
+    x_loop = sample(model, context, w, seed=4, use_sampling_plan=False)
+    torch.testing.assert_close(x_plan, x_loop, rtol=1e-4, atol=1e-4)
+    # the cached plan gives the same samples again
+    torch.testing.assert_close(sample(model, context, w, seed=4, use_sampling_plan=True), x_plan)
+
+
+def test_plan_is_rebuilt_when_the_time_encoder_changes(make_diffusion_model, condition_dim):
+    model = make_diffusion_model()
+    context = torch.zeros(2, condition_dim)
+    sample(model, context, 0.5, seed=0)
+    plan = next(iter(model.sampling_plans.values()))
+    with torch.no_grad():
+        for param in model.model.time_mlp.parameters():
+            param.add_(0.1)
+    x_plan = sample(model, context, 0.5, seed=0)
+    assert next(iter(model.sampling_plans.values())) is not plan
+    torch.testing.assert_close(x_plan, sample(model, context, 0.5, seed=0, use_sampling_plan=False),
+                               rtol=1e-4, atol=1e-4)
@@ -0,0 +1,67 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from conftest import import_or_skip
+
+
+@pytest.fixture
+def shard_store():
+    return import_or_skip('mpd.datasets.shard_store')
+
+
+def make_group(idx_group, size_normal=3, size_noisy=6):
+    # rows of a collected group: normal data first, then noisy data, u values encode (group, row)
+    n = size_normal + size_noisy
+    u = (100 * idx_group + torch.arange(n, dtype=torch.float32)).reshape(n, 1, 1).expand(n, 4, 1).contiguous()
+    x0 = torch.randn(n, 5)
+    j = torch.rand(n)
+    return {'u': u, 'x0': x0, 'j': j}
+
+
+def test_round_trip(tmp_path, shard_store):
+    store = shard_store.ShardStore(str(tmp_path / 'shards'))
+    groups = [make_group(0), make_group(1)]
+    for group in groups:
+        store.append(group, dtype='float32')
+
+    assert len(store) == 18
+    assert shard_store.ShardStore.exists(str(tmp_path / 'shards'))
+    for name in ('u', 'x0', 'j'):
+        torch.testing.assert_close(store.load_field(name), torch.cat([group[name] for group in groups]))
+
+    # statistics merged at append time, equal to the statistics of all the data
+    x0 = torch.cat([group['x0'] for group in groups])
+    stats = store.get_stats('x0', dtype=torch.float32).get_tensors()
+    torch.testing.assert_close(stats['means'], x0.mean(dim=0))
+    torch.testing.assert_close(stats['stds'], x0.std(dim=0))
+
+
+def test_field_shapes_must_match(tmp_path, shard_store):
+    store = shard_store.ShardStore(str(tmp_path / 'shards'))
+    store.append(make_group(0))
+    group = make_group(1)
+    group['x0'] = torch.randn(len(group['x0']), 4)
+    with pytest.raises(ValueError):
+        store.append(group)
+    assert len(store.read_manifest()['shards']) == 1
+    assert not [p for p in (tmp_path / 'shards').iterdir() if p.name.startswith('.tmp_')]
+
+
+def test_full_file_layout(tmp_path, shard_store):
+    # groups appended in completion order by parallel workers
+    store = shard_store.ShardStore(str(tmp_path / 'shards'))
+    for idx_group in (2, 0, 1):
+        store.append(make_group(idx_group), meta={'idx_group': idx_group, 'size_normal_data': 3})
+
+    # normal data of the groups in idx_group order, then their noisy data
+    u = store.load_field('u')[:, 0, 0]
+    normal = [100 * g + r for g in (0, 1, 2) for r in range(3)]
+    noisy = [100 * g + r for g in (0, 1, 2) for r in range(3, 9)]
+    assert u.tolist() == normal + noisy
+
+    # normal blocks only: the pure data of every group
+    shards = store.read_manifest()['shards']
+    normal_blocks = store.get_layout(noisy=False)
+    assert [shards[i]['meta']['idx_group'] for i, _, _ in normal_blocks] == [0, 1, 2]
+    assert [(start, stop) for _, start, stop in normal_blocks] == [(0, 3)] * 3
@@ -0,0 +1,63 @@
+import pytest
+
+torch = pytest.importorskip('torch')
+
+from conftest import import_or_skip
+
+
+@pytest.fixture
+def train_loaders():
+    return import_or_skip('mpd.trainer.train_loaders')
+
+
+class IndexDataset(torch.utils.data.Dataset):
+    # dataset of its own indices
+
+    def __init__(self, dataset_subdir=None, n=100):
+        self.n = n
+
+    def __len__(self):
+        return self.n
+
+    def __getitem__(self, idx):
+        return idx
+
+
+def zip_split(normal_pos_range, normal_neg_range, noisy_pos_range, noisy_neg_range, val_set_size):
+    # previous split: python lists and zip comprehensions
+    indices_normal_pos, indices_normal_neg = list(normal_pos_range), list(normal_neg_range)
+    indices_noisy_pos, indices_noisy_neg = list(noisy_pos_range), list(noisy_neg_range)
+    normal_len = int((1 - val_set_size) * len(indices_normal_pos))
+    noisy_len = int((1 - val_set_size) * len(indices_noisy_pos))
+
+    def interleave(a, b):
+        return [val for pair in zip(a, b) for val in pair]
+
+    train_indices = (interleave(indices_normal_pos[:normal_len], indices_normal_neg[:normal_len])
+                     + interleave(indices_noisy_pos[:noisy_len], indices_noisy_neg[:noisy_len]))
+    val_indices = (interleave(indices_normal_pos[normal_len:], indices_normal_neg[normal_len:])
+                   + interleave(indices_noisy_pos[noisy_len:], indices_noisy_neg[noisy_len:]))
+    return train_indices, val_indices
+
+
+@pytest.mark.parametrize('indices_a, indices_b', [(range(5), range(10, 15)), (range(5), range(10, 13)), ([], range(3))])
+def test_interleave_indices_matches_zip(train_loaders, indices_a, indices_b):
+    interleaved = train_loaders.interleave_indices(train_loaders.range_to_indices(indices_a),
+                                                   train_loaders.range_to_indices(indices_b))
+    assert interleaved.dtype == torch.long
+    assert interleaved.tolist() == [val for pair in zip(indices_a, indices_b) for val in pair]
+
+
+def test_specified_dataset_order_matches_zip_split(train_loaders, monkeypatch):
+    monkeypatch.setattr(train_loaders.datasets, 'IndexDataset', IndexDataset, raising=False)
+    # the negative normal range is shorter than the positive one
+    ranges = dict(normal_pos_range=range(0, 20), normal_neg_range=range(20, 38),
+                  noisy_pos_range=range(40, 70), noisy_neg_range=range(70, 100))
+    train_subset, train_dataloader, val_subset, val_dataloader = train_loaders.get_specified_dataset(
+        dataset_class='IndexDataset', batch_size=4, val_set_size=0.2, **ranges
+    )
+    train_indices, val_indices = zip_split(val_set_size=0.2, **ranges)
+    assert torch.as_tensor(train_subset.indices).tolist() == train_indices
+    assert torch.as_tensor(val_subset.indices).tolist() == val_indices
+    assert torch.cat(list(train_dataloader)).tolist() == train_indices
+    assert torch.cat(list(val_dataloader)).tolist() == val_indices